@@ -1 +1,5 @@
-from .extension import *
+import importlib.util
+
+# the worker processes import this package from a plain python with only pxr available
+if importlib.util.find_spec("omni.ext") is not None:
+    from .extension import *
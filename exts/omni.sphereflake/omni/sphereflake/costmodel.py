@@ -0,0 +1,187 @@
+import os
+import json
+import socket
+import statistics
+from pxr import Usd
+from .sflayout import GetLayout
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Pre-flight cost model for a multi-flake run. Counts what a parameter set authors (prims, array data bytes) from the
+# flake layout and the tessellation, then turns that into wall time and process memory with per genmode coefficients.
+# The coefficients were measured on a desktop with usd-core, every host rescales them with the median ratio of
+# actual to predicted in its own run log records (the 2-pred_* fields written next to the actuals).
+
+COST_COEFS = {
+    # secs_prim - seconds per authored prim, secs_byte - seconds per byte of array data (points, normals, indices,
+    # instancer arrays), mem_prim - process memory per prim in bytes
+    "UsdSphere": {"secs_prim": 1.1e-4, "secs_byte": 0.0, "mem_prim": 1400},
+    "OmniSphere": {"secs_prim": 5.0e-4, "secs_byte": 0.0, "mem_prim": 1400},
+    "SdfSphere": {"secs_prim": 6.0e-5, "secs_byte": 0.0, "mem_prim": 1900},
+    "DirectMesh": {"secs_prim": 1.0e-4, "secs_byte": 2.5e-8, "mem_prim": 1400},
+    "AsyncMesh": {"secs_prim": 1.0e-4, "secs_byte": 2.5e-8, "mem_prim": 1400},
+    "MergedMesh": {"secs_prim": 1.0e-4, "secs_byte": 3.5e-9, "mem_prim": 1400},
+    "PointInstancer": {"secs_prim": 1.0e-4, "secs_byte": 8.0e-9, "mem_prim": 1400},
+}
+MEM_PER_DATA_BYTE = 1.5  # array data is held by the layer and again by Usd value caches
+SPEC_BYTES = 250  # a prim spec with its few scalar attributes, for the authored size
+MESH_GENMODES = ["DirectMesh", "AsyncMesh", "MergedMesh"]
+MAX_RATIOS = 50  # the most recent records per genmode that go into the calibration
+# Smaller runs do not calibrate, their time is noise and their memory mostly comes out of what earlier runs freed
+MIN_CALIB_SECS = 0.05
+MIN_CALIB_MEM = 32e6
+
+
+def GetRss() -> int:
+    return psutil.Process().memory_info().rss if psutil is not None else 0
+
+
+def GetPhysicalMemory() -> int:
+    return psutil.virtual_memory().total if psutil is not None else 0
+
+
+class CostModel():
+    hostname: str = None
+
+    def __init__(self, hostname: str = None):
+        self.hostname = hostname if hostname is not None else socket.gethostname()
+        self._ratios = {}
+
+    def CalcFeatures(self, sff, smf) -> dict:
+        # what a run of the current parameters authors - the same numbers are logged, calibration recomputes from them
+        genmode = sff.p_genmode
+        nflakes = sff.p_nsfx * sff.p_nsfy * sff.p_nsfz
+        layout = GetLayout(sff.p_genform, sff.p_depth, sff.p_rad, sff.p_radratio)
+        nspheres = layout.nnodes
+        databytes = 0
+        if genmode in MESH_GENMODES:
+            # points are point3f whatever the precision, normals normal3f or normal3h, quads with 4 indices each
+            normbytes = 6 if smf.p_precision == "Half" else 12
+            for level in range(sff.p_depth+1):
+                nlev = int((layout.depths == level).sum())
+                if nlev == 0:
+                    continue
+                rad = float(layout.radii[layout.depths == level][0])
+                (nlat, nlng) = sff.GetSphereTess(level, rad)
+                nverts = (nlat+1)*nlng
+                nquads = nlat*nlng
+                databytes += nlev * (nverts*(12 + normbytes) + nquads*(4*4 + 4))
+        elif genmode == "PointInstancer":
+            databytes = nspheres * (12 + 12 + 4)  # positions, scales, protoIndices
+        if genmode == "MergedMesh":
+            nprims = 3 * nflakes
+        elif genmode == "PointInstancer":
+            nprims = 5 * nflakes
+        elif sff.p_instanceable:
+            # one prototype per material, every flake is an instance root with its bounds
+            nprims = 2*nspheres + 1 + 2*nflakes
+        else:
+            # a node xform and its sphere per tree node, plus the flake root
+            nprims = (2*nspheres + 1) * nflakes
+        if not sff.p_instanceable or genmode in ["MergedMesh", "PointInstancer"]:
+            databytes *= nflakes
+        return {"genmode": genmode, "nflakes": nflakes, "spheres": nspheres*nflakes, "prims": nprims,
+                "databytes": databytes}
+
+    def CalcBase(self, genmode: str, prims: int, databytes: int) -> tuple:
+        # uncalibrated (secs, memory bytes)
+        coefs = COST_COEFS.get(genmode, COST_COEFS["UsdSphere"])
+        secs = coefs["secs_prim"]*prims + coefs["secs_byte"]*databytes
+        mem = coefs["mem_prim"]*prims + MEM_PER_DATA_BYTE*databytes
+        return (secs, mem)
+
+    def GetScale(self, genmode: str, kind: str) -> float:
+        ratios = self._ratios.get(genmode, {}).get(kind, [])
+        return statistics.median(ratios) if len(ratios) > 0 else 1.0
+
+    def GetNCalib(self, genmode: str) -> int:
+        return len(self._ratios.get(genmode, {}).get("secs", []))
+
+    def Predict(self, sff, smf) -> dict:
+        feat = self.CalcFeatures(sff, smf)
+        genmode = feat["genmode"]
+        (secs, mem) = self.CalcBase(genmode, feat["prims"], feat["databytes"])
+        rss = GetRss()
+        pred = dict(feat)
+        pred["bytes"] = feat["databytes"] + SPEC_BYTES*feat["prims"]
+        pred["secs"] = secs * self.GetScale(genmode, "secs")
+        pred["mem"] = mem * self.GetScale(genmode, "mem")
+        pred["rss_start"] = rss
+        pred["peak_rss"] = rss + pred["mem"]
+        pred["ncalib"] = self.GetNCalib(genmode)
+        return pred
+
+    def AddRecord(self, rec: dict) -> bool:
+        # only complete serial runs of this host, anything else does not measure what the model predicts
+        if rec.get("0-hostname") != self.hostname or "2-pred_prims" not in rec:
+            return False
+        if rec.get("2-cancelled") or rec.get("1-incremental") or rec.get("1-parallel"):
+            return False
+        genmode = rec.get("1-genmode")
+        (secs, mem) = self.CalcBase(genmode, rec["2-pred_prims"], rec["2-pred_databytes"])
+        actsecs = rec.get("2-elapsed", 0) - rec.get("2-yield_elapsed", 0)
+        actmem = rec.get("2-rss_delta_mb", 0) * 1e6
+        ratios = self._ratios.setdefault(genmode, {"secs": [], "mem": []})
+        if secs >= MIN_CALIB_SECS and actsecs > 0:
+            ratios["secs"] = (ratios["secs"] + [min(50.0, max(0.02, actsecs/secs))])[-MAX_RATIOS:]
+        if mem >= MIN_CALIB_MEM and actmem > 0:
+            ratios["mem"] = (ratios["mem"] + [min(50.0, max(0.02, actmem/mem))])[-MAX_RATIOS:]
+        return True
+
+    def CalibrateFromLog(self, path: str) -> int:
+        # the rotated backups are older, they go in first so the newest records win
+        nrec = 0
+        paths = [f"{path}.{i}" for i in range(9, 0, -1)] + [path]
+        for fname in paths:
+            if not os.path.isfile(fname):
+                continue
+            try:
+                with open(fname, "r") as f:
+                    for line in f:
+                        try:
+                            rec = json.loads(line)
+                        except ValueError:
+                            continue
+                        if self.AddRecord(rec):
+                            nrec += 1
+            except OSError as e:
+                print(f"CostModel.CalibrateFromLog - cannot read {fname}: {e}")
+        return nrec
+
+    def GetBudget(self, budgetgb: float) -> int:
+        # 0 means three quarters of the physical memory, when that is known
+        if budgetgb > 0:
+            return int(budgetgb * 1e9)
+        return int(0.75 * GetPhysicalMemory())
+
+    def IsOverBudget(self, pred: dict, budgetgb: float) -> bool:
+        budget = self.GetBudget(budgetgb)
+        return budget > 0 and pred["peak_rss"] > budget
+
+
+def MakeCostFields(pred: dict, nprims: int) -> dict:
+    # predicted next to actual, for the run log - the features are what calibration reads back
+    om = 1e6
+    rss = GetRss()
+    return {"2-pred_prims": pred["prims"],
+            "2-pred_databytes": pred["databytes"],
+            "2-pred_bytes": pred["bytes"],
+            "2-pred_secs": round(pred["secs"], 3),
+            "2-pred_rss_delta_mb": round(pred["mem"]/om, 1),
+            "2-pred_peak_rss_mb": round(pred["peak_rss"]/om, 1),
+            "2-pred_ncalib": pred["ncalib"],
+            "2-actual_prims": nprims,
+            "2-rss_delta_mb": round((rss - pred["rss_start"])/om, 1) if rss > 0 else 0,
+            "2-rss_mb": round(rss/om, 1)}
+
+
+def CountPrims(stage, roots: list) -> int:
+    nprims = 0
+    for root in roots:
+        prim = stage.GetPrimAtPath(root)
+        if prim.IsValid():
+            nprims += sum(1 for _ in Usd.PrimRange(prim))
+    return nprims
@@ -50,7 +50,9 @@ class SphereflakeBenchmarkExtension(omni.ext.IExt):
 
         # Model objects
         self._matman = MatMan()
+        self._matman.LoadSettings()
         self._smf = SphereMeshFactory(self._matman)
+        self._smf.LoadSettings()
         self._sff = SphereFlakeFactory(self._matman, self._smf)
         self._sff.LoadSettings()
 
@@ -0,0 +1,185 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from pxr import Sdf
+
+# On-disk cache of generated flakes. Each distinct flake (SphereFlakeFactory.GetVariantKey) is authored once at the
+# origin, copied into its own .usdc under FLAKE_ROOT and referenced from then on. Relationships that point outside
+# the flake (the material bindings, materials live in the stage) cannot be carried by a reference, they are taken
+# out of the .usdc and kept in a json next to it, and authored as overs on the referencing prim.
+# The manifest records size and last use of every entry, past maxbytes the least recently used go first.
+
+FLAKE_CACHE_VERSION = 1
+FLAKE_ROOT = Sdf.Path("/Flake")
+
+
+def GetDefaultFlakeCacheDir() -> str:
+    return os.path.join(os.path.expanduser("~"), ".omni.sphereflake", "flakes")
+
+
+class FlakeCache():
+    cachedir: str = None
+    maxbytes: int = 0
+    manifest: dict = None
+
+    hitCount: int = 0
+    missCount: int = 0
+    storeCount: int = 0
+    evictCount: int = 0
+
+    def __init__(self, cachedir: str, maxbytes: int = 1024*1024*1024):
+        self.cachedir = cachedir
+        self.maxbytes = maxbytes
+        self._bindings = {}
+        self._touched = set()
+        self.LoadManifest()
+        # a lowered maxbytes applies right away, not only at the next Store
+        if self.Evict() > 0:
+            self.SaveManifest()
+
+    def GetManifestPath(self) -> str:
+        return os.path.join(self.cachedir, "manifest.json")
+
+    def LoadManifest(self):
+        self.manifest = {"version": FLAKE_CACHE_VERSION, "entries": {}}
+        path = self.GetManifestPath()
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"FlakeCache.LoadManifest - unreadable manifest {path}: {e}")
+            return
+        if manifest.get("version") != FLAKE_CACHE_VERSION:
+            print(f"FlakeCache.LoadManifest - version {manifest.get('version')} != {FLAKE_CACHE_VERSION}, discarding")
+            return
+        self.manifest = manifest
+
+    def SaveManifest(self):
+        os.makedirs(self.cachedir, exist_ok=True)
+        path = self.GetManifestPath()
+        tmppath = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmppath, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmppath, path)
+
+    def GetKey(self, variantkey: tuple) -> str:
+        return hashlib.sha256(repr((FLAKE_CACHE_VERSION, variantkey)).encode()).hexdigest()[:24]
+
+    def GetLayerPath(self, key: str) -> str:
+        return os.path.join(self.cachedir, f"{key}.usdc")
+
+    def GetBindingsPath(self, key: str) -> str:
+        return os.path.join(self.cachedir, f"{key}.bindings.json")
+
+    def Lookup(self, key: str) -> str:
+        # the .usdc path on a hit, the last use is written back once per entry and session
+        entry = self.manifest["entries"].get(key)
+        path = self.GetLayerPath(key)
+        if entry is None or not os.path.isfile(path) or os.path.getsize(path) != entry["usdcsize"]:
+            self.missCount += 1
+            return None
+        self.hitCount += 1
+        if key not in self._touched:
+            self._touched.add(key)
+            entry["lastused"] = time.time()
+            self.SaveManifest()
+        return path
+
+    def GetBindings(self, key: str) -> list:
+        if key not in self._bindings:
+            try:
+                with open(self.GetBindingsPath(key), "r") as f:
+                    self._bindings[key] = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"FlakeCache.GetBindings - {key}: {e}")
+                self._bindings[key] = []
+        return self._bindings[key]
+
+    def ExtractBindings(self, layer: Sdf.Layer) -> list:
+        # relationships with targets outside FLAKE_ROOT, grouped by (name, targets) - PerSphere binds
+        # every sphere to the same material, so that is one group with all the sphere paths
+        relpaths = []
+        layer.Traverse(FLAKE_ROOT, lambda path: relpaths.append(path) if path.IsPropertyPath() else None)
+        groups = {}
+        for path in relpaths:
+            rel = layer.GetRelationshipAtPath(path)
+            if rel is None:
+                continue
+            targets = list(rel.targetPathList.explicitItems)
+            if all(t.HasPrefix(FLAKE_ROOT) for t in targets):
+                continue
+            gkey = (rel.name, tuple(str(t) for t in targets))
+            groups.setdefault(gkey, []).append(str(path.GetPrimPath()))
+            rel.owner.RemoveProperty(rel)
+        return [{"rel": name, "targets": list(targets), "prims": prims}
+                for ((name, targets), prims) in groups.items()]
+
+    def Store(self, key: str, srclayer: Sdf.Layer, srcpath: str) -> str:
+        # srcpath is a flake authored at the origin, it is copied as is (CopySpec remaps the paths inside it)
+        os.makedirs(self.cachedir, exist_ok=True)
+        layer = Sdf.Layer.CreateAnonymous(".usdc")
+        Sdf.CreatePrimInLayer(layer, FLAKE_ROOT)
+        Sdf.CopySpec(srclayer, Sdf.Path(srcpath), layer, FLAKE_ROOT)
+        layer.defaultPrim = FLAKE_ROOT.name
+        bindings = self.ExtractBindings(layer)
+        path = self.GetLayerPath(key)
+        bpath = self.GetBindingsPath(key)
+        tmppath = f"{path[:-5]}.{threading.get_ident()}.tmp.usdc"
+        try:
+            with open(f"{bpath}.tmp", "w") as f:
+                json.dump(bindings, f)
+            os.replace(f"{bpath}.tmp", bpath)
+            layer.Export(tmppath)
+            os.replace(tmppath, path)
+        except OSError as e:
+            # an open layer on Windows, a full disk - the flake is then just authored uncached
+            print(f"FlakeCache.Store - cannot write {path}: {e}")
+            return None
+        self._bindings[key] = bindings
+        self._touched.add(key)
+        self.manifest["entries"][key] = {"usdcsize": os.path.getsize(path),
+                                         "size": os.path.getsize(path) + os.path.getsize(bpath),
+                                         "created": time.time(),
+                                         "lastused": time.time()}
+        self.storeCount += 1
+        self.Evict(keep=key)
+        self.SaveManifest()
+        return path
+
+    def GetTotalBytes(self) -> int:
+        return sum(entry["size"] for entry in self.manifest["entries"].values())
+
+    def Evict(self, keep: str = None) -> int:
+        # least recently used first, until the total is under maxbytes - a file the stage still has open may not
+        # be deletable (Windows), that entry then stays until the next time
+        nevict = 0
+        total = self.GetTotalBytes()
+        entries = sorted(self.manifest["entries"].items(), key=lambda kv: kv[1]["lastused"])
+        for (key, entry) in entries:
+            if total <= self.maxbytes:
+                break
+            if key == keep:
+                continue
+            try:
+                for path in [self.GetLayerPath(key), self.GetBindingsPath(key)]:
+                    if os.path.exists(path):
+                        os.remove(path)
+            except OSError as e:
+                print(f"FlakeCache.Evict - cannot remove {key}: {e}")
+                continue
+            del self.manifest["entries"][key]
+            self._bindings.pop(key, None)
+            total -= entry["size"]
+            nevict += 1
+        self.evictCount += nevict
+        return nevict
+
+    def ResetStats(self):
+        self.hitCount = 0
+        self.missCount = 0
+        self.storeCount = 0
+        self.evictCount = 0
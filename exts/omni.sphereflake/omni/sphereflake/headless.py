@@ -0,0 +1,280 @@
+import os
+import sys
+import json
+import time
+import types
+import asyncio
+import argparse
+import itertools
+import importlib.util
+from pxr import Usd, UsdGeom
+
+# Headless benchmark runner - runs SphereFlakeFactory/SphereMeshFactory against an in-memory Usd stage with usd-core,
+# no Kit needed. Writes one JSONL record per run, same schema as the Kit UI log (runlog.MakeRunRecord).
+#
+#   python -m omni.sphereflake.headless --sweep sweep.json --out runs.jsonl
+#   python -m omni.sphereflake.headless --genmode UsdSphere,SdfSphere --depth 2,3 --grid 1x1x1,4x1x4 --out runs.jsonl
+#   python -m omni.sphereflake.headless --genmode DirectMesh --depth 4 --trace trace.json --trace-sample 10
+#   python -m omni.sphereflake.headless --genmode SdfSphere --depth 3 --grid 100x1x100 --export grid.usdc
+#
+# run from exts/omni.sphereflake (or put it on PYTHONPATH). A sweep spec is a json object with a list per axis:
+#   {"seriesname": "ci", "genmode": ["UsdSphere"], "genform": ["Classic"], "depth": [2, 3],
+#    "grid": [[1, 1, 1], [4, 1, 4]], "nlatlng": [[8, 8], [16, 16]], "repeat": 1, "params": {"p_bind_mode": "FlakeRoot"}}
+# "params" are set on the factories as is, anything starting with p_ that either of them has.
+
+_stage = None
+
+# these need Kit commands (or the renderer) and are skipped headless
+KIT_ONLY_GENMODES = ["OmniSphere"]
+
+
+class _KitlessContext():
+    def get_stage(self):
+        return _stage
+
+    def get_stage_id(self):
+        return 0
+
+    async def new_stage_async(self):
+        SetStage(Usd.Stage.CreateInMemory())
+
+
+class _KitlessApp():
+    async def next_update_async(self):
+        await asyncio.sleep(0)
+
+
+class _KitlessSettings(dict):
+    def set(self, key, value):
+        self[key] = value
+
+
+def _kitless_execute(cmdname, **kwargs):
+    raise RuntimeError(f"Kit command {cmdname} is not available in a headless run")
+
+
+def InstallKitlessContext() -> bool:
+    # The factories reach the stage through omni.usd.get_context() and settings through carb. Without Kit those are
+    # provided here, backed by the stage SetStage was given. Inside Kit nothing is touched.
+    if importlib.util.find_spec("omni.usd") is not None:
+        return False
+    omni = importlib.import_module("omni")
+
+    usd = types.ModuleType("omni.usd")
+    usd.get_context = lambda: _KitlessContext()
+    kit = types.ModuleType("omni.kit")
+    app = types.ModuleType("omni.kit.app")
+    app.get_app = lambda: _KitlessApp()
+    commands = types.ModuleType("omni.kit.commands")
+    commands.execute = _kitless_execute
+    kit.app = app
+    kit.commands = commands
+
+    settings = _KitlessSettings()
+    carb = types.ModuleType("carb")
+    carb_settings = types.ModuleType("carb.settings")
+    carb_settings.get_settings = lambda: settings
+    carb.settings = carb_settings
+    carb.log_error = lambda msg: print(f"[Error] {msg}")
+    carb.log_warn = lambda msg: print(f"[Warning] {msg}")
+    carb.log = types.SimpleNamespace(error=carb.log_error, warn=carb.log_warn)
+    # only the remote build-sf-set path uses aiohttp, and that is never taken headless
+    aiohttp = types.ModuleType("aiohttp")
+
+    omni.usd = usd
+    omni.kit = kit
+    sys.modules.update({"omni.usd": usd, "omni.kit": kit, "omni.kit.app": app, "omni.kit.commands": commands,
+                        "carb": carb, "carb.settings": carb_settings})
+    if importlib.util.find_spec("aiohttp") is None:
+        sys.modules["aiohttp"] = aiohttp
+    return True
+
+
+def SetStage(stage: Usd.Stage):
+    global _stage
+    _stage = stage
+
+
+def ParseList(arg: str, conv=str) -> list:
+    return [conv(a) for a in arg.split(",") if a != ""]
+
+
+def ParseTriples(arg: str) -> list:
+    # "4x1x4,2x2x2" -> [[4, 1, 4], [2, 2, 2]], a pair "8x8" for nlat/nlng
+    return [[int(v) for v in a.split("x")] for a in arg.split(",") if a != ""]
+
+
+def MakeSweep(args) -> dict:
+    sweep = {"seriesname": "headless", "genmode": ["UsdSphere"], "genform": ["Classic"], "depth": [2],
+             "grid": [[1, 1, 1]], "nlatlng": [[8, 8]], "repeat": 1, "params": {}}
+    if args.sweep:
+        with open(args.sweep, "r") as f:
+            sweep.update(json.load(f))
+    if args.seriesname:
+        sweep["seriesname"] = args.seriesname
+    if args.genmode:
+        sweep["genmode"] = ParseList(args.genmode)
+    if args.genform:
+        sweep["genform"] = ParseList(args.genform)
+    if args.depth:
+        sweep["depth"] = ParseList(args.depth, int)
+    if args.grid:
+        sweep["grid"] = ParseTriples(args.grid)
+    if args.nlatlng:
+        sweep["nlatlng"] = ParseTriples(args.nlatlng)
+    if args.repeat:
+        sweep["repeat"] = args.repeat
+    return sweep
+
+
+def MakeFactories(genmode: str, genform: str, depth: int, grid: list, nlatlng: list, params: dict,
+                  stage: Usd.Stage = None) -> tuple:
+    # a fresh in-memory stage (or the one given) with /World, and the factories set up on it - (stage, matman, smf, sff)
+    from .ovut import MatMan
+    from .spheremesh import SphereMeshFactory
+    from .sphereflake import SphereFlakeFactory
+
+    if stage is None:
+        stage = Usd.Stage.CreateInMemory()
+    UsdGeom.SetStageUpAxis(stage, UsdGeom.Tokens.y)
+    UsdGeom.Xform.Define(stage, "/World")
+    SetStage(stage)
+
+    matman = MatMan()
+    matman.p_content_mode = "Preview"
+    smf = SphereMeshFactory(matman)
+    sff = SphereFlakeFactory(matman, smf)
+    sff.p_genmode = genmode
+    sff.p_genform = genform
+    sff.p_depth = depth
+    (sff.p_nsfx, sff.p_nsfy, sff.p_nsfz) = grid
+    (smf.p_nlat, smf.p_nlng) = nlatlng
+    sff.p_parallelRender = False
+    sff.p_partialRender = False
+    sff.p_frame_budget_ms = 0.0
+    for (name, val) in params.items():
+        if hasattr(sff, name):
+            setattr(sff, name, val)
+        elif hasattr(smf, name):
+            setattr(smf, name, val)
+        else:
+            print(f"MakeFactories - no parameter {name}, ignored")
+    return (stage, matman, smf, sff)
+
+
+def RunOne(genmode: str, genform: str, depth: int, grid: list, nlatlng: list, params: dict, seriesname: str,
+           costmodel=None, budgetgb: float = None) -> dict:
+    # budgetgb - skip the run (returns None) when the predicted peak memory is over it, 0 is 75% of the RAM
+    from .runlog import MakeRunRecord
+    from .costmodel import CostModel, MakeCostFields, CountPrims
+
+    (stage, matman, smf, sff) = MakeFactories(genmode, genform, depth, grid, nlatlng, params)
+    costmodel = costmodel if costmodel is not None else CostModel()
+    pred = costmodel.Predict(sff, smf)
+    if budgetgb is not None and costmodel.IsOverBudget(pred, budgetgb):
+        print(f"RunOne - skipping {genmode} depth:{depth} grid:{grid}, predicted peak "
+              f"{pred['peak_rss']/1e9:.2f} GB is over the budget")
+        SetStage(None)
+        return None
+    sff.ResetBindStats()
+    sff.ResetPhaseTimes()
+    asyncio.run(matman.Prewarm([sff.p_sf_matname, sff.p_sf_alt_matname, sff.p_bb_matname]))
+
+    start = time.time()
+    sff.GenerateMany()
+    asyncio.run(sff.AwaitAsyncMeshes())
+    elap = time.time() - start
+
+    rundict = MakeRunRecord(sff, smf, matman, elap, seriesname)
+    rundict.update(MakeCostFields(pred, CountPrims(stage, sff._createlist)))
+    rundict["0-runner"] = "headless"
+    costmodel.AddRecord(rundict)
+    SetStage(None)
+    return rundict
+
+
+def RunSweep(sweep: dict, outpath: str, tracepath: str = None, tracesample: int = 1, budgetgb: float = None) -> int:
+    from .telemetry import TelemetrySink
+    from .tracing import GetTracer
+    from .costmodel import CostModel
+    costmodel = CostModel()
+    ncalib = costmodel.CalibrateFromLog(outpath)
+    print(f"RunSweep - cost model calibrated from {ncalib} records of {outpath}")
+    tracer = GetTracer()
+    if tracepath is not None:
+        tracer.Reset()
+        tracer.Enable(True, tracesample)
+    sink = TelemetrySink(outpath, maxbytes=0)
+    axes = [sweep["genmode"], sweep["genform"], sweep["depth"], sweep["grid"], sweep["nlatlng"]]
+    nruns = 0
+    for (genmode, genform, depth, grid, nlatlng) in itertools.product(*axes):
+        if genmode in KIT_ONLY_GENMODES:
+            print(f"RunSweep - skipping {genmode}, it needs Kit")
+            continue
+        for irep in range(sweep["repeat"]):
+            rundict = RunOne(genmode, genform, depth, grid, nlatlng, sweep["params"], sweep["seriesname"],
+                             costmodel, budgetgb)
+            if rundict is None:
+                break
+            rundict["0-repeat"] = irep
+            sink.Write(rundict)
+            nruns += 1
+            print(f"{genmode} {genform} depth:{depth} grid:{grid} tess:{nlatlng} rep:{irep} "
+                  f"elapsed:{rundict['2-elapsed']} s (predicted {rundict['2-pred_secs']} s) "
+                  f"spheres/s:{rundict['2-spheres_per_sec']}")
+    sink.Close()
+    if tracepath is not None:
+        tracer.Enable(False)
+        nevents = tracer.WriteChromeTrace(tracepath)
+        print(tracer.FormatTable())
+        print(f"wrote {nevents} trace events to {tracepath}")
+    return nruns
+
+
+def ExportOne(genmode: str, genform: str, depth: int, grid: list, nlatlng: list, params: dict, filepath: str,
+              chunkcells: int) -> dict:
+    # streams the grid to filepath (SphereFlakeFactory.ExportMany), the in-memory stage only holds the materials
+    from .costmodel import GetRss
+    (stage, matman, smf, sff) = MakeFactories(genmode, genform, depth, grid, nlatlng, params)
+    sff.p_export_chunk = chunkcells
+    rss = GetRss()
+    res = asyncio.run(sff.ExportMany(filepath))
+    if res is not None:
+        res["rss_delta_mb"] = round((GetRss() - rss)/1e6, 1)
+    SetStage(None)
+    return res
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Headless SphereFlake benchmark sweeps (usd-core, no Kit)")
+    parser.add_argument("--sweep", help="json sweep spec, the other options override its axes")
+    parser.add_argument("--out", default="sphereflake_runs.jsonl", help="JSONL file the run records are appended to")
+    parser.add_argument("--seriesname", help="0-seriesname of the records")
+    parser.add_argument("--genmode", help="comma separated, e.g. UsdSphere,SdfSphere")
+    parser.add_argument("--genform", help="comma separated, e.g. Classic,Flat-8")
+    parser.add_argument("--depth", help="comma separated, e.g. 2,3")
+    parser.add_argument("--grid", help="comma separated nxXnyXnz, e.g. 1x1x1,4x1x4")
+    parser.add_argument("--nlatlng", help="comma separated nlatXnlng, e.g. 8x8,16x16")
+    parser.add_argument("--repeat", type=int, help="runs per combination")
+    parser.add_argument("--trace", help="Chrome trace json of the hot path spans of the whole sweep")
+    parser.add_argument("--trace-sample", type=int, default=1, help="keep every nth event per span name")
+    parser.add_argument("--mem-budget-gb", type=float, help="skip runs predicted over it, 0 is 75%% of the RAM")
+    parser.add_argument("--export", help="write the first combination of the axes to this .usdc instead of a sweep")
+    parser.add_argument("--export-chunk", type=int, default=256, help="grid cells per chunk file of --export")
+    args = parser.parse_args(argv)
+
+    InstallKitlessContext()
+    sweep = MakeSweep(args)
+    if args.export:
+        axes = [sweep["genmode"], sweep["genform"], sweep["depth"], sweep["grid"], sweep["nlatlng"]]
+        res = ExportOne(*[axis[0] for axis in axes], sweep["params"], os.path.abspath(args.export), args.export_chunk)
+        print(f"export: {res}")
+        return 0 if res is not None else 1
+    tracepath = os.path.abspath(args.trace) if args.trace else None
+    nruns = RunSweep(sweep, os.path.abspath(args.out), tracepath, args.trace_sample, args.mem_budget_gb)
+    print(f"wrote {nruns} records to {os.path.abspath(args.out)}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,181 @@
+import os
+import json
+import time
+import hashlib
+import threading
+import urllib.request
+from typing import List
+
+# Local content cache for the remote assets we pull from the omniverse-content bucket (MDL materials, the sky).
+# Files are stored under the cache dir with the same relative path they have in the bucket, the manifest records
+# the source url, size and sha256 of each of them. Only stdlib and pxr, so it can also be used from plain python.
+
+CACHE_VERSION = 1
+CONTENT_BASEURL = 'https://omniverse-content-production.s3.us-west-2.amazonaws.com'
+
+
+def GetDefaultCacheDir() -> str:
+    return os.path.join(os.path.expanduser("~"), ".omni.sphereflake", "content")
+
+
+def HashFile(path: str) -> str:
+    sha = hashlib.sha256()
+    with open(path, "rb") as f:
+        for blk in iter(lambda: f.read(1 << 20), b""):
+            sha.update(blk)
+    return sha.hexdigest()
+
+
+class ContentCache():
+    cachedir: str = None
+    manifest: dict = None
+
+    hitCount: int = 0
+    missCount: int = 0
+    fillCount: int = 0
+    failCount: int = 0
+
+    def __init__(self, cachedir: str, baseurl: str = CONTENT_BASEURL):
+        self.cachedir = cachedir
+        self.baseurl = baseurl
+        self._verified = set()
+        self._lock = threading.RLock()
+        self.LoadManifest()
+
+    def GetManifestPath(self) -> str:
+        return os.path.join(self.cachedir, "manifest.json")
+
+    def LoadManifest(self):
+        self.manifest = {"version": CACHE_VERSION, "entries": {}}
+        path = self.GetManifestPath()
+        if not os.path.isfile(path):
+            return
+        try:
+            with open(path, "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"ContentCache.LoadManifest - unreadable manifest {path}: {e}")
+            return
+        if manifest.get("version") != CACHE_VERSION:
+            # layout or hashing changed, everything gets refetched on demand
+            print(f"ContentCache.LoadManifest - version {manifest.get('version')} != {CACHE_VERSION}, discarding")
+            return
+        self.manifest = manifest
+
+    def SaveManifest(self):
+        os.makedirs(self.cachedir, exist_ok=True)
+        path = self.GetManifestPath()
+        tmppath = path + ".tmp"
+        with open(tmppath, "w") as f:
+            json.dump(self.manifest, f, indent=1, sort_keys=True)
+        os.replace(tmppath, path)
+
+    def GetUrl(self, key: str) -> str:
+        return f"{self.baseurl}/{key}"
+
+    def GetLocalPath(self, key: str) -> str:
+        return os.path.join(self.cachedir, *key.split("/"))
+
+    def IsValid(self, key: str, seen: set = None) -> bool:
+        # an entry is only good if its file and all its dependencies are there with the recorded hash,
+        # hashes are checked once per session
+        entry = self.manifest["entries"].get(key)
+        if entry is None:
+            return False
+        if key not in self._verified:
+            path = self.GetLocalPath(key)
+            if not os.path.isfile(path) or HashFile(path) != entry["sha256"]:
+                print(f"ContentCache.IsValid - {key} missing or hash mismatch")
+                del self.manifest["entries"][key]
+                return False
+            self._verified.add(key)
+        seen = set() if seen is None else seen
+        seen.add(key)
+        return all(dep in seen or self.IsValid(dep, seen) for dep in entry.get("deps", []))
+
+    def Lookup(self, key: str) -> str:
+        # resolves may run on several threads at once (material prewarm), the manifest is shared state
+        with self._lock:
+            if self.IsValid(key):
+                self.hitCount += 1
+                return self.GetLocalPath(key)
+        return None
+
+    def Fill(self, key: str, timeout: float = 30.0) -> str:
+        # the remote bucket is only a fill source, the local file is what gets used
+        url = self.GetUrl(key)
+        path = self.GetLocalPath(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmppath = f"{path}.{threading.get_ident()}.part"
+        try:
+            with urllib.request.urlopen(url, timeout=timeout) as rsp, open(tmppath, "wb") as f:
+                while True:
+                    blk = rsp.read(1 << 20)
+                    if not blk:
+                        break
+                    f.write(blk)
+            os.replace(tmppath, path)
+        except OSError as e:
+            print(f"ContentCache.Fill - failed to fetch {url}: {e}")
+            self.failCount += 1
+            if os.path.exists(tmppath):
+                os.remove(tmppath)
+            return None
+        entry = {"url": url,
+                 "sha256": HashFile(path),
+                 "size": os.path.getsize(path),
+                 "fetched": time.strftime("%Y-%m-%d %H:%M:%S"),
+                 "deps": []}
+        with self._lock:
+            self.manifest["entries"][key] = entry
+            self._verified.add(key)
+            self.fillCount += 1
+        entry["deps"] = self.FillDependencies(key, path, timeout)
+        with self._lock:
+            self.SaveManifest()
+        return path
+
+    def FillDependencies(self, key: str, path: str, timeout: float) -> List[str]:
+        # usd layers (the sky) pull in textures and other layers by relative path, those have to be local too
+        if os.path.splitext(path)[1].lower() not in [".usd", ".usda", ".usdc"]:
+            return []
+        from pxr import Tf, UsdUtils
+        try:
+            (sublayers, refs, payloads) = UsdUtils.ExtractExternalReferences(path)
+        except Tf.ErrorException as e:
+            print(f"ContentCache.FillDependencies - cannot parse {path}: {e}")
+            return []
+        deps = []
+        keydir = key.rsplit("/", 1)[0]
+        for asset in sublayers + refs + payloads:
+            if "://" in asset or os.path.isabs(asset):
+                continue
+            depkey = os.path.normpath(f"{keydir}/{asset}").replace("\\", "/")
+            if depkey.startswith(".."):
+                continue
+            if depkey not in deps and (self.Lookup(depkey) or self.Fill(depkey, timeout) is not None):
+                deps.append(depkey)
+        return deps
+
+    def Resolve(self, key: str, offline: bool = False) -> str:
+        path = self.Lookup(key)
+        if path is not None:
+            return path
+        self.missCount += 1
+        if offline:
+            return None
+        return self.Fill(key)
+
+    def Prefetch(self, keys: List[str]) -> int:
+        nok = 0
+        for key in keys:
+            if self.Lookup(key) or self.Fill(key) is not None:
+                nok += 1
+        print(f"ContentCache.Prefetch - {nok} of {len(keys)} available in {self.cachedir}")
+        return nok
+
+    def ResetStats(self):
+        self.hitCount = 0
+        self.missCount = 0
+        self.fillCount = 0
+        self.failCount = 0
@@ -1,12 +1,17 @@
 import omni.kit.commands as okc
+import omni.kit.app
 import omni.usd
 import os
 import sys
 import math
+import time
+import asyncio
 
 from pxr import Gf, Sdf, UsdShade
 from typing import Tuple, List
 import carb.settings
+from .matcache import ContentCache, GetDefaultCacheDir
+from .tracing import traced
 
 
 _settings = None
@@ -49,6 +54,7 @@ def truncf(number, digits) -> float:
     return math.trunc(stepper * number) / stepper
 
 
+@traced()
 def delete_if_exists(primpath: str) -> None:
     ctx = omni.usd.get_context()
     stage = ctx.get_stage()
@@ -102,10 +108,54 @@ def read_in_syspath(fname: str = 'd:/nv/ov/syspath.txt') -> None:
 class MatMan():
     matlib = {}
 
+    # CacheFirst resolves remote content from the local cache and fills it from S3 on a miss,
+    # Offline never touches the network and falls back to UsdPreviewSurface equivalents,
+    # Preview always uses the UsdPreviewSurface equivalents (headless runs have no MDL support)
+    p_content_mode = "CacheFirst"
+    p_cache_dir = ""
+    _cache: ContentCache = None
+
+    skybranch = "Assets/Skies/2022_1/Skies/Dynamic/CumulusLight.usd"
+
     def __init__(self) -> None:
         self.CreateMaterials()
         pass
 
+    def LoadSettings(self):
+        print("MatMan.LoadSettings (trc)")
+        self.p_content_mode = get_setting("p_content_mode", self.p_content_mode)
+        self.p_cache_dir = get_setting("p_cache_dir", self.p_cache_dir)
+
+    def SaveSettings(self):
+        print("MatMan.SaveSettings (trc)")
+        save_setting("p_content_mode", self.p_content_mode)
+        save_setting("p_cache_dir", self.p_cache_dir)
+
+    def GetContentModes(self) -> List[str]:
+        return ["CacheFirst", "Offline", "Remote", "Preview"]
+
+    def GetContentCache(self) -> ContentCache:
+        cachedir = self.p_cache_dir if self.p_cache_dir else GetDefaultCacheDir()
+        if self._cache is None or self._cache.cachedir != cachedir:
+            self._cache = ContentCache(cachedir)
+        return self._cache
+
+    def ResolveContent(self, key: str) -> str:
+        # returns what to load for a bucket relative key - a local file, the remote url, or None if unavailable
+        if self.p_content_mode == "Remote":
+            return self.GetContentCache().GetUrl(key)
+        if self.p_content_mode == "Preview":
+            return None
+        return self.GetContentCache().Resolve(key, offline=self.p_content_mode == "Offline")
+
+    def GetRemoteKeys(self) -> List[str]:
+        keys = [f"Materials/{m['spec']}.mdl" for m in self.matlib.values() if m["typ"] == "mtl"]
+        keys.append(self.skybranch)
+        return keys
+
+    def PrefetchContent(self) -> int:
+        return self.GetContentCache().Prefetch(self.GetRemoteKeys())
+
     def MakePreviewSurfaceTexMateral(self, matname: str, fname: str):
         # This is all materials
         matpath = "/World/Looks"
@@ -149,7 +199,7 @@ class MatMan():
         b = float(sar[2])
         return (r, g, b)
 
-    def MakePreviewSurfaceMaterial(self, matname: str, rgb: str):
+    def MakePreviewSurfaceMaterial(self, matname: str, rgb: str, roughness=0.5, metallic=0.0, opacity=1.0):
         mtl_path = Sdf.Path(f"/World/Looks/Presurf_{matname}")
         stage = omni.usd.get_context().get_stage()
 
@@ -158,8 +208,11 @@ class MatMan():
         shader.CreateIdAttr("UsdPreviewSurface")
         rgbtup = self.SplitRgb(rgb)
         shader.CreateInput("diffuseColor", Sdf.ValueTypeNames.Color3f).Set(rgbtup)
-        shader.CreateInput("roughness", Sdf.ValueTypeNames.Float).Set(0.5)
-        shader.CreateInput("metallic", Sdf.ValueTypeNames.Float).Set(0.0)
+        shader.CreateInput("roughness", Sdf.ValueTypeNames.Float).Set(roughness)
+        shader.CreateInput("metallic", Sdf.ValueTypeNames.Float).Set(metallic)
+        if opacity < 1.0:
+            shader.CreateInput("opacity", Sdf.ValueTypeNames.Float).Set(opacity)
+            shader.CreateInput("ior", Sdf.ValueTypeNames.Float).Set(1.5)
         mtl.CreateSurfaceOutput().ConnectToSource(shader.ConnectableAPI(), "surface")
         # self.matlib[matname] = {"name": matname, "typ": "mtl", "mat": mtl}
         self.matlib[matname]["mat"] = mtl
@@ -168,16 +221,58 @@ class MatMan():
     refCount: int = 0
     fetchCount: int = 0
     skipCount: int = 0
+    fallbackCount: int = 0
+    prewarmTime: float = 0.0
+
+    def IsRealized(self, matname: str) -> bool:
+        # a material realized on an earlier stage does not count
+        mat = self.matlib[matname]["mat"]
+        if not self.matlib[matname]["realized"] or mat is None or not mat.GetPrim().IsValid():
+            return False
+        return mat.GetPrim().GetStage() == omni.usd.get_context().get_stage()
+
+    async def Prewarm(self, names: List[str]) -> float:
+        # realizes the materials a run will use before it is timed, so the first sphere does not stall on them
+        # remote content is resolved concurrently on threads, stage authoring has to stay on the main thread
+        start = time.time()
+        names = list(dict.fromkeys(names))
+        todo = []
+        for name in names:
+            if name not in self.matlib or self.IsRealized(name):
+                continue
+            self.matlib[name]["realized"] = False
+            todo.append(name)
+        keys = [f"Materials/{self.matlib[n]['spec']}.mdl" for n in todo if self.matlib[n]["typ"] == "mtl"]
+        if len(keys) > 0 and self.p_content_mode not in ["Remote", "Preview"]:
+            cache = self.GetContentCache()
+            offline = self.p_content_mode == "Offline"
+            loop = asyncio.get_event_loop()
+            await asyncio.gather(*[loop.run_in_executor(None, cache.Resolve, key, offline) for key in keys])
+        for name in todo:
+            self.GetMaterial(name)
+        # give Kit a frame to pick up the new material prims before the timed run starts
+        await omni.kit.app.get_app().next_update_async()
+        self.prewarmTime = time.time() - start
+        print(f"MatMan.Prewarm - {len(todo)} of {len(names)} materials realized in {self.prewarmTime:.3f} s")
+        return self.prewarmTime
+
+    def MakeFallbackMaterial(self, matname: str):
+        # offline stand-in for an MDL material, close enough in colour and transparency for benchmark renders
+        (rgb, roughness, metallic, opacity) = self.matlib[matname]["fallback"]
+        print(f"MakeFallbackMaterial matname:{matname} rgb:{rgb}")
+        self.fallbackCount += 1
+        return self.MakePreviewSurfaceMaterial(matname, rgb, roughness, metallic, opacity)
 
     def CopyRemoteMaterial(self, matname, urlbranch, force=False):
         print(f"CopyRemoteMaterial matname:{matname} urlbranch:{urlbranch} force:{force}")
         stage = omni.usd.get_context().get_stage()
-        baseurl = 'https://omniverse-content-production.s3.us-west-2.amazonaws.com'
-        url = f'{baseurl}/Materials/{urlbranch}.mdl'
         mpath = f'/World/Looks/{matname}'
         action = ""
         # Note we should not execute the next command if the material already exists
         if force or not stage.GetPrimAtPath(mpath):
+            url = self.ResolveContent(f'Materials/{urlbranch}.mdl')
+            if url is None:
+                return self.MakeFallbackMaterial(matname)
             okc.execute('CreateMdlMaterialPrimCommand', mtl_url=url, mtl_name=matname, mtl_path=mpath)
             action = "fetch"
             self.fetchCount += 1
@@ -201,7 +296,7 @@ class MatMan():
             self.MakePreviewSurfaceMaterial(matname, spec)
         self.matlib[matname]["realized"] = True
 
-    def SetupMaterial(self, matname: str, typ: str, spec: str):
+    def SetupMaterial(self, matname: str, typ: str, spec: str, fallback=None):
         # print(f"SetupMaterial {matname} {typ} {spec}")
         matpath = f"/World/Looks/{matname}"
         self.matlib[matname] = {"name": matname,
@@ -209,7 +304,8 @@ class MatMan():
                                 "mat": None,
                                 "path": matpath,
                                 "realized": False,
-                                "spec": spec}
+                                "spec": spec,
+                                "fallback": fallback}
 
     def CreateMaterials(self):
         self.SetupMaterial("red", "rgb", "1,0,0")
@@ -220,16 +316,18 @@ class MatMan():
         self.SetupMaterial("magenta", "rgb", "1,0,1")
         self.SetupMaterial("white", "rgb", "1,1,1")
         self.SetupMaterial("black", "rgb", "0,0,0")
-        self.SetupMaterial("Blue_Glass",  "mtl", "Base/Glass/Blue_Glass")
-        self.SetupMaterial("Red_Glass", "mtl", "Base/Glass/Red_Glass")
-        self.SetupMaterial("Green_Glass", "mtl", "Base/Glass/Green_Glass")
-        self.SetupMaterial("Clear_Glass", "mtl", "Base/Glass/Clear_Glass")
-        self.SetupMaterial("Mirror", "mtl", "Base/Glass/Mirror")
+        # fallbacks are (rgb, roughness, metallic, opacity) for the UsdPreviewSurface used in Offline mode
+        self.SetupMaterial("Blue_Glass",  "mtl", "Base/Glass/Blue_Glass", ("0.2,0.3,1", 0.05, 0.0, 0.3))
+        self.SetupMaterial("Red_Glass", "mtl", "Base/Glass/Red_Glass", ("1,0.2,0.2", 0.05, 0.0, 0.3))
+        self.SetupMaterial("Green_Glass", "mtl", "Base/Glass/Green_Glass", ("0.2,1,0.2", 0.05, 0.0, 0.3))
+        self.SetupMaterial("Clear_Glass", "mtl", "Base/Glass/Clear_Glass", ("1,1,1", 0.0, 0.0, 0.1))
+        self.SetupMaterial("Mirror", "mtl", "Base/Glass/Mirror", ("0.95,0.95,0.95", 0.0, 1.0, 1.0))
         self.SetupMaterial("sunset_texture", "tex", "sunset.png")
 
     def GetMaterialNames(self) -> List[str]:
         return list(self.matlib.keys())
 
+    @traced()
     def GetMaterial(self, key):
         self.refCount += 1
         if key in self.matlib:
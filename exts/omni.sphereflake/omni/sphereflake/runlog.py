@@ -0,0 +1,111 @@
+import json
+import socket
+import hashlib
+import datetime
+from .ovut import truncf
+
+# The run record written for every benchmark run, shared by the Kit UI (SfControls.write_log) and the headless runner.
+# Keys are prefixed with a sort group: 0 - run identity, 1 - parameters, 2 - results, 3 - gpu, 4 - host memory, 5 - cpu.
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+
+def GetSysInfo() -> dict:
+    om = float(1024*1024*1024)
+    if psutil is None:
+        return {"4-sys_gbmem_tot": 0, "4-sys_gbmem_used": 0, "4-sys_gbmem_free": 0, "5-cpu_cores": 0}
+    vmem = psutil.virtual_memory()
+    return {"4-sys_gbmem_tot": truncf(vmem.total/om, 3),
+            "4-sys_gbmem_used": truncf(vmem.used/om, 3),
+            "4-sys_gbmem_free": truncf(vmem.free/om, 3),
+            "5-cpu_cores": psutil.cpu_count()}
+
+
+def GetParams(*objs) -> dict:
+    # the persisted p_ parameters of the factories, what a run was configured with
+    params = {}
+    for obj in objs:
+        for name in dir(obj):
+            val = getattr(obj, name)
+            if name.startswith("p_") and isinstance(val, (bool, int, float, str)):
+                params[f"{type(obj).__name__}.{name}"] = val
+    return params
+
+
+def GetParamsHash(*objs) -> str:
+    # runs with the same hash were configured the same, whatever the series name says
+    jstr = json.dumps(GetParams(*objs), sort_keys=True)
+    return hashlib.sha256(jstr.encode("utf-8")).hexdigest()[:16]
+
+
+def MakeRunRecord(sff, smf, matman, elap: float, seriesname: str, gpuinfo=None) -> dict:
+    nflakes = sff.p_nsfx * sff.p_nsfy * sff.p_nsfz
+    ntris, nprims = sff.CalcTrisAndPrims()
+    gridtris, gridprims = sff.CalcGridTrisAndPrims()
+    nspheres = sff.CalcSpheres()*nflakes
+    nbindrels, bindtime = sff.GetBindStats()
+    cache = matman.GetContentCache()
+    phases = sff.GetPhaseTimes()
+    (flakehits, flakemisses) = sff.GetFlakeCacheStats()
+    om = float(1024*1024*1024)
+    rundict = {"0-seriesname": seriesname,
+               "0-params_hash": GetParamsHash(sff, smf, matman),
+               "0-hostname": socket.gethostname(),
+               "0-date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+               "1-genmode": sff.p_genmode,
+               "1-genform": sff.p_genform,
+               "1-depth": sff.p_depth,
+               "1-rad": sff.p_rad,
+               "1-radratio": sff.p_radratio,
+               "1-nsfx": sff.p_nsfx,
+               "1-nsfy": sff.p_nsfy,
+               "1-nsfz": sff.p_nsfz,
+               "1-nlat": smf.p_nlat,
+               "1-nlng": smf.p_nlng,
+               "1-instanceable": sff.p_instanceable,
+               "1-incremental": sff.p_incremental,
+               "1-parallel": sff.p_parallelRender,
+               "1-bind_mode": sff.p_bind_mode,
+               "1-flake_cache": sff.p_flake_cache,
+               "1-payload_cells": sff.p_payload_cells,
+               "1-frame_budget_ms": sff.p_frame_budget_ms,
+               "1-precision": smf.p_precision,
+               "1-tess_mode": smf.p_tess_mode,
+               "1-async_workers": smf.p_async_workers,
+               "1-content_mode": matman.p_content_mode,
+               "2-tris": ntris,
+               "2-prims": nprims,
+               "2-grid_tris": gridtris,
+               "2-grid_prims": gridprims,
+               "2-spheres": nspheres,
+               "2-merge_chunk": sff.GetMergeChunk(),
+               "2-nflakes": nflakes,
+               "2-elapsed": truncf(elap, 3),
+               "2-teardown_elapsed": truncf(sff._teardown_time, 3),
+               "2-prewarm_elapsed": truncf(matman.prewarmTime, 3),
+               "2-yield_elapsed": truncf(sff._yield_time, 3),
+               "2-slices": sff._nslices,
+               "2-cancelled": sff._cancelled,
+               "2-bind_rels": nbindrels,
+               "2-bind_elapsed": truncf(bindtime, 3),
+               "2-content_hits": cache.hitCount,
+               "2-content_fills": cache.fillCount,
+               "2-content_fallbacks": matman.fallbackCount,
+               "2-flake_cache_hits": flakehits,
+               "2-flake_cache_misses": flakemisses,
+               "2-phase_prewarm": truncf(matman.prewarmTime, 4),
+               "2-phase_layout": truncf(phases.get("layout", 0.0), 4),
+               "2-phase_author": truncf(phases.get("author", 0.0), 4),
+               "2-phase_bind": truncf(phases.get("bind", 0.0), 4),
+               "2-phase_bounds": truncf(phases.get("bounds", 0.0), 4),
+               "2-phase_teardown": truncf(phases.get("teardown", 0.0), 4),
+               "2-spheres_per_sec": truncf(nspheres/elap, 1) if elap > 0 else 0,
+               "3-gpu_gbmem_tot": truncf(gpuinfo.total/om, 3) if gpuinfo is not None else 0,
+               "3-gpu_gbmem_used": truncf(gpuinfo.used/om, 3) if gpuinfo is not None else 0,
+               "3-gpu_gbmem_free": truncf(gpuinfo.free/om, 3) if gpuinfo is not None else 0,
+               }
+    rundict.update(GetSysInfo())
+    return rundict
@@ -0,0 +1,200 @@
+import time
+from pxr import Gf, Sdf, Vt
+from .sflayout import SphereFlakeLayout
+
+
+class SdfAuthor():
+    # Writes prim specs, xformOps and attributes straight into an Sdf.Layer.
+    # Nothing in here goes through the Usd API, so a caller can wrap a whole chunk
+    # in one Sdf.ChangeBlock and the stage only recomposes once when the block closes.
+    # Materials have to be realized (and their paths known) before the block is opened.
+
+    _layer: Sdf.Layer = None
+    _opordercache: dict = {}
+    _bindschemas = Sdf.TokenListOp.Create(prependedItems=["MaterialBindingAPI"])
+    nprims: int = 0
+    nrels: int = 0
+    bindtime: float = 0.0
+
+    def __init__(self, layer: Sdf.Layer) -> None:
+        self._layer = layer
+        self.nprims = 0
+        self.nrels = 0
+        self.bindtime = 0.0
+
+    def EnsureDefined(self, primpath: str) -> Sdf.PrimSpec:
+        # like UsdStage.DefinePrim, missing ancestors become typeless defs rather than overs
+        path = Sdf.Path(primpath)
+        spec = self._layer.GetPrimAtPath(path)
+        if spec is not None:
+            return spec
+        parent = self._layer.pseudoRoot
+        for prefix in path.GetPrefixes():
+            spec = self._layer.GetPrimAtPath(prefix)
+            if spec is None:
+                spec = Sdf.PrimSpec(parent, prefix.name, Sdf.SpecifierDef)
+            parent = spec
+        return spec
+
+    def RemovePrim(self, primpath: str) -> bool:
+        spec = self._layer.GetPrimAtPath(primpath)
+        if spec is None:
+            return False
+        del spec.realNameParent.nameChildren[spec.name]
+        return True
+
+    def DefinePrim(self, parent: Sdf.PrimSpec, name: str, typename: str = "") -> Sdf.PrimSpec:
+        self.nprims += 1
+        return Sdf.PrimSpec(parent, name, Sdf.SpecifierDef, typename)
+
+    def SetXformOps(self, spec: Sdf.PrimSpec, translate, scale=None, rotate=None):
+        # same attribute types XformCommonAPI authors: double3 translate, float3 rotateXYZ and scale
+        order = ("xformOp:translate",)
+        attr = Sdf.AttributeSpec(spec, "xformOp:translate", Sdf.ValueTypeNames.Double3)
+        attr.default = Gf.Vec3d(translate[0], translate[1], translate[2])
+        if rotate is not None:
+            attr = Sdf.AttributeSpec(spec, "xformOp:rotateXYZ", Sdf.ValueTypeNames.Float3)
+            attr.default = Gf.Vec3f(rotate[0], rotate[1], rotate[2])
+            order += ("xformOp:rotateXYZ",)
+        if scale is not None:
+            attr = Sdf.AttributeSpec(spec, "xformOp:scale", Sdf.ValueTypeNames.Float3)
+            attr.default = Gf.Vec3f(scale[0], scale[1], scale[2])
+            order += ("xformOp:scale",)
+        if order not in self._opordercache:
+            self._opordercache[order] = Vt.TokenArray(order)
+        attr = Sdf.AttributeSpec(spec, "xformOpOrder", Sdf.ValueTypeNames.TokenArray, Sdf.VariabilityUniform)
+        attr.default = self._opordercache[order]
+
+    def SetTranslate(self, spec: Sdf.PrimSpec, translate):
+        # moves a prim whose xformOps are already authored, the op order is left alone
+        attr = spec.attributes.get("xformOp:translate")
+        if attr is None:
+            attr = Sdf.AttributeSpec(spec, "xformOp:translate", Sdf.ValueTypeNames.Double3)
+        attr.default = Gf.Vec3d(translate[0], translate[1], translate[2])
+
+    def SetScale(self, spec: Sdf.PrimSpec, scale):
+        attr = spec.attributes.get("xformOp:scale")
+        if attr is None:
+            attr = Sdf.AttributeSpec(spec, "xformOp:scale", Sdf.ValueTypeNames.Float3)
+        attr.default = Gf.Vec3f(scale[0], scale[1], scale[2])
+
+    def SetVisibility(self, spec: Sdf.PrimSpec, visible: bool):
+        attr = spec.attributes.get("visibility")
+        if attr is None:
+            attr = Sdf.AttributeSpec(spec, "visibility", Sdf.ValueTypeNames.Token, Sdf.VariabilityVarying)
+        attr.default = "inherited" if visible else "invisible"
+
+    def BindMaterial(self, spec: Sdf.PrimSpec, mtlpath: Sdf.Path):
+        # equivalent of UsdShade.MaterialBindingAPI(prim).Bind(mtl)
+        if mtlpath is None:
+            return
+        start = time.time()
+        spec.SetInfo("apiSchemas", self._bindschemas)
+        rel = Sdf.RelationshipSpec(spec, "material:binding", False)
+        rel.targetPathList.explicitItems = [mtlpath]
+        self.nrels += 1
+        self.bindtime += time.time() - start
+
+    def BindCollection(self, spec: Sdf.PrimSpec, collname: str, includes: list, mtlpath: Sdf.Path):
+        # collection based binding - a CollectionAPI instance on spec and one binding relationship that
+        # points at the collection and the material, the bound prims themselves get no specs at all
+        if mtlpath is None:
+            return
+        start = time.time()
+        schemas = list(spec.GetInfo("apiSchemas").prependedItems) if spec.HasInfo("apiSchemas") else []
+        for schema in ["MaterialBindingAPI", f"CollectionAPI:{collname}"]:
+            if schema not in schemas:
+                schemas.append(schema)
+        spec.SetInfo("apiSchemas", Sdf.TokenListOp.Create(prependedItems=schemas))
+        rel = Sdf.RelationshipSpec(spec, f"collection:{collname}:includes", False)
+        rel.targetPathList.explicitItems = includes
+        rel = Sdf.RelationshipSpec(spec, f"material:binding:collection:{collname}", False)
+        rel.targetPathList.explicitItems = [spec.path.AppendProperty(f"collection:{collname}"), mtlpath]
+        self.nrels += 2
+        self.bindtime += time.time() - start
+
+    def DefineSphereFlake(self, rootpath: str, layout: SphereFlakeLayout, cenpt, mtlpath: Sdf.Path,
+                          spherename: str = "SdfSphere") -> Sdf.PrimSpec:
+        # the same prim structure Generate produces for "UsdSphere", one implicit sphere per tree node
+        path = Sdf.Path(rootpath)
+        parent = self.EnsureDefined(path.GetParentPath())
+        root = self.DefinePrim(parent, path.name, "Xform")
+        self.SetXformOps(root, (0, 0, 0), rotate=(0, 0, 0))
+
+        names = layout.GetNodeNames()
+        parents = layout.parents.tolist()
+        centers = layout.GetCenters(cenpt).tolist()
+        radii = layout.radii.tolist()
+        nodes = [root]*layout.nnodes
+        for i in range(layout.nnodes):
+            if i > 0:
+                nodes[i] = self.DefinePrim(nodes[parents[i]], names[i])
+            sphere = self.DefinePrim(nodes[i], spherename, "Sphere")
+            rad = radii[i]
+            self.SetXformOps(sphere, centers[i], scale=(rad, rad, rad))
+            self.BindMaterial(sphere, mtlpath)
+        return root
+
+    def DefineInstance(self, primpath: str, cenpt, protopath: str) -> Sdf.PrimSpec:
+        # a thin Xform that pulls in the prototype through an internal reference
+        path = Sdf.Path(primpath)
+        parent = self.EnsureDefined(path.GetParentPath())
+        inst = self.DefinePrim(parent, path.name, "Xform")
+        self.SetXformOps(inst, cenpt)
+        inst.referenceList.Prepend(Sdf.Reference(primPath=Sdf.Path(protopath)))
+        inst.instanceable = True
+        return inst
+
+    def DefineReference(self, primpath: str, cenpt, assetpath: str) -> Sdf.PrimSpec:
+        # like DefineInstance, but the flake comes from the default prim of another layer
+        path = Sdf.Path(primpath)
+        parent = self.EnsureDefined(path.GetParentPath())
+        ref = self.DefinePrim(parent, path.name, "Xform")
+        self.SetXformOps(ref, cenpt)
+        ref.referenceList.Prepend(Sdf.Reference(assetpath))
+        return ref
+
+    def DefinePayloadCell(self, primpath: str, assetpath: str, cenpt, extent) -> Sdf.PrimSpec:
+        # a grid cell whose content is a payload on the same path in another layer, with the analytic extent as
+        # extentsHint so bounds are known while it is unloaded (a component model, so BBoxCache uses the hint)
+        path = Sdf.Path(primpath)
+        parent = self.EnsureDefined(path.GetParentPath())
+        cell = self.DefinePrim(parent, path.name, "Xform")
+        cell.kind = "component"
+        cell.payloadList.Prepend(Sdf.Payload(assetpath, path))
+        extmin = Gf.Vec3f(*[cenpt[i] - extent[i] for i in range(3)])
+        extmax = Gf.Vec3f(*[cenpt[i] + extent[i] for i in range(3)])
+        attr = Sdf.AttributeSpec(cell, "extentsHint", Sdf.ValueTypeNames.Float3Array, Sdf.VariabilityVarying)
+        attr.default = Vt.Vec3fArray([extmin, extmax])
+        return cell
+
+    def OverrideRelationships(self, rootpath: str, srcroot: Sdf.Path, bindings: list):
+        # relationships of a referenced flake, as overs - bindings are FlakeCache.ExtractBindings groups with
+        # paths under srcroot, which are moved to rootpath
+        start = time.time()
+        root = Sdf.Path(rootpath)
+        for group in bindings:
+            targets = [Sdf.Path(t).ReplacePrefix(srcroot, root) for t in group["targets"]]
+            for primpath in group["prims"]:
+                spec = Sdf.CreatePrimInLayer(self._layer, Sdf.Path(primpath).ReplacePrefix(srcroot, root))
+                rel = Sdf.RelationshipSpec(spec, group["rel"], False)
+                rel.targetPathList.explicitItems = targets
+                self.nrels += 1
+        self.bindtime += time.time() - start
+
+    def DefineBoundsCube(self, primpath: str, cenpt, extent, mtlpath: Sdf.Path, visible: bool) -> Sdf.PrimSpec:
+        # a cell updated in place keeps its bounds spec, that one is emptied and written again
+        path = Sdf.Path(primpath)
+        cube = self._layer.GetPrimAtPath(path)
+        if cube is None:
+            parent = self.EnsureDefined(path.GetParentPath())
+            cube = self.DefinePrim(parent, path.name, "Cube")
+        else:
+            cube.typeName = "Cube"
+            for prop in list(cube.properties):
+                cube.RemoveProperty(prop)
+            cube.ClearInfo("apiSchemas")
+        self.SetXformOps(cube, cenpt, scale=extent)
+        self.BindMaterial(cube, mtlpath)
+        self.SetVisibility(cube, visible)
+        return cube
@@ -0,0 +1,192 @@
+import os
+import sys
+import math
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+from pxr import Gf, Usd, UsdGeom
+from .headless import InstallKitlessContext, SetStage, KIT_ONLY_GENMODES
+
+# Per stage benchmark suite - times each stage of the pipeline on its own, with warmup and repetitions, for every
+# genmode and genform. Runs headless like headless.py, every repetition gets a fresh in-memory stage.
+#
+#   python -m omni.sphereflake.sfbench --depth 3 --warmup 2 --reps 10 --out stagebench.jsonl
+#
+# Stages:
+#   template - unit sphere template build (SphereMeshFactory.MakeArrays, template cache cleared)
+#   layout   - flake layout solve (GetLayout, layout cache cleared)
+#   vertbuf  - vertex buffers for all spheres of a flake (MakeVertBuf / MakeMergedVertBuf), mesh genmodes only
+#   author   - SphereFlakeFactory.Generate on an empty stage, minus the material binding time
+#   bind     - material binding time inside that Generate (the bind counters of the factories)
+#   bounds   - the bounds cube of the cell
+#   save     - export of the stage root layer to .usdc
+
+STAGES = ["template", "layout", "vertbuf", "author", "bind", "bounds", "save"]
+MESH_GENMODES = ["DirectMesh", "AsyncMesh", "MergedMesh"]
+
+
+def CalcStats(samples: list) -> dict:
+    srt = sorted(samples)
+    n = len(srt)
+    p95 = srt[min(n-1, max(0, math.ceil(0.95*n)-1))]
+    return {"median": statistics.median(srt),
+            "p95": p95,
+            "stddev": statistics.stdev(srt) if n > 1 else 0.0,
+            "mean": statistics.fmean(srt),
+            "min": srt[0],
+            "reps": n}
+
+
+def NewStage() -> Usd.Stage:
+    stage = Usd.Stage.CreateInMemory()
+    UsdGeom.SetStageUpAxis(stage, UsdGeom.Tokens.y)
+    UsdGeom.Xform.Define(stage, "/World")
+    SetStage(stage)
+    return stage
+
+
+def TimeStages(genmode: str, genform: str, depth: int, nlatlng: list, savedir: str) -> dict:
+    # one repetition of every stage, in seconds
+    from .ovut import MatMan
+    from .sflayout import GetLayout
+    from .spheremesh import SphereMeshFactory, GetSphereTemplate
+    from .sphereflake import SphereFlakeFactory
+
+    stage = NewStage()
+    matman = MatMan()
+    matman.p_content_mode = "Preview"
+    smf = SphereMeshFactory(matman)
+    sff = SphereFlakeFactory(matman, smf)
+    sff.p_genmode = genmode
+    sff.p_genform = genform
+    sff.p_depth = depth
+    (smf.p_nlat, smf.p_nlng) = nlatlng
+    asyncio.run(matman.Prewarm([sff.p_sf_matname, sff.p_bb_matname]))
+    times = {}
+
+    GetSphereTemplate.cache_clear()
+    start = time.perf_counter()
+    smf.MakeArrays()
+    times["template"] = time.perf_counter() - start
+
+    GetLayout.cache_clear()
+    start = time.perf_counter()
+    layout = GetLayout(genform, depth, sff.p_rad, sff.p_radratio)
+    times["layout"] = time.perf_counter() - start
+
+    cpt = Gf.Vec3f(0, sff.p_rad, 0)
+    if genmode in MESH_GENMODES:
+        if genmode == "MergedMesh":
+            centers = layout.GetCenters(cpt)
+            start = time.perf_counter()
+            smf.MakeMergedVertBuf(centers, layout.radii)
+        else:
+            centers = layout.GetCenters(cpt)
+            start = time.perf_counter()
+            for i in range(layout.nnodes):
+                rad = float(layout.radii[i])
+                smf.MakeVertBuf(centers[i], rad, smf.GetLevelTemplate(int(layout.depths[i]), rad))
+        times["vertbuf"] = time.perf_counter() - start
+
+    sff.GenPrep()
+    sff.ResetBindStats()
+    start = time.perf_counter()
+    sff.Generate("/World/SphereFlake", cpt)
+    asyncio.run(sff.AwaitAsyncMeshes())
+    elap = time.perf_counter() - start
+    bindtime = sff.GetBindStats()[1]
+    times["author"] = max(0.0, elap - bindtime)
+    times["bind"] = bindtime
+
+    extentvec = sff.GetSphereFlakeBoundingBox()
+    start = time.perf_counter()
+    if genmode == "SdfSphere":
+        sff.SpawnBBcubeSdf("/World/SphereFlake/bounds", cpt, extentvec, sff.p_bb_matname, False)
+    else:
+        sff.SpawnBBcube("/World/SphereFlake/bounds", cpt, extentvec, sff.p_bb_matname)
+    times["bounds"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stage.GetRootLayer().Export(os.path.join(savedir, "stagebench.usdc"))
+    times["save"] = time.perf_counter() - start
+
+    SetStage(None)
+    return times
+
+
+def RunCase(genmode: str, genform: str, depth: int, nlatlng: list, warmup: int, reps: int, savedir: str) -> dict:
+    for _ in range(warmup):
+        TimeStages(genmode, genform, depth, nlatlng, savedir)
+    samples = {}
+    for _ in range(reps):
+        for (stg, elap) in TimeStages(genmode, genform, depth, nlatlng, savedir).items():
+            samples.setdefault(stg, []).append(elap)
+    return {stg: CalcStats(samples[stg]) for stg in STAGES if stg in samples}
+
+
+def PrintTable(rows: list):
+    print(f"{'genmode':<15}{'genform':<9}{'stage':<10}{'median ms':>11}{'p95 ms':>10}{'stddev ms':>11}{'reps':>6}")
+    for (genmode, genform, stg, st) in rows:
+        print(f"{genmode:<15}{genform:<9}{stg:<10}{st['median']*1000:>11.3f}{st['p95']*1000:>10.3f}"
+              f"{st['stddev']*1000:>11.3f}{st['reps']:>6}")
+
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Per stage SphereFlake benchmarks (usd-core, no Kit)")
+    parser.add_argument("--depth", type=int, default=3)
+    parser.add_argument("--nlatlng", default="8x8", help="nlatXnlng")
+    parser.add_argument("--warmup", type=int, default=2, help="discarded repetitions per case")
+    parser.add_argument("--reps", type=int, default=10, help="timed repetitions per case")
+    parser.add_argument("--genmode", help="comma separated, default all of GetGenModes()")
+    parser.add_argument("--genform", help="comma separated, default all of GetGenForms()")
+    parser.add_argument("--out", help="JSONL file the per stage records are appended to")
+    parser.add_argument("--seriesname", default="stagebench")
+    args = parser.parse_args(argv)
+
+    InstallKitlessContext()
+    from .sphereflake import SphereFlakeFactory
+    from .runlog import GetSysInfo
+    from .telemetry import TelemetrySink
+    sink = TelemetrySink(args.out, maxbytes=0) if args.out else None
+    genmodes = args.genmode.split(",") if args.genmode else SphereFlakeFactory.GetGenModes()
+    genforms = args.genform.split(",") if args.genform else SphereFlakeFactory.GetGenForms()
+    nlatlng = [int(v) for v in args.nlatlng.split("x")]
+
+    rows = []
+    with tempfile.TemporaryDirectory() as savedir:
+        for genmode in genmodes:
+            if genmode in KIT_ONLY_GENMODES:
+                print(f"sfbench - skipping {genmode}, it needs Kit")
+                continue
+            for genform in genforms:
+                stats = RunCase(genmode, genform, args.depth, nlatlng, args.warmup, args.reps, savedir)
+                for (stg, st) in stats.items():
+                    rows.append((genmode, genform, stg, st))
+                    if args.out:
+                        rundict = {"0-seriesname": args.seriesname,
+                                   "0-runner": "sfbench",
+                                   "1-genmode": genmode,
+                                   "1-genform": genform,
+                                   "1-depth": args.depth,
+                                   "1-nlat": nlatlng[0],
+                                   "1-nlng": nlatlng[1],
+                                   "1-stage": stg,
+                                   "2-median": st["median"],
+                                   "2-p95": st["p95"],
+                                   "2-stddev": st["stddev"],
+                                   "2-mean": st["mean"],
+                                   "2-min": st["min"],
+                                   "2-reps": st["reps"],
+                                   "2-warmup": args.warmup}
+                        rundict.update(GetSysInfo())
+                        sink.Write(rundict)
+    if sink is not None:
+        sink.Close()
+    PrintTable(rows)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,21 +2,25 @@ import omni.kit.commands as okc
 import omni.usd
 import time
 import datetime
-import json
 import socket
 import psutil
-from pxr import Gf, Sdf, Usd, UsdGeom, UsdShade
+from pxr import Gf, Sdf, Usd, UsdGeom, UsdShade, UsdLux
 from .ovut import MatMan, delete_if_exists, write_out_syspath, truncf
 from .spheremesh import SphereMeshFactory
-from .sphereflake import SphereFlakeFactory
+from .sphereflake import SphereFlakeFactory, GetDefaultExportPath
+from .runlog import MakeRunRecord, GetParamsHash
+from .costmodel import CostModel, MakeCostFields, CountPrims
+from .telemetry import TelemetrySink, GetDefaultLogPath
+from .tracing import GetTracer, GetDefaultTraceDir
 import nvidia_smi
 # import multiprocessing
 import subprocess
 from omni.services.core import main
 import os
+import tempfile
 from .ovut import get_setting, save_setting
 
-# import asyncio
+import asyncio
 
 # fflake8: noqa
 
@@ -59,6 +63,17 @@ class SfControls():
     sfw = None  # We can't give this a type because it would be a circular reference
     p_writelog = True
     p_logseriesname = "None"
+    p_log_path = ""
+    p_log_max_mb = 16
+    p_log_backups = 5
+    p_trace_sample = 0
+    p_mem_budget_gb = 0.0
+    p_over_budget = "Confirm"
+    p_export_path = ""
+    _costmodel: CostModel = None
+    _pred: dict = None
+    _confirm_key: str = None
+    _telemetry: TelemetrySink = None
 
     def __init__(self, matman: MatMan, smf: SphereMeshFactory, sff: SphereFlakeFactory):
         print("SfControls __init__ (trc)")
@@ -72,6 +87,8 @@ class SfControls():
         self._matkeys = self._matman.GetMaterialNames()
         self._total_quads = 0
         self._sf_size = 50
+        self._last_sfpath = None
+        self._spheres_per_cell = 1
 
         # self._sf_matbox: ui.ComboBox = None
         self._prims = ["Sphere", "Cube", "Cone", "Torus", "Cylinder", "Plane", "Disk", "Capsule",
@@ -108,6 +125,8 @@ class SfControls():
         except Exception as e:
             print(f"Exception deregistering endpoint: {e}")
 
+        if self._telemetry is not None:
+            self._telemetry.Close()
         print("SfControls close")
 
     def SaveSettings(self):
@@ -115,11 +134,34 @@ class SfControls():
         self.query_write_log()
         save_setting("write_log", self.p_writelog)
         save_setting("log_series_name", self.p_logseriesname)
+        save_setting("log_path", self.p_log_path)
+        save_setting("log_max_mb", self.p_log_max_mb)
+        save_setting("log_backups", self.p_log_backups)
+        save_setting("trace_sample", self.p_trace_sample)
+        save_setting("mem_budget_gb", self.p_mem_budget_gb)
+        save_setting("over_budget", self.p_over_budget)
+        save_setting("export_path", self.p_export_path)
+        self._matman.SaveSettings()
 
     def LoadSettings(self):
         print("SfControls LoadSettings (trc)")
         self.p_writelog = get_setting("write_log", True)
         self.p_logseriesname = get_setting("log_series_name", "None")
+        self.p_log_path = get_setting("log_path", "")
+        self.p_log_max_mb = get_setting("log_max_mb", 16)
+        self.p_log_backups = get_setting("log_backups", 5)
+        self.p_trace_sample = get_setting("trace_sample", 0)
+        if self._telemetry is not None:
+            self._telemetry.Close()
+        logpath = self.p_log_path if self.p_log_path != "" else GetDefaultLogPath()
+        self._telemetry = TelemetrySink(logpath, maxbytes=int(self.p_log_max_mb*1024*1024),
+                                        backups=self.p_log_backups)
+        self.p_mem_budget_gb = get_setting("mem_budget_gb", 0.0)
+        self.p_over_budget = get_setting("over_budget", "Confirm")
+        self.p_export_path = get_setting("export_path", "")
+        self._costmodel = CostModel()
+        ncalib = self._costmodel.CalibrateFromLog(logpath)
+        print(f"SfControls cost model calibrated from {ncalib} records of {logpath}")
 
     def setup_environment(self, extent3f: Gf.Vec3f,  force: bool = False):
         ppathstr = "/World/Floor"
@@ -147,15 +189,28 @@ class SfControls():
                         count=1,
                         paths=[ppathstr],
                         new_scales=[self._floor_xdim, 1, self._floor_zdim])
-            baseurl = 'https://omniverse-content-production.s3.us-west-2.amazonaws.com'
-            okc.execute('CreateDynamicSkyCommand',
-                        sky_url=f'{baseurl}/Assets/Skies/2022_1/Skies/Dynamic/CumulusLight.usd',
-                        sky_path='/Environment/sky')
+            skyurl = self._matman.ResolveContent(self._matman.skybranch)
+            if skyurl is None:
+                self.create_fallback_sky('/Environment/sky')
+            else:
+                okc.execute('CreateDynamicSkyCommand', sky_url=skyurl, sky_path='/Environment/sky')
 
             # print(f"nvidia_smi.__file__:{nvidia_smi.__file__}")
             # print(f"omni.ui.__file__:{omni.ui.__file__}")
             # print(f"omni.ext.__file__:{omni.ext.__file__}")
 
+    def create_fallback_sky(self, skypath: str):
+        # offline stand-in for the dynamic sky, a dome plus a sun so the lighting stays reproducible
+        print(f"create_fallback_sky {skypath}")
+        UsdGeom.Xform.Define(self._stage, skypath)
+        dome = UsdLux.DomeLight.Define(self._stage, f"{skypath}/dome")
+        dome.CreateIntensityAttr(1000.0)
+        dome.CreateColorAttr(Gf.Vec3f(0.75, 0.85, 1.0))
+        sun = UsdLux.DistantLight.Define(self._stage, f"{skypath}/sun")
+        sun.CreateIntensityAttr(3000.0)
+        sun.CreateAngleAttr(0.53)
+        sun.AddRotateXYZOp().Set(Gf.Vec3f(-50, 30, 0))
+
     def ensure_stage(self):
         # print("ensure_stage")
         self._stage = omni.usd.get_context().get_stage()
@@ -233,8 +288,33 @@ class SfControls():
             val = self.sfw._sf_radratio_slider_model.as_float
             self.sff.p_radratio = val
 
-    def on_click_sphereflake(self):
+    def on_radratio_changed(self, model):
+        # live update of the last single flake, only when its prims can be updated in place
+        self.sff.p_radratio = model.as_float
+        if self._last_sfpath is None or self._stage is None:
+            return
+        if not self.sff.CanUpdateInPlace(self._last_sfpath, self.sff.p_sf_matname):
+            return
+        cpt = Gf.Vec3f(0, self._sf_size, 0)
+        self.sff.Generate(self._last_sfpath, cpt)
+        self.UpdateNQuads()
+
+    def update_tess(self):
+        if self.sfw._tess_levels_model is not None:
+            self.smf.p_tess_levels = self.sfw._tess_levels_model.as_string
+        if self.sfw._tess_edge_model is not None:
+            self.smf.p_tess_edge = max(0.01, self.sfw._tess_edge_model.as_float)
+
+    async def prewarm_materials(self):
+        # everything the run will bind, as currently selected on the materials tab
+        names = [self.get_curmat_name(), self.get_curaltmat_name(), self.get_curmat_bbox_name(),
+                 self.get_curfloormat_name()]
+        await self._matman.Prewarm(names)
+
+    async def on_click_sphereflake(self):
         self.ensure_stage()
+        self.begin_trace()
+        await self.prewarm_materials()
 
         start_time = time.time()
 
@@ -245,6 +325,7 @@ class SfControls():
         # print(f"slider: {type(self._sf_radratio_slider)}")
         # sff._radratio = self._sf_radratio_slider.get_value_as_float()
         self.update_radratio()
+        self.update_tess()
         sff.p_sf_matname = self.get_curmat_name()
         sff.p_sf_alt_matname = self.get_curaltmat_name()
         sff.p_bb_matname = self.get_curmat_bbox_name()
@@ -253,21 +334,27 @@ class SfControls():
         primpath = f"/World/SphereFlake_{self._count}"
 
         self._count += 1
+        sff.ResetBindStats()
+        sff.ResetPhaseTimes()
         sff.Generate(primpath, cpt)
+        await sff.AwaitAsyncMeshes()
+        self._last_sfpath = primpath
 
         elap = time.time() - start_time
         self.sfw._statuslabel.text = f"SphereFlake took elapsed: {elap:.2f} s"
+        self.sfw._statuslabel.text += f"\nMaterial prewarm: {self._matman.prewarmTime:.2f} s"
+        self.end_trace()
         self.UpdateStuff()
 
-    async def generate_sflakes(self):
-
+    def apply_sf_params(self):
+        # the factory parameters that live in the window widgets
         sff = self.sff
-
         sff._matman = self._matman
         sff.p_genmode = self.get_sf_genmode()
         sff.p_genform = self.get_sf_genform()
         sff.p_rad = self._sf_size
         self.update_radratio()
+        self.update_tess()
 
         sff.p_sf_matname = self.get_curmat_name()
         sff.p_sf_alt_matname = self.get_curaltmat_name()
@@ -275,59 +362,139 @@ class SfControls():
         sff.p_make_bounds_visible = self._bounds_visible
         sff.p_bb_matname = self.get_curmat_bbox_name()
 
+    async def generate_sflakes(self):
+
+        sff = self.sff
+
+        self.apply_sf_params()
+        sff.ResetBindStats()
+        sff.ResetPhaseTimes()
         if sff.p_parallelRender:
             await sff.GenerateManyParallel()
             new_count = sff.p_nsfx*sff.p_nsfy*sff.p_nsfz
+        elif sff.p_frame_budget_ms > 0:
+            self._spheres_per_cell = sff.CalcSpheres()
+            new_count = await sff.GenerateManyBudgeted(self.on_generate_progress)
+            await sff.AwaitAsyncMeshes()
         else:
             new_count = sff.GenerateMany()
+            await sff.AwaitAsyncMeshes()
 
         self._count += new_count
         sff.SaveSettings()
+        self.smf.SaveSettings()
+
+    def on_generate_progress(self, ndone: int, ncells: int, activeelap: float):
+        # called by the time-sliced generator after every slice, activeelap leaves out the frames we yielded
+        frac = ndone / ncells if ncells > 0 else 1.0
+        sps = ndone * self._spheres_per_cell / activeelap if activeelap > 0 else 0
+        eta = activeelap * (ncells - ndone) / ndone if ndone > 0 else 0
+        if self.sfw._gen_progress_model is not None:
+            self.sfw._gen_progress_model.set_value(frac)
+        msg = f"{ndone}/{ncells} cells - {sps:.0f} spheres/s - ETA {eta:.1f} s"
+        self.sfw._statuslabel.text = msg
+
+    async def on_click_export(self):
+        # the grid goes straight to a .usdc in chunks, the stage only gets the materials it binds to
+        self.ensure_stage()
+        self.apply_sf_params()
+        if not self.sff.CanExport():
+            self.sfw._statuslabel.text = (f"Export - {self.sff.p_genmode} with {self.sff.p_bind_mode} binding "
+                                          "cannot be exported, use UsdSphere or SdfSphere")
+            return
+        await self.prewarm_materials()
+        filepath = self.p_export_path if self.p_export_path != "" else GetDefaultExportPath()
+        res = await self.sff.ExportMany(filepath, self.on_export_progress)
+        self.sfw._statuslabel.text = (f"Exported {res['cells']} flakes, {res['prims']} prims in {res['chunks']} "
+                                      f"chunks ({res['bytes']/1e6:.1f} MB) in {res['elapsed']:.2f} s\n"
+                                      f"{res['filepath']}")
+
+    def on_export_progress(self, ndone: int, nchunks: int, elap: float):
+        frac = ndone / nchunks if nchunks > 0 else 1.0
+        if self.sfw._gen_progress_model is not None:
+            self.sfw._gen_progress_model.set_value(frac)
+        self.sfw._statuslabel.text = f"Exporting {ndone}/{nchunks} chunks - {elap:.1f} s"
+
+    def on_click_cancel_generate(self):
+        self.sff.CancelGenerate()
+
+    def on_click_frame_budget(self):
+        budgets = self.sff.GetFrameBudgets()
+        cur = self.sff.p_frame_budget_ms
+        idx = (budgets.index(cur) + 1) % len(budgets) if cur in budgets else 0
+        self.sff.p_frame_budget_ms = budgets[idx]
+        self.sfw._frame_budget_but.text = f"Frame budget: {self.sff.p_frame_budget_ms:.0f} ms"
 
     def write_log(self, elap: float = 0.0):
         self.query_write_log()
         if self.p_writelog:
-            nflakes = self.sff.p_nsfx * self.sff.p_nsfz
-            ntris, nprims = self.sff.CalcTrisAndPrims()
-            gpuinfo = self._gpuinfo
-            om = float(1024*1024*1024)
-            hostname = socket.gethostname()
-            memused = psutil.virtual_memory().used
-            memtot = psutil.virtual_memory().total
-            memfree = psutil.virtual_memory().free
-            cores = psutil.cpu_count()
-            # msg = f"GPU Mem tot:  {gpuinfo.total/om:.2f}: used: {gpuinfo.used/om:.2f} free: {gpuinfo.free/om:.2f} GB"
-            # msg += f"\nCPU cores: {cores}"
-            # msg += f"\nSys Mem tot: {memtot/om:.2f}: used: {memused/om:.2f} free: {memfree/om:.2f} GB"
+            rundict = MakeRunRecord(self.sff, self.smf, self._matman, elap, self.p_logseriesname, self._gpuinfo)
+            if self._pred is not None:
+                nprims = CountPrims(self._stage, self.sff._createlist)
+                rundict.update(MakeCostFields(self._pred, nprims))
+                self._costmodel.AddRecord(rundict)
+            self.WriteRunLog(rundict)
+        self._pred = None
+
+    def write_teardown_log(self, nroots: int, elap: float):
+        # teardown is its own phase in the log, so it does not hide inside the generation times
+        self.query_write_log()
+        if self.p_writelog:
             rundict = {"0-seriesname": self.p_logseriesname,
-                       "0-hostname": hostname,
+                       "0-hostname": socket.gethostname(),
                        "0-date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                       "1-phase": "teardown",
                        "1-genmode": self.sff.p_genmode,
-                       "1-genform": self.sff.p_genform,
-                       "1-depth": self.sff.p_depth,
-                       "1-rad": self.sff.p_rad,
-                       "1-radratio": self.sff.p_radratio,
-                       "1-nsfx": self.sff.p_nsfx,
-                       "1-nsfy": self.sff.p_nsfy,
-                       "1-nsfz": self.sff.p_nsfz,
-                       "2-tris": ntris,
-                       "2-prims": nprims,
-                       "2-nflakes": nflakes,
+                       "1-deferred": self.sff.p_deferred_removal,
+                       "2-nroots": nroots,
                        "2-elapsed": truncf(elap, 3),
-                       "3-gpu_gbmem_tot": truncf(gpuinfo.total/om, 3),
-                       "3-gpu_gbmem_used": truncf(gpuinfo.used/om, 3),
-                       "3-gpu_gbmem_free": truncf(gpuinfo.free/om, 3),
-                       "4-sys_gbmem_tot": truncf(memtot/om, 3),
-                       "4-sys_gbmem_used": truncf(memused/om, 3),
-                       "4-sys_gbmem_free": truncf(memfree/om, 3),
-                       "5-cpu_cores": cores,
                        }
             self.WriteRunLog(rundict)
 
+    def get_cost_label(self, pred: dict) -> str:
+        return f"~{pred['secs']:.1f} s ~{pred['mem']/1e9:.2f} GB"
+
+    def preflight(self) -> bool:
+        # predicted cost of the multi-flake run against the memory budget, Confirm runs it on the next click
+        if self.sfw.mem_budget_model is not None:
+            self.p_mem_budget_gb = max(0.0, self.sfw.mem_budget_model.as_float)
+        pred = self._costmodel.Predict(self.sff, self.smf)
+        self._pred = pred
+        if self.p_over_budget == "Allow" or not self._costmodel.IsOverBudget(pred, self.p_mem_budget_gb):
+            self._confirm_key = None
+            return True
+        key = GetParamsHash(self.sff, self.smf, self._matman)
+        if self.p_over_budget == "Confirm" and self._confirm_key == key:
+            self._confirm_key = None
+            return True
+        peakgb = pred["peak_rss"]/1e9
+        budgetgb = self._costmodel.GetBudget(self.p_mem_budget_gb)/1e9
+        msg = f"Predicted peak {peakgb:.2f} GB over the {budgetgb:.2f} GB budget ({self.get_cost_label(pred)})"
+        if self.p_over_budget == "Confirm":
+            self._confirm_key = key
+            msg += "\nclick Multi ShereFlake again to run it anyway"
+        else:
+            msg += "\nrefused, lower the depth or the grid"
+        print(f"preflight - {msg}")
+        self.sfw._statuslabel.text = msg
+        self._pred = None
+        return False
+
+    def on_click_over_budget(self):
+        policies = ["Confirm", "Refuse", "Allow"]
+        idx = (policies.index(self.p_over_budget) + 1) % len(policies) if self.p_over_budget in policies else 0
+        self.p_over_budget = policies[idx]
+        self.sfw._over_budget_but.text = f"Over budget: {self.p_over_budget}"
+
     async def on_click_multi_sphereflake(self):
         self.ensure_stage()
+        self.apply_sf_params()
+        if not self.preflight():
+            return
         # extent3f = self.sff.GetSphereFlakeBoundingBox()
         extent3f = self.sff.GetSphereFlakeBoundingBoxNxNyNz()
+        self.begin_trace()
+        await self.prewarm_materials()
         self.setup_environment(extent3f, force=True)
 
         start_time = time.time()
@@ -337,6 +504,16 @@ class SfControls():
         nflakes = self.sff.p_nsfx * self.sff.p_nsfz
 
         self.sfw._statuslabel.text = f"{nflakes} flakes took elapsed: {elap:.2f} s"
+        if self.sff._nslices > 1:
+            # wall time includes the frames handed back to Kit between slices
+            yld = self.sff._yield_time
+            pct = 100 * yld / elap if elap > 0 else 0
+            self.sfw._statuslabel.text += f"\n{self.sff._nslices} slices, yielded {yld:.2f} s ({pct:.0f}%)"
+            if self.sff._cancelled:
+                self.sfw._statuslabel.text += " - cancelled"
+        self.sfw._statuslabel.text += f"\nMaterial prewarm: {self._matman.prewarmTime:.2f} s"
+        self.sfw._statuslabel.text += f"\nPredicted: {self.get_cost_label(self._pred)}"
+        self.end_trace()
 
         self.UpdateStuff()
         self.write_log(elap)
@@ -403,6 +580,176 @@ class SfControls():
         self.smf.p_nlng = nlng
         self.UpdateStuff()
 
+    def on_click_merge_chunk(self, x, y, button, modifier):
+        tmp = self.round_increment(self.sff.p_merge_chunk, button == 1, 64, 1)
+        self.sfw._merge_chunk_but.text = f"Merge chunk: {tmp}"
+        self.sff.p_merge_chunk = tmp
+        self.UpdateStuff()
+
+    def on_click_instancer_proto(self):
+        protos = self.sff.GetInstancerProtos()
+        idx = (protos.index(self.sff.p_instancer_proto) + 1) % len(protos)
+        self.sff.p_instancer_proto = protos[idx]
+        self.sfw._instancer_proto_but.text = f"Instancer proto: {self.sff.p_instancer_proto}"
+
+    def on_click_precision(self):
+        precs = self.smf.GetPrecisions()
+        idx = (precs.index(self.smf.p_precision) + 1) % len(precs)
+        self.smf.p_precision = precs[idx]
+        self.sfw._precision_but.text = f"Precision: {self.smf.p_precision}"
+
+    def on_click_async_workers(self, x, y, button, modifier):
+        tmp = self.round_increment(self.smf.p_async_workers, button == 1, 32, 1)
+        self.sfw._async_workers_but.text = f"Async workers: {tmp}"
+        self.smf.p_async_workers = tmp
+
+    def on_click_content_mode(self):
+        modes = self._matman.GetContentModes()
+        idx = (modes.index(self._matman.p_content_mode) + 1) % len(modes)
+        self._matman.p_content_mode = modes[idx]
+        self.sfw._content_mode_but.text = f"Content: {self._matman.p_content_mode}"
+
+    async def on_click_prefetch_content(self):
+        # downloads block, so they go to a thread and the UI keeps running
+        self.sfw._prefetch_but.text = "Prefetching..."
+        keys = self._matman.GetRemoteKeys()
+        loop = asyncio.get_event_loop()
+        nok = await loop.run_in_executor(None, self._matman.PrefetchContent)
+        self.sfw._prefetch_but.text = f"Prefetch Content ({nok}/{len(keys)} cached)"
+
+    def get_trace_label(self) -> str:
+        if self.p_trace_sample == 0:
+            return "Tracing: Off"
+        return f"Tracing: every {self.p_trace_sample}" if self.p_trace_sample > 1 else "Tracing: every call"
+
+    def on_click_trace(self):
+        # 0 is off, otherwise every nth call of a span is kept in the trace, the totals always count all of them
+        samples = [0, 1, 10, 100]
+        idx = (samples.index(self.p_trace_sample) + 1) % len(samples) if self.p_trace_sample in samples else 0
+        self.p_trace_sample = samples[idx]
+        self.sfw._trace_but.text = self.get_trace_label()
+
+    def begin_trace(self):
+        tracer = GetTracer()
+        tracer.Reset()
+        tracer.Enable(self.p_trace_sample > 0, self.p_trace_sample)
+
+    def end_trace(self):
+        tracer = GetTracer()
+        if not tracer.enabled:
+            return
+        tracer.Enable(False)
+        stamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
+        tracepath = os.path.join(GetDefaultTraceDir(), f"trace_{stamp}.json")
+        nevents = tracer.WriteChromeTrace(tracepath)
+        print(tracer.FormatTable())
+        print(f"wrote {nevents} trace events to {tracepath}")
+        self.sfw._statuslabel.text += f"\nTrace: {tracepath}"
+
+    def on_click_bind_mode(self):
+        modes = self.sff.GetBindModes()
+        idx = (modes.index(self.sff.p_bind_mode) + 1) % len(modes)
+        self.sff.p_bind_mode = modes[idx]
+        self.sfw._bind_mode_but.text = f"Binding: {self.sff.p_bind_mode}"
+
+    def on_click_tess_mode(self):
+        modes = self.smf.GetTessModes()
+        idx = (modes.index(self.smf.p_tess_mode) + 1) % len(modes)
+        self.smf.p_tess_mode = modes[idx]
+        self.sfw._tess_mode_but.text = f"Tessellation: {self.smf.p_tess_mode}"
+        self.UpdateStuff()
+
+    def run_precision_membench(self, depth: int = 4, nsf: int = 5, genmode: str = "DirectMesh"):
+        # generates the same grid once per precision mode and compares the .usdc size and the RSS growth
+        self.ensure_stage()
+        sff = self.sff
+        smf = self.smf
+        saved = (sff.p_genmode, sff.p_depth, sff.p_nsfx, sff.p_nsfy, sff.p_nsfz, sff.p_partialRender, smf.p_precision)
+        sff.p_genmode = genmode
+        sff.p_depth = depth
+        sff.p_nsfx = nsf
+        sff.p_nsfy = 1
+        sff.p_nsfz = nsf
+        sff.p_partialRender = False
+        proc = psutil.Process()
+        om = float(1024*1024)
+        results = []
+        for prec in smf.GetPrecisions():
+            self.on_click_clearprims()
+            smf.p_precision = prec
+            rss0 = proc.memory_info().rss
+            start_time = time.time()
+            sff.GenerateMany()
+            elap = time.time() - start_time
+            rss1 = proc.memory_info().rss
+            with tempfile.TemporaryDirectory() as tmpdir:
+                fname = os.path.join(tmpdir, "membench.usdc")
+                self._stage.GetRootLayer().Export(fname)
+                laysize = os.path.getsize(fname)
+            res = {"0-seriesname": "membench",
+                   "1-genmode": genmode,
+                   "1-depth": depth,
+                   "1-nsfx": nsf,
+                   "1-nsfz": nsf,
+                   "1-precision": prec,
+                   "2-elapsed": truncf(elap, 3),
+                   "6-layer_mb": truncf(laysize/om, 3),
+                   "6-rss_delta_mb": truncf((rss1-rss0)/om, 3),
+                   }
+            print(f"membench {prec}: layer:{laysize/om:.1f} MB rss delta:{(rss1-rss0)/om:.1f} MB in {elap:.2f} s")
+            results.append(res)
+            if self.p_writelog:
+                self.WriteRunLog(res)
+        self.on_click_clearprims()
+        (sff.p_genmode, sff.p_depth, sff.p_nsfx, sff.p_nsfy, sff.p_nsfz, sff.p_partialRender, smf.p_precision) = saved
+        msg = " ".join(f"{r['1-precision']}:{r['6-layer_mb']:.1f}MB" for r in results)
+        self.sfw._statuslabel.text = f"Layer size {msg}"
+        return results
+
+    def toggle_instanceable(self):
+        self.sff.p_instanceable = not self.sff.p_instanceable
+        self.sfw._instanceable_but.text = f"Instanceable: {self.sff.p_instanceable}"
+
+    def toggle_flake_cache(self):
+        self.sff.p_flake_cache = not self.sff.p_flake_cache
+        self.sfw._flake_cache_but.text = f"Flake cache: {self.sff.p_flake_cache}"
+
+    def toggle_payload_cells(self):
+        self.sff.p_payload_cells = not self.sff.p_payload_cells
+        self.sfw._payload_cells_but.text = f"Payload cells: {self.sff.p_payload_cells}"
+
+    def on_click_load_partial_cells(self):
+        # the payload cells of the partial render box, everything else gets unloaded
+        sff = self.sff
+        start = time.time()
+        nload = sff.LoadCells(sff.p_partial_ssfx, sff.p_partial_ssfy, sff.p_partial_ssfz,
+                              sff.p_partial_nsfx, sff.p_partial_nsfy, sff.p_partial_nsfz, unloadrest=True)
+        self.sfw._statuslabel.text = f"Loaded {nload} payload cells in {time.time()-start:.2f} s"
+
+    def on_click_load_all_cells(self):
+        sff = self.sff
+        start = time.time()
+        nload = sff.LoadCells(0, 0, 0, sff.p_nsfx, sff.p_nsfy, sff.p_nsfz)
+        self.sfw._statuslabel.text = f"Loaded {nload} payload cells in {time.time()-start:.2f} s"
+
+    def on_click_unload_cells(self):
+        start = time.time()
+        self.sff.UnloadCells()
+        self.sfw._statuslabel.text = f"Unloaded all cells in {time.time()-start:.2f} s"
+
+    def toggle_deferred_removal(self):
+        self.sff.p_deferred_removal = not self.sff.p_deferred_removal
+        self.sfw._deferred_removal_but.text = f"Deferred clear: {self.sff.p_deferred_removal}"
+
+    def toggle_incremental(self):
+        self.sff.p_incremental = not self.sff.p_incremental
+        self.sfw._incremental_but.text = f"Incremental: {self.sff.p_incremental}"
+
+    def toggle_instancer_grid(self):
+        self.sff.p_instancer_grid = not self.sff.p_instancer_grid
+        self.sfw._instancer_grid_but.text = f"Instancer per grid: {self.sff.p_instancer_grid}"
+        self.UpdateStuff()
+
     def on_click_sfx(self, x, y, button, modifier):
         nsfx = self.round_increment(self.sff.p_nsfx, button == 1, 20, 1)
         self.sfw._nsf_x_but.text = f"SF - x:{nsfx}"
@@ -432,6 +779,12 @@ class SfControls():
         self.sff.p_parallel_nzbatch = tmp
         self.UpdateStuff()
 
+    def on_click_parallel_workers(self, x, y, button, modifier):
+        # 0 means one worker process per core
+        tmp = self.round_increment(self.sff.p_parallel_workers, button == 1, os.cpu_count() or 1, 0)
+        self.sfw._parallel_workers_but.text = f"Worker processes: {tmp}"
+        self.sff.p_parallel_workers = tmp
+
     def toggle_partial_render(self):
         self.sff.p_partialRender = not self.sff.p_partialRender
         self.sfw._partial_render_but.text = f"Partial Render: {self.sff.p_partialRender}"
@@ -504,20 +857,26 @@ class SfControls():
 
     def on_click_clearprims(self):
         self.ensure_stage()
+        start_time = time.time()
         # check and see what we have missed
         worldprim = self._stage.GetPrimAtPath("/World")
+        paths = []
         for child_prim in worldprim.GetAllChildren():
             cname = child_prim.GetName()
             prefix = cname.split("_")[0]
             dodelete = prefix in ["SphereFlake", "SphereMesh", "Prim"]
             if dodelete:
-                # print(f"deleting {cname}")
-                cpath = child_prim.GetPrimPath()
-                self._stage.RemovePrim(cpath)
-                # okc.execute("DeletePrimsCommand", paths=[cpath])
+                paths.append(child_prim.GetPrimPath())
+        # one bulk removal instead of a RemovePrim (and a recompose) per root
+        nroots = self.sff.RemoveRoots(paths)
+        elap = time.time() - start_time
+        self.sfw._statuslabel.text = f"Cleared {nroots} roots in {elap:.2f} s"
+        self.write_teardown_log(nroots, elap)
         self.smf.Clear()
         self.sff.Clear()
         self._count = 0
+        self._last_sfpath = None
+        self._spheres_per_cell = 1
 
     def on_click_changeprim(self):
         idx = self._prims.index(self._curprim) + 1
@@ -533,10 +892,11 @@ class SfControls():
             self.sfw._sf_spawn_but.text = f"Spawn ShereFlake\n tris:{ntris:,} prims:{nprims:,}\ngen: {elap:.2f} s"
 
     def UpdateMQuads(self):
-        ntris, nprims = self.sff.CalcTrisAndPrims()
-        tottris = ntris*self.sff.p_nsfx*self.sff.p_nsfz
+        tottris, totprims = self.sff.CalcGridTrisAndPrims()
         if self.sfw._msf_spawn_but is not None:
-            self.sfw._msf_spawn_but.text = f"Multi ShereFlake\ntris:{tottris:,} prims:{nprims:,}"
+            pred = self._costmodel.Predict(self.sff, self.smf)
+            msg = f"Multi ShereFlake\ntris:{tottris:,} prims:{totprims:,}\n{self.get_cost_label(pred)}"
+            self.sfw._msf_spawn_but.text = msg
 
     def UpdateGpuMemory(self):
         nvidia_smi.nvmlInit()
@@ -558,6 +918,9 @@ class SfControls():
         ftccnt = self._matman.fetchCount
         skpcnt = self._matman.skipCount
         msg += f"\n Materials ref: {refcnt} fetched: {ftccnt} skipped: {skpcnt}"
+        cache = self._matman.GetContentCache()
+        msg += f"\n Content {self._matman.p_content_mode} hits: {cache.hitCount} fills: {cache.fillCount}"
+        msg += f" fallbacks: {self._matman.fallbackCount}"
 
         self.sfw._memlabel.text = msg
 
@@ -614,10 +977,7 @@ class SfControls():
         if rundict is None:
             rundict = {}
 
-        jline = json.dumps(rundict, sort_keys=True)
-
-        fname = "d:/nv/ov/log.txt"
-        with open(fname, "a") as f:
-            f.write(f"{jline}\n")
+        # queued, the sink writes and rotates the file on its own thread
+        self._telemetry.Write(rundict)
 
-        print("wrote log")
+        print(f"queued log record for {self._telemetry.path}")
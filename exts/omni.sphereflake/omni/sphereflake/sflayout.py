@@ -0,0 +1,138 @@
+import math
+import functools
+import numpy as np
+from typing import List, Tuple
+
+
+class SphereFlakeLayout():
+    # Computes the whole sphereflake tree as flat numpy arrays, one depth level at a time.
+    # Nodes are stored breadth first: node 0 is the root, every level follows the previous one
+    # and the children of a node are contiguous, so parents[i] < i always holds.
+    # The layout is relative to a root at the origin - use GetCenters to place it.
+
+    def __init__(self, genform: str, depth: int, rad: float, radratio: float) -> None:
+        self.genform = genform
+        self.depth = depth
+        self.rad = rad
+        self.radratio = radratio
+        self.rings = SphereFlakeLayout.GetRings(genform)
+        self.nchild = sum(nring for (_, nring, _, _) in self.rings)
+        self.Solve()
+
+    @staticmethod
+    def GetRings(genform: str) -> List[Tuple[str, int, float, float]]:
+        # (ringname, nring, thoff, phioff) - must stay in step with SphereFlakeFactory.GenRecursively
+        if genform == "Classic":
+            return [("r1", 6, 0, -20*math.pi/180),
+                    ("r2", 3, 30*math.pi/180, 55*math.pi/180)]
+        else:
+            return [("r1", 8, 0, 0)]
+
+    @staticmethod
+    def CalcNodeCount(genform: str, depth: int) -> int:
+        nchild = sum(nring for (_, nring, _, _) in SphereFlakeLayout.GetRings(genform))
+        return sum(nchild**i for i in range(depth+1))
+
+    def MakeTemplate(self):
+        # unit offsets of all the children of one node in its local (lxax, lyax, lzax) frame
+        tmpl = np.zeros((self.nchild, 3), dtype=np.float64)
+        ringidx = np.zeros(self.nchild, dtype=np.int8)
+        slotidx = np.zeros(self.nchild, dtype=np.int16)
+        k = 0
+        for ir, (_, nring, thoff, phioff) in enumerate(self.rings):
+            theta = thoff + np.arange(nring)*2*math.pi/nring
+            cphi = math.cos(phioff)
+            tmpl[k:k+nring, 0] = cphi*np.sin(theta)
+            tmpl[k:k+nring, 1] = math.sin(phioff)
+            tmpl[k:k+nring, 2] = cphi*np.cos(theta)
+            ringidx[k:k+nring] = ir
+            slotidx[k:k+nring] = np.arange(nring)
+            k += nring
+        return tmpl, ringidx, slotidx
+
+    def MakeFrames(self, offvek: np.ndarray) -> np.ndarray:
+        # batched version of the axis construction in SphereFlakeFactory.GenRing
+        # returns (m, 3, 3) with rows lxax, lyax, lzax
+        yax = np.array([0, 1, 0], dtype=np.float64)
+        zax = np.array([0, 0, 1], dtype=np.float64)
+        lxax = np.cross(offvek, yax)
+        lxlen = np.linalg.norm(lxax, axis=1)
+        degen = lxlen <= 1e-12*np.linalg.norm(offvek, axis=1)
+        if np.any(degen):
+            lxax[degen] = np.cross(offvek[degen], zax)
+            lxlen[degen] = np.linalg.norm(lxax[degen], axis=1)
+        lxax /= lxlen[:, None]
+        lzax = np.cross(offvek, lxax)
+        lzax /= np.linalg.norm(lzax, axis=1)[:, None]
+        lyax = offvek / np.linalg.norm(offvek, axis=1)[:, None]
+        return np.stack((lxax, lyax, lzax), axis=1)
+
+    def Solve(self):
+        nnodes = SphereFlakeLayout.CalcNodeCount(self.genform, self.depth)
+        centers = np.zeros((nnodes, 3), dtype=np.float64)
+        radii = np.zeros(nnodes, dtype=np.float64)
+        depths = np.zeros(nnodes, dtype=np.int32)
+        parents = np.full(nnodes, -1, dtype=np.int32)
+        rings = np.full(nnodes, -1, dtype=np.int8)
+        slots = np.full(nnodes, -1, dtype=np.int16)
+        levelstart = [0, 1]
+
+        radii[0] = self.rad
+        tmpl, ringidx, slotidx = self.MakeTemplate()
+        offfak = 1 + self.radratio
+        for d in range(1, self.depth+1):
+            ps = levelstart[d-1]
+            pe = levelstart[d]
+            npar = pe - ps
+            cs = pe
+            ce = cs + npar*self.nchild
+            pidx = np.arange(ps, pe, dtype=np.int32)
+            if d == 1:
+                # the root has no incoming offset vector so it uses the world axes
+                frames = np.eye(3, dtype=np.float64)[None, :, :]
+            else:
+                frames = self.MakeFrames(centers[ps:pe] - centers[parents[ps:pe]])
+            # (npar, nchild, 3) child offsets for every parent at once
+            npt = np.einsum("kj,mjc->mkc", tmpl, frames) * radii[ps:pe, None, None]
+            centers[cs:ce] = (centers[ps:pe, None, :] + offfak*npt).reshape(-1, 3)
+            radii[cs:ce] = np.repeat(radii[ps:pe]*self.radratio, self.nchild)
+            depths[cs:ce] = d
+            parents[cs:ce] = np.repeat(pidx, self.nchild)
+            rings[cs:ce] = np.tile(ringidx, npar)
+            slots[cs:ce] = np.tile(slotidx, npar)
+            levelstart.append(ce)
+
+        self.nnodes = nnodes
+        self.centers = centers
+        self.radii = radii
+        self.depths = depths
+        self.parents = parents
+        self.ringidx = rings
+        self.slotidx = slots
+        self.levelstart = levelstart
+        for arr in (centers, radii, depths, parents, rings, slots):
+            arr.flags.writeable = False
+
+    def GetCenters(self, cenpt=(0, 0, 0), dtype=np.float64) -> np.ndarray:
+        return (self.centers + np.asarray(cenpt, dtype=np.float64)).astype(dtype, copy=False)
+
+    def GetNodeNames(self) -> List[str]:
+        # the node name relative to its parent, the same naming GenRing uses
+        names = [""]*self.nnodes
+        for i in range(1, self.nnodes):
+            names[i] = f"{self.rings[self.ringidx[i]][0]}_sf_{self.slotidx[i]}"
+        return names
+
+    def GetNodePaths(self, rootpath: str) -> List[str]:
+        paths = [rootpath]*self.nnodes
+        names = self.GetNodeNames()
+        parents = self.parents
+        for i in range(1, self.nnodes):
+            paths[i] = f"{paths[parents[i]]}/{names[i]}"
+        return paths
+
+
+@functools.lru_cache(maxsize=32)
+def GetLayout(genform: str, depth: int, rad: float, radratio: float) -> SphereFlakeLayout:
+    # layouts are immutable and translation invariant, so one per parameter set is enough
+    return SphereFlakeLayout(genform, int(depth), float(rad), float(radratio))
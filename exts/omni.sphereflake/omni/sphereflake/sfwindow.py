@@ -34,6 +34,20 @@ class SfcWindow(ui.Window):
     _sf_spawn_but: ui.Button = None
     _sf_nlat_but: ui.Button = None
     _sf_nlng_but: ui.Button = None
+    _merge_chunk_but: ui.Button = None
+    _instancer_proto_but: ui.Button = None
+    _instancer_grid_but: ui.Button = None
+    _instanceable_but: ui.Button = None
+    _incremental_but: ui.Button = None
+    _deferred_removal_but: ui.Button = None
+    _flake_cache_but: ui.Button = None
+    _payload_cells_but: ui.Button = None
+    _precision_but: ui.Button = None
+    _tess_mode_but: ui.Button = None
+    _bind_mode_but: ui.Button = None
+    _async_workers_but: ui.Button = None
+    _tess_levels_model: ui.SimpleStringModel = None
+    _tess_edge_model: ui.SimpleFloatModel = None
     _sf_radratio_slider_model: ui.SimpleFloatModel = None
 
     _genmodebox: ui.ComboBox = None
@@ -60,6 +74,16 @@ class SfcWindow(ui.Window):
     writelog_checkbox_model = None
     writelog_seriesname: ui.StringField = None
     writelog_seriesname_model = None
+    mem_budget_field: ui.FloatField = None
+    mem_budget_model = None
+    _over_budget_but: ui.Button = None
+    _content_mode_but: ui.Button = None
+    _frame_budget_but: ui.Button = None
+    _cancel_gen_but: ui.Button = None
+    _gen_progress: ui.ProgressBar = None
+    _gen_progress_model: ui.SimpleFloatModel = None
+    _prefetch_but: ui.Button = None
+    _trace_but: ui.Button = None
 
     # state
     sfc: SfControls
@@ -87,6 +111,9 @@ class SfcWindow(ui.Window):
 
         # sphereflake params
         self._sf_radratio_slider_model = ui.SimpleFloatModel(sff.p_radratio)
+        self._sf_radratio_slider_model.add_value_changed_fn(sfc.on_radratio_changed)
+        self._tess_levels_model = ui.SimpleStringModel(self.smf.p_tess_levels)
+        self._tess_edge_model = ui.SimpleFloatModel(self.smf.p_tess_edge)
         idx = sff.GetGenModes().index(sff.p_genmode)
         self._genmodebox_model = ui.SimpleIntModel(idx)
         idx = sff.GetGenForms().index(sff.p_genform)
@@ -106,6 +133,7 @@ class SfcWindow(ui.Window):
         # options
         self.writelog_checkbox_model = ui.SimpleBoolModel(sfc.p_writelog)
         self.writelog_seriesname_model = ui.SimpleStringModel(sfc.p_logseriesname)
+        self.mem_budget_model = ui.SimpleFloatModel(sfc.p_mem_budget_gb)
 
     def BuildWindow(self):
         print("SfcWindow.BuildWindow  (trc)")
@@ -185,6 +213,30 @@ class SfcTabMulti(BaseTab):
                     sfw._tog_bounds_but = ui.Button(f"Bounds:{sfc._bounds_visible}",
                                                     style={'background_color': sfw.darkcyan},
                                                     clicked_fn=sfc.toggle_bounds)
+                    sfw._instanceable_but = ui.Button(f"Instanceable: {sff.p_instanceable}",
+                                                      style={'background_color': sfw.darkcyan},
+                                                      clicked_fn=sfc.toggle_instanceable)
+                    sfw._incremental_but = ui.Button(f"Incremental: {sff.p_incremental}",
+                                                     style={'background_color': sfw.darkcyan},
+                                                     clicked_fn=sfc.toggle_incremental)
+                    sfw._deferred_removal_but = ui.Button(f"Deferred clear: {sff.p_deferred_removal}",
+                                                          style={'background_color': sfw.darkcyan},
+                                                          clicked_fn=sfc.toggle_deferred_removal)
+                with ui.HStack(height=20):
+                    sfw._frame_budget_but = ui.Button(f"Frame budget: {sff.p_frame_budget_ms:.0f} ms",
+                                                      style={'background_color': sfw.darkcyan},
+                                                      clicked_fn=sfc.on_click_frame_budget)
+                    sfw._flake_cache_but = ui.Button(f"Flake cache: {sff.p_flake_cache}",
+                                                     style={'background_color': sfw.darkcyan},
+                                                     clicked_fn=sfc.toggle_flake_cache)
+                    sfw._payload_cells_but = ui.Button(f"Payload cells: {sff.p_payload_cells}",
+                                                       style={'background_color': sfw.darkcyan},
+                                                       clicked_fn=sfc.toggle_payload_cells)
+                    sfw._gen_progress_model = ui.SimpleFloatModel(0.0)
+                    sfw._gen_progress = ui.ProgressBar(model=sfw._gen_progress_model)
+                    sfw._cancel_gen_but = ui.Button("Cancel", width=80,
+                                                    style={'background_color': sfw.darkred},
+                                                    clicked_fn=sfc.on_click_cancel_generate)
                 sfw.prframe = ui.CollapsableFrame("Partial Renders", collapsed=sfw.docollapse_prframe)
                 with sfw.prframe:
                     with ui.VStack():
@@ -217,6 +269,16 @@ class SfcTabMulti(BaseTab):
                             sfw._part_nsf_nz_but = ui.Button(f"SF partial nz: {sff.p_partial_nsfz}",
                                                              style={'background_color': sfw.darkblue},
                                                              mouse_pressed_fn=clkfn)
+                        with ui.HStack():
+                            ui.Button("Load partial only",
+                                      style={'background_color': sfw.darkcyan},
+                                      clicked_fn=sfc.on_click_load_partial_cells)
+                            ui.Button("Load all cells",
+                                      style={'background_color': sfw.darkcyan},
+                                      clicked_fn=sfc.on_click_load_all_cells)
+                            ui.Button("Unload all cells",
+                                      style={'background_color': sfw.darkcyan},
+                                      clicked_fn=sfc.on_click_unload_cells)
                 sfw.drframe = ui.CollapsableFrame("Distributed Renders", collapsed=sfw.docollapse_drframe)
                 with sfw.drframe:
                     with ui.VStack():
@@ -236,6 +298,10 @@ class SfcTabMulti(BaseTab):
                             sfw._parallel_nzbatch_but = ui.Button(f"SF batch z: {sff.p_parallel_nzbatch}",
                                                                   style={'background_color': sfw.darkblue},
                                                                   mouse_pressed_fn=clkfn)
+                        clkfn = lambda x, y, b, m: sfc.on_click_parallel_workers(x, y, b, m) # noqa : E731
+                        sfw._parallel_workers_but = ui.Button(f"Worker processes: {sff.p_parallel_workers}",
+                                                              style={'background_color': sfw.darkblue},
+                                                              mouse_pressed_fn=clkfn)
 
 
 class SfcTabSphereFlake(BaseTab):
@@ -261,7 +327,8 @@ class SfcTabSphereFlake(BaseTab):
                 with ui.HStack():
                     sfw._sf_spawn_but = ui.Button("Spawn SphereFlake",
                                                   style={'background_color': sfw.darkred},
-                                                  clicked_fn=lambda: sfc.on_click_sphereflake())
+                                                  clicked_fn= # noqa : E251
+                                                  lambda: asyncio.ensure_future(sfc.on_click_sphereflake()))
                     with ui.VStack(width=200):
                         sfw._sf_depth_but = ui.Button(f"Depth:{sff.p_depth}",
                                                       style={'background_color': sfw.darkgreen},
@@ -298,6 +365,35 @@ class SfcTabSphereFlake(BaseTab):
                                                      style={'background_color': sfw.darkgreen},
                                                      mouse_pressed_fn= # noqa : E251
                                                      lambda x, y, b, m: sfc.on_click_nlng(x, y, b, m))
+                        sfw._merge_chunk_but = ui.Button(f"Merge chunk: {sff.p_merge_chunk}",
+                                                         style={'background_color': sfw.darkgreen},
+                                                         mouse_pressed_fn= # noqa : E251
+                                                         lambda x, y, b, m: sfc.on_click_merge_chunk(x, y, b, m))
+                        sfw._precision_but = ui.Button(f"Precision: {smf.p_precision}",
+                                                       style={'background_color': sfw.darkgreen},
+                                                       clicked_fn=sfc.on_click_precision)
+                        sfw._bind_mode_but = ui.Button(f"Binding: {sff.p_bind_mode}",
+                                                       style={'background_color': sfw.darkgreen},
+                                                       clicked_fn=sfc.on_click_bind_mode)
+                        sfw._tess_mode_but = ui.Button(f"Tessellation: {smf.p_tess_mode}",
+                                                       style={'background_color': sfw.darkgreen},
+                                                       clicked_fn=sfc.on_click_tess_mode)
+                        sfw._async_workers_but = ui.Button(f"Async workers: {smf.p_async_workers}",
+                                                           style={'background_color': sfw.darkgreen},
+                                                           mouse_pressed_fn= # noqa : E251
+                                                           lambda x, y, b, m: sfc.on_click_async_workers(x, y, b, m))
+                        with ui.HStack():
+                            ui.Label("Tess per level:", width=50)
+                            ui.StringField(model=sfw._tess_levels_model)
+                        with ui.HStack():
+                            ui.Label("Tess edge len:", width=50)
+                            ui.FloatField(model=sfw._tess_edge_model)
+                        sfw._instancer_proto_but = ui.Button(f"Instancer proto: {sff.p_instancer_proto}",
+                                                             style={'background_color': sfw.darkgreen},
+                                                             clicked_fn=sfc.on_click_instancer_proto)
+                        sfw._instancer_grid_but = ui.Button(f"Instancer per grid: {sff.p_instancer_grid}",
+                                                            style={'background_color': sfw.darkgreen},
+                                                            clicked_fn=sfc.toggle_instancer_grid)
 
 
 class SfcTabShapes(BaseTab):
@@ -389,7 +485,7 @@ class SfcTabOptions(BaseTab):
     def build_fn(self):
         print("SfcTabOptions.build_fn (trc)")
         sfw = self.sfw
-        sfc = self.sfc # noqa : F841
+        sfc = self.sfc
 
         with ui.VStack(style={"margin": sfw.marg}):
             with ui.HStack():
@@ -400,3 +496,24 @@ class SfcTabOptions(BaseTab):
                 ui.Label("Log Series Name:")
                 sfw.writelog_seriesname = ui.StringField(model=sfw.writelog_seriesname_model,
                                                          width=200, height=20, visible=True)
+            with ui.HStack():
+                ui.Label("Memory Budget GB (0 - 75% of RAM):")
+                sfw.mem_budget_field = ui.FloatField(model=sfw.mem_budget_model, width=80, height=20)
+            sfw._over_budget_but = ui.Button(f"Over budget: {sfc.p_over_budget}",
+                                             style={'background_color': sfw.darkgreen},
+                                             clicked_fn=sfc.on_click_over_budget)
+            sfw._content_mode_but = ui.Button(f"Content: {sfc._matman.p_content_mode}",
+                                              style={'background_color': sfw.darkgreen},
+                                              clicked_fn=sfc.on_click_content_mode)
+            sfw._prefetch_but = ui.Button("Prefetch Content",
+                                          style={'background_color': sfw.darkgreen},
+                                          clicked_fn=lambda: asyncio.ensure_future(sfc.on_click_prefetch_content()))
+            sfw._trace_but = ui.Button(sfc.get_trace_label(),
+                                       style={'background_color': sfw.darkgreen},
+                                       clicked_fn=sfc.on_click_trace)
+            ui.Button("Export Grid to .usdc",
+                      style={'background_color': sfw.darkgreen},
+                      clicked_fn=lambda: asyncio.ensure_future(sfc.on_click_export()))
+            ui.Button("Precision Memory Benchmark (depth 4, 5x5)",
+                      style={'background_color': sfw.darkpurple},
+                      clicked_fn=lambda: sfc.run_precision_membench())
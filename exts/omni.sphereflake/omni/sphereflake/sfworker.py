@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import multiprocessing
+from pxr import Sdf
+from .sflayout import GetLayout
+from .sdfauthor import SdfAuthor
+
+# Everything in here runs in worker processes and must only depend on pxr, numpy and the pxr-only
+# modules of this package (sflayout, sdfauthor) - no Kit, no omni.usd, no carb.
+
+
+def CreateLayer(filepath: str) -> Sdf.Layer:
+    # a layer this process still has open (a stage on an earlier export) is emptied and reused, CreateNew would fail
+    layer = Sdf.Layer.Find(filepath)
+    if layer is None:
+        return Sdf.Layer.CreateNew(filepath)
+    layer.Clear()
+    return layer
+
+
+def GenerateChunk(job: dict):
+    # authors one batch of grid cells into its own layer and saves it, the main process attaches the file
+    start = time.time()
+    layer = CreateLayer(job["filepath"])
+    sdfa = SdfAuthor(layer)
+    layout = GetLayout(job["genform"], job["depth"], job["rad"], job["radratio"])
+    mtlpath = Sdf.Path(job["mtlpath"]) if job["mtlpath"] else None
+    bbmtlpath = Sdf.Path(job["bbmtlpath"]) if job["bbmtlpath"] else None
+    with Sdf.ChangeBlock():
+        flakeroot = job["bindmode"] == "FlakeRoot"
+        for (primpath, cpt) in job["cells"]:
+            root = sdfa.DefineSphereFlake(primpath, layout, cpt, None if flakeroot else mtlpath, job["spherename"])
+            if flakeroot:
+                sdfa.BindMaterial(root, mtlpath)
+            # payload content leaves the bounds to the cell roots
+            if job.get("bounds", True):
+                sdfa.DefineBoundsCube(primpath+"/bounds", cpt, job["extent"], bbmtlpath, job["visible"])
+    layer.Save()
+    return job["filepath"], len(job["cells"]), sdfa.nprims, sdfa.nrels, time.time() - start
+
+
+def GetPythonExecutable() -> str:
+    # inside Kit sys.executable is the kit binary, spawned workers need a plain interpreter
+    exe = sys.executable
+    if os.path.basename(exe).lower().startswith("python"):
+        return exe
+    for cand in ["python.exe", "python3", "python", os.path.join("bin", "python3")]:
+        path = os.path.join(sys.prefix, cand)
+        if os.path.isfile(path):
+            return path
+    return exe
+
+
+def GetSpawnContext():
+    # spawn rather than fork, a forked Kit process would inherit the renderer and the open stage
+    ctx = multiprocessing.get_context("spawn")
+    ctx.set_executable(GetPythonExecutable())
+    return ctx
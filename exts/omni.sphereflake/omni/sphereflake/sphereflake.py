@@ -1,11 +1,24 @@
 import omni.kit.commands as okc
 import omni.usd
+import omni.kit.app
 import carb
 import time
 import asyncio
 import math
-from pxr import Gf, Usd, UsdGeom, UsdShade
-from .spheremesh import SphereMeshFactory
+import os
+import contextlib
+import hashlib
+import shutil
+import tempfile
+import concurrent.futures
+import numpy as np
+from pxr import Gf, Sdf, Usd, UsdGeom, UsdShade, Vt
+from .spheremesh import SphereMeshFactory, CalcSphereExtent
+from .sflayout import GetLayout
+from .sdfauthor import SdfAuthor
+from .flakecache import FlakeCache, FLAKE_ROOT, GetDefaultFlakeCacheDir
+from .tracing import traced
+from .sfworker import GenerateChunk, GetSpawnContext, CreateLayer
 from . import ovut
 from .ovut import MatMan, get_setting, save_setting
 # import omni.services.client
@@ -14,6 +27,14 @@ import aiohttp
 latest_sf_gen_time = 0
 
 
+def GetDefaultExportPath() -> str:
+    return os.path.join(os.path.expanduser("~"), ".omni.sphereflake", "export", "sphereflake.usdc")
+
+
+def GetDefaultPayloadDir() -> str:
+    return os.path.join(os.path.expanduser("~"), ".omni.sphereflake", "payloads")
+
+
 class SphereFlakeFactory():
     _matman: MatMan = None
     _smf: SphereMeshFactory = None
@@ -36,14 +57,50 @@ class SphereFlakeFactory():
     p_parallel_nxbatch = 1
     p_parallel_nybatch = 1
     p_parallel_nzbatch = 1
+    p_parallel_workers = 0  # 0 means one worker process per core
 
     p_sf_matname = "Mirror"
     p_sf_alt_matname = "Red_Glass"
     p_bb_matname = "Blue_Glass"
     p_make_bounds_visible = False
+    p_merge_chunk = 1
+    p_instancer_proto = "Sphere"
+    p_instancer_grid = False
+    p_instanceable = False
+    p_incremental = False
+    p_deferred_removal = False
+    p_bind_mode = "PerSphere"
+    p_frame_budget_ms = 8.0
+    p_flake_cache = False
+    p_flake_cache_mb = 1024.0
+    p_flake_cache_dir = ""
+    p_export_chunk = 256  # grid cells per chunk file of ExportMany and per content layer of payload cells
+    p_payload_cells = False
+    p_payload_dir = ""
     _start_time = 0
     _createlist: list = []
     _bbcubelist: list = []
+    _mergechunk: list = []
+    _nmergechunks = 0
+    _mergeroots: list = []
+    _protos: dict = {}
+    _parallel_layers: list = []
+    _parallel_dir: str = None
+    _gridcells: dict = {}
+    _flakes: dict = {}
+    _deferred: list = []
+    _deferred_running = False
+    _teardown_time = 0.0
+    _cancel_requested = False
+    _cancelled = False
+    _yield_time = 0.0
+    _nslices = 0
+    _ncells_planned = 0
+    _phase_times: dict = {}
+    _phase_stack: list = []
+    _nbindrels = 0
+    _bindtime = 0.0
+    _flakecache: FlakeCache = None
 
     _org = Gf.Vec3f(0, 0, 0)
     _xax = Gf.Vec3f(1, 0, 0)
@@ -55,6 +112,18 @@ class SphereFlakeFactory():
         self._count = 0
         self._matman = matman
         self._smf = smf
+        # the class level containers would be shared by every factory, and a new stage would inherit old entries
+        self._createlist = []
+        self._bbcubelist = []
+        self._mergechunk = []
+        self._mergeroots = []
+        self._protos = {}
+        self._parallel_layers = []
+        self._gridcells = {}
+        self._flakes = {}
+        self._deferred = []
+        self._phase_times = {}
+        self._phase_stack = []
 
     def GenPrep(self):
         self._smf.GenPrep()
@@ -81,11 +150,26 @@ class SphereFlakeFactory():
         self.p_parallel_nxbatch = get_setting("p_parallel_nxbatch", self.p_parallel_nxbatch)
         self.p_parallel_nybatch = get_setting("p_parallel_nybatch", self.p_parallel_nybatch)
         self.p_parallel_nzbatch = get_setting("p_parallel_nzbatch", self.p_parallel_nzbatch)
+        self.p_parallel_workers = get_setting("p_parallel_workers", self.p_parallel_workers)
         self.p_sf_matname = get_setting("p_sf_matname", self.p_sf_matname)
         self.p_sf_alt_matname = get_setting("p_sf_alt_matname", self.p_sf_alt_matname)
         self.p_bb_matname = get_setting("p_bb_matname", self.p_bb_matname)
         self.p_bb_matname = get_setting("p_bb_matname", self.p_bb_matname)
         self.p_make_bounds_visible = get_setting("p_make_bounds_visible", self.p_make_bounds_visible)
+        self.p_merge_chunk = get_setting("p_merge_chunk", self.p_merge_chunk)
+        self.p_instancer_proto = get_setting("p_instancer_proto", self.p_instancer_proto)
+        self.p_instancer_grid = get_setting("p_instancer_grid", self.p_instancer_grid)
+        self.p_instanceable = get_setting("p_instanceable", self.p_instanceable)
+        self.p_incremental = get_setting("p_incremental", self.p_incremental)
+        self.p_deferred_removal = get_setting("p_deferred_removal", self.p_deferred_removal)
+        self.p_bind_mode = get_setting("p_bind_mode", self.p_bind_mode)
+        self.p_frame_budget_ms = get_setting("p_frame_budget_ms", self.p_frame_budget_ms)
+        self.p_flake_cache = get_setting("p_flake_cache", self.p_flake_cache)
+        self.p_flake_cache_mb = get_setting("p_flake_cache_mb", self.p_flake_cache_mb)
+        self.p_flake_cache_dir = get_setting("p_flake_cache_dir", self.p_flake_cache_dir)
+        self.p_export_chunk = get_setting("p_export_chunk", self.p_export_chunk)
+        self.p_payload_cells = get_setting("p_payload_cells", self.p_payload_cells)
+        self.p_payload_dir = get_setting("p_payload_dir", self.p_payload_dir)
         print(f"SphereFlakeFactory.LoadSettings: p_nsfx:{self.p_nsfx} p_nsfy:{self.p_nsfy} p_nsfz:{self.p_nsfz}")
 
     def SaveSettings(self):
@@ -109,16 +193,48 @@ class SphereFlakeFactory():
         save_setting("p_parallel_nxbatch", self.p_parallel_nxbatch)
         save_setting("p_parallel_nybatch", self.p_parallel_nybatch)
         save_setting("p_parallel_nzbatch", self.p_parallel_nzbatch)
+        save_setting("p_parallel_workers", self.p_parallel_workers)
         save_setting("p_sf_matname", self.p_sf_matname)
         save_setting("p_sf_alt_matname", self.p_sf_alt_matname)
         save_setting("p_bb_matname", self.p_bb_matname)
         save_setting("p_make_bounds_visible", self.p_make_bounds_visible)
+        save_setting("p_merge_chunk", self.p_merge_chunk)
+        save_setting("p_instancer_proto", self.p_instancer_proto)
+        save_setting("p_instancer_grid", self.p_instancer_grid)
+        save_setting("p_instanceable", self.p_instanceable)
+        save_setting("p_incremental", self.p_incremental)
+        save_setting("p_deferred_removal", self.p_deferred_removal)
+        save_setting("p_bind_mode", self.p_bind_mode)
+        save_setting("p_frame_budget_ms", self.p_frame_budget_ms)
+        save_setting("p_flake_cache", self.p_flake_cache)
+        save_setting("p_flake_cache_mb", self.p_flake_cache_mb)
+        save_setting("p_flake_cache_dir", self.p_flake_cache_dir)
+        save_setting("p_export_chunk", self.p_export_chunk)
+        save_setting("p_payload_cells", self.p_payload_cells)
+        save_setting("p_payload_dir", self.p_payload_dir)
 
 
 
     @staticmethod
     def GetGenModes():
-        return ["UsdSphere", "DirectMesh", "AsyncMesh", "OmniSphere"]
+        return ["UsdSphere", "DirectMesh", "AsyncMesh", "OmniSphere", "SdfSphere", "MergedMesh", "PointInstancer"]
+
+    @staticmethod
+    def GetBindModes():
+        # PerSphere - every sphere gets its own binding relationship (the original behavior)
+        # FlakeRoot - one binding on the flake root, the spheres inherit it
+        # PerLevel  - depth levels alternate between the main and the alt material, bound per level with
+        #             one collection per level on the root, or one GeomSubset per material in a merged mesh
+        return ["PerSphere", "FlakeRoot", "PerLevel"]
+
+    @staticmethod
+    def GetFrameBudgets():
+        # ms per frame for time-sliced multi generation, 0 generates everything in one go
+        return [0.0, 4.0, 8.0, 16.0, 33.0]
+
+    @staticmethod
+    def GetInstancerProtos():
+        return ["Sphere", "Mesh"]
 
     @staticmethod
     def GetGenForms():
@@ -127,6 +243,13 @@ class SphereFlakeFactory():
     def Clear(self):
         self._createlist = []
         self._bbcubelist = []
+        self._mergechunk = []
+        self._nmergechunks = 0
+        self._protos = {}
+        self._gridcells = {}
+        self._flakes = {}
+        self._mergeroots = []
+        self.DetachParallelLayers()
 
     def Set(self, attname: str, val: float):
         if hasattr(self, attname):
@@ -134,23 +257,55 @@ class SphereFlakeFactory():
         else:
             carb.log.error(f"SphereFlakeFactory.Set: no attribute {attname}")
 
+    def GetSphereTess(self, level: int, rad: float):
+        # (nlat, nlng) of the mesh one sphere is authored as, None for UsdGeom.Sphere prims
+        # only DirectMesh and AsyncMesh follow the per-level schedule, a merged mesh is one uniform template
+        if self.p_genmode in ["UsdSphere", "SdfSphere"]:
+            return None
+        if self.p_genmode == "PointInstancer":
+            return self._smf.GetLevelTess(0, 1.0) if self.p_instancer_proto == "Mesh" else None
+        if self.p_genmode in ["DirectMesh", "AsyncMesh"]:
+            return self._smf.GetLevelTess(level, rad)
+        return (self._smf.p_nlat, self._smf.p_nlng)
+
     def CalcQuadsAndPrims(self):
         nring = 9 if self.p_genform == "Classic" else 8
-        nlat = self._smf.p_nlat
-        nlng = self._smf.p_nlng
+        rad = self.p_rad
         totquads = 0
         totprims = 0
         for i in range(self.p_depth+1):
             nspheres = nring**(i)
-            nquads = nspheres * nlat * nlng
+            tess = self.GetSphereTess(i, rad)
+            nquads = nspheres * tess[0] * tess[1] if tess is not None else 0
+            rad *= self.p_radratio
             totquads += nquads
             totprims += nspheres
+        if self.p_genmode in ["MergedMesh", "PointInstancer"]:
+            totprims = 1  # every flake is one mesh/instancer, or a share of one when chunked
         return totquads, totprims
 
+    def CalcSpheres(self):
+        # spheres in one flake, MergedMesh and PointInstancer author all of them as a single prim
+        return GetLayout(self.p_genform, self.p_depth, self.p_rad, self.p_radratio).nnodes
+
     def CalcTrisAndPrims(self):
         totquads, totprims = self.CalcQuadsAndPrims()
         return totquads * 2, totprims
 
+    def CalcGridTrisAndPrims(self):
+        # what a multi-flake run actually authors, merged chunks hold p_merge_chunk flakes per mesh
+        ntris, nprims = self.CalcTrisAndPrims()
+        nflakes = self.p_nsfx * self.p_nsfy * self.p_nsfz
+        if self.p_genmode in ["MergedMesh", "PointInstancer"]:
+            return ntris*nflakes, math.ceil(nflakes / self.GetMergeChunk())
+        return ntris*nflakes, nprims*nflakes
+
+    def GetMergeChunk(self) -> int:
+        # number of grid cells that go into one merged mesh or point instancer
+        if self.p_genmode == "PointInstancer":
+            return max(1, self.p_nsfx * self.p_nsfy * self.p_nsfz) if self.p_instancer_grid else 1
+        return max(1, self.p_merge_chunk)
+
     def GetCenterPosition(self, ix: int, iy: int, iz: int,
                           extentvec: Gf.Vec3f, gap: float = 1.1):
         nx = self.p_nsfx
@@ -172,16 +327,123 @@ class SphereFlakeFactory():
         global latest_sf_gen_time
         return latest_sf_gen_time
 
+    @traced()
     def SpawnBBcube(self, primpath, cenpt, extent, bbmatname):
         stage = omni.usd.get_context().get_stage()
         xformPrim = UsdGeom.Xform.Define(stage, primpath)
         UsdGeom.XformCommonAPI(xformPrim).SetTranslate((cenpt[0], cenpt[1], cenpt[2]))
         UsdGeom.XformCommonAPI(xformPrim).SetScale((extent[0], extent[1], extent[2]))
         cube = UsdGeom.Cube.Define(stage, primpath)
-        mtl = self._matman.GetMaterial(bbmatname)
-        UsdShade.MaterialBindingAPI(cube).Bind(mtl)
+        self.BindMaterial(cube.GetPrim(), bbmatname)
         return cube
 
+    @traced()
+    def SpawnBBcubeSdf(self, primpath, cenpt, extent, bbmatname, visible: bool):
+        sdfa = SdfAuthor(self.GetTargetLayer())
+        mtlpath = self.GetMaterialPath(bbmatname)
+        cube = sdfa.DefineBoundsCube(primpath, cenpt, extent, mtlpath, visible)
+        self.CollectBindStats(sdfa)
+        return cube
+
+    def BindMaterial(self, prim: Usd.Prim, matname: str):
+        # counts the binding relationships and the time they take for the run log
+        start = time.time()
+        mtl = self._matman.GetMaterial(matname)
+        UsdShade.MaterialBindingAPI(prim).Bind(mtl)
+        self._nbindrels += 1
+        self._bindtime += time.time() - start
+
+    def CollectBindStats(self, sdfa: SdfAuthor):
+        self._nbindrels += sdfa.nrels
+        self._bindtime += sdfa.bindtime
+        sdfa.nrels = 0
+        sdfa.bindtime = 0.0
+
+    def ResetPhaseTimes(self):
+        self._phase_times = {}
+        self._phase_stack = []
+        if self._flakecache is not None:
+            self._flakecache.ResetStats()
+
+    def AddPhaseTime(self, name: str, elap: float):
+        self._phase_times[name] = self._phase_times.get(name, 0.0) + elap
+
+    def GetPhaseTimes(self) -> dict:
+        # bind comes from the bind counters, teardown from RemoveRoots, the rest from PhaseTimer blocks
+        phases = dict(self._phase_times)
+        phases["bind"] = self.GetBindStats()[1]
+        phases["teardown"] = self._teardown_time
+        return phases
+
+    @contextlib.contextmanager
+    def PhaseTimer(self, name: str):
+        # Nested phases and material binding are taken out of the time of the enclosing phase,
+        # so the phases of a run add up to its wall time instead of counting anything twice.
+        start = time.time()
+        bindstart = self.GetBindStats()[1]
+        self._phase_stack.append([0.0, 0.0])
+        try:
+            yield
+        finally:
+            (nestelap, nestbind) = self._phase_stack.pop()
+            elap = time.time() - start
+            bindelap = self.GetBindStats()[1] - bindstart
+            self.AddPhaseTime(name, elap - nestelap - (bindelap - nestbind))
+            if len(self._phase_stack) > 0:
+                self._phase_stack[-1][0] += elap
+                self._phase_stack[-1][1] += bindelap
+
+    def ResetBindStats(self):
+        self._nbindrels = 0
+        self._bindtime = 0.0
+        self._smf.nbindrels = 0
+        self._smf.bindtime = 0.0
+
+    def GetBindStats(self):
+        return self._nbindrels + self._smf.nbindrels, self._bindtime + self._smf.bindtime
+
+    def GetLevelMatName(self, level: int) -> str:
+        return self.p_sf_alt_matname if level % 2 == 1 else self.p_sf_matname
+
+    def GetSphereName(self) -> str:
+        # the name of the sphere prim under each tree node, per genmode
+        names = {"UsdSphere": "UsdSphere", "SdfSphere": "SdfSphere", "DirectMesh": "SphereMesh",
+                 "AsyncMesh": "SphereMeshAsync", "OmniSphere": "OmniSphere"}
+        return names.get(self.p_genmode, "")
+
+    def PrepareMaterials(self):
+        # the Sdf paths need the materials realized up front, the Usd API must not be used inside a change block
+        self.GetMaterialPath(self.p_sf_matname)
+        self.GetMaterialPath(self.p_bb_matname)
+        if self.p_bind_mode == "PerLevel":
+            self.GetMaterialPath(self.p_sf_alt_matname)
+
+    def BindFlakeRoot(self, sphflkname: str, layout, matname: str):
+        # the flake level bindings of FlakeRoot and PerLevel, all of them authored on the root spec
+        sdfa = SdfAuthor(self.GetTargetLayer())
+        root = self.GetTargetLayer().GetPrimAtPath(sphflkname)
+        if self.p_bind_mode == "FlakeRoot":
+            sdfa.BindMaterial(root, self.GetMaterialPath(matname))
+        elif self.p_bind_mode == "PerLevel":
+            spherename = self.GetSphereName()
+            paths = layout.GetNodePaths(sphflkname)
+            for level in range(layout.depth+1):
+                includes = [Sdf.Path(f"{paths[i]}/{spherename}")
+                            for i in range(layout.levelstart[level], layout.levelstart[level+1])]
+                mtlpath = self.GetMaterialPath(self.GetLevelMatName(level))
+                sdfa.BindCollection(root, f"level_{level}", includes, mtlpath)
+        self.CollectBindStats(sdfa)
+
+    def GetTargetLayer(self) -> Sdf.Layer:
+        stage = omni.usd.get_context().get_stage()
+        return stage.GetEditTarget().GetLayer()
+
+    def GetMaterialPath(self, matname: str) -> Sdf.Path:
+        mtl = self._matman.GetMaterial(matname)
+        if mtl is None:
+            return None
+        return mtl.GetPath()
+
     def GetSphereFlakeBoundingBox(self) -> Gf.Vec3f:
         # sz = rad  +  (1+(radratio))**depth # old method
         sz = self.p_rad
@@ -228,6 +490,15 @@ class SphereFlakeFactory():
         # client = omni.services.client.AsyncClient("http://localhost:8211/sphereflake")
         self._createlist = []
         self._bbcubelist = []
+        self._mergechunk = []
+        self._nmergechunks = 0
+        self._protos = {}
+        self._teardown_time = 0.0
+        self.DropGridCells()
+        self.DropMergeChunks()
+        self.DetachParallelLayers()
+        useworkers = self.CanGenerateInWorkers()
+        jobs = []
         tasks = []
         doremote = False
         if doremote:
@@ -263,8 +534,22 @@ class SphereFlakeFactory():
                         t.add_done_callback(tasks.remove)
                         tasks.append(t)
                         print(f"GMP sf_ - url:{url}")
-                    sfcount += self.GenerateManySubcube(sx, sy, sz, nx, ny, nz)
+                    if useworkers and self.CanPayloadCells():
+                        jobs.append(self.MakePayloadJob(ibatch, sx, sy, sz, nx, ny, nz))
+                        sfcount += nx*ny*nz
+                    elif useworkers:
+                        jobs.append(self.MakeWorkerJob(ibatch, sx, sy, sz, nx, ny, nz))
+                        sfcount += nx*ny*nz
+                    else:
+                        # merge chunks may span batches, so they are only flushed once all batches are done
+                        sfcount += self.GenerateManySubcube(sx, sy, sz, nx, ny, nz, flush=False)
                     ibatch += 1
+        self.FlushMergeChunk()
+        await self.AwaitAsyncMeshes()
+        if len(jobs) > 0 and self.CanPayloadCells():
+            await self.GeneratePayloadsInWorkers(jobs)
+        elif len(jobs) > 0:
+            await self.GenerateInWorkers(jobs)
         if doremote:
             print(f"GMP: sf_ waiting for tasks to complete ln:{len(tasks)}")
             txts = await asyncio.gather(*tasks)
@@ -276,7 +561,291 @@ class SphereFlakeFactory():
         self.p_sf_alt_matname = original_alt_matname
         return sfcount
 
-    def GenerateMany(self):
+    async def AwaitAsyncMeshes(self) -> int:
+        # AsyncMesh only queues its spheres in Generate, they exist once this returns
+        global latest_sf_gen_time
+        start = time.time()
+        with self.PhaseTimer("author"):
+            nmesh = await self._smf.BuildQueuedMeshes()
+        if nmesh > 0:
+            latest_sf_gen_time += time.time() - start
+        return nmesh
+
+    def CanGenerateInWorkers(self) -> bool:
+        # the workers only have pxr, so only the modes that are pure Sdf prim specs can go out of process
+        if self.p_bind_mode == "PerLevel":
+            return False
+        return self.p_genmode in ["UsdSphere", "SdfSphere"] and not self.p_instanceable
+
+    def GetParallelWorkers(self) -> int:
+        if self.p_parallel_workers > 0:
+            return self.p_parallel_workers
+        return os.cpu_count() or 1
+
+    def MakeWorkerJob(self, ibatch: int, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int,
+                      filepath: str = None) -> dict:
+        # everything a worker needs, as plain picklable values - materials are realized here in the main process
+        if filepath is None:
+            if self._parallel_dir is None:
+                self._parallel_dir = tempfile.mkdtemp(prefix="sphereflake_")
+            filepath = os.path.join(self._parallel_dir, f"chunk_{ibatch}.usdc")
+        extentvec = self.GetSphereFlakeBoundingBox()
+        cells = []
+        for ix in range(sx, sx+nx):
+            for iy in range(sy, sy+ny):
+                for iz in range(sz, sz+nz):
+                    primpath = self.GetCellPath(ix, iy, iz)
+                    cpt = self.GetCenterPosition(ix, iy, iz, extentvec)
+                    cells.append((primpath, (cpt[0], cpt[1], cpt[2])))
+        mtlpath = self.GetMaterialPath(self.p_sf_matname)
+        bbmtlpath = self.GetMaterialPath(self.p_bb_matname)
+        spherename = "SdfSphere" if self.p_genmode == "SdfSphere" else "UsdSphere"
+        return {"filepath": filepath,
+                "genform": self.p_genform, "depth": self.p_depth, "rad": self.p_rad, "radratio": self.p_radratio,
+                "mtlpath": str(mtlpath) if mtlpath is not None else "",
+                "bbmtlpath": str(bbmtlpath) if bbmtlpath is not None else "",
+                "extent": (extentvec[0], extentvec[1], extentvec[2]),
+                "visible": self.p_make_bounds_visible,
+                "spherename": spherename,
+                "bindmode": self.p_bind_mode,
+                "cells": cells}
+
+    async def RunInWorkers(self, jobs: list) -> list:
+        # GenerateChunk for every job on a pool of worker processes, the results in job order
+        nworkers = min(self.GetParallelWorkers(), len(jobs))
+        print(f"RunInWorkers: {len(jobs)} batches on {nworkers} worker processes")
+        loop = asyncio.get_event_loop()
+        with concurrent.futures.ProcessPoolExecutor(max_workers=nworkers, mp_context=GetSpawnContext()) as pool:
+            futs = [loop.run_in_executor(pool, GenerateChunk, job) for job in jobs]
+            return await asyncio.gather(*futs)
+
+    async def GenerateInWorkers(self, jobs: list):
+        results = await self.RunInWorkers(jobs)
+
+        # the cells may still exist from a serial run, those opinions would be stronger than the sublayers
+        stage = omni.usd.get_context().get_stage()
+        sdfa = SdfAuthor(self.GetTargetLayer())
+        root = stage.GetRootLayer()
+        with Sdf.ChangeBlock():
+            for job in jobs:
+                for (primpath, _) in job["cells"]:
+                    sdfa.RemovePrim(primpath)
+                    self._flakes.pop(primpath, None)
+                    self._createlist.append(primpath)
+                    self._bbcubelist.append(primpath+"/bounds")
+            for (filepath, ncells, nprims, nrels, elap) in results:
+                root.subLayerPaths.append(filepath)
+                self._nbindrels += nrels
+                self._parallel_layers.append(filepath)
+        for (filepath, ncells, nprims, nrels, elap) in results:
+            print(f"   GenerateInWorkers: {os.path.basename(filepath)} cells:{ncells} prims:{nprims} in {elap:.2f} s")
+
+    async def GeneratePayloadsInWorkers(self, jobs: list):
+        # content layers that are already on disk are not written again
+        todo = [job for job in jobs if not os.path.isfile(job["filepath"])]
+        if len(todo) > 0:
+            await self.RunInWorkers(todo)
+        for job in jobs:
+            self.AttachPayloadCells(job)
+
+    def CanPayloadCells(self) -> bool:
+        # the cell content is authored by GenerateChunk, so the same modes as the parallel workers
+        return self.p_payload_cells and self.CanGenerateInWorkers()
+
+    def MakePayloadJob(self, ibatch: int, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int) -> dict:
+        # The content layer of a box of cells, no bindings or bounds in it - relationship targets outside a payload
+        # are dropped, the cell roots bind the material instead. The file is named by everything in the job, so a
+        # box that did not change keeps its file and the layer the stage may already have open.
+        payloaddir = self.p_payload_dir if self.p_payload_dir != "" else GetDefaultPayloadDir()
+        os.makedirs(payloaddir, exist_ok=True)
+        job = self.MakeWorkerJob(ibatch, sx, sy, sz, nx, ny, nz, filepath="")
+        job["cellmtlpath"] = job["mtlpath"]
+        job["mtlpath"] = ""
+        job["bindmode"] = "PerSphere"
+        job["bounds"] = False
+        content = {key: val for (key, val) in job.items()
+                   if key not in ["filepath", "cellmtlpath", "bbmtlpath", "visible"]}
+        khash = hashlib.md5(repr(sorted(content.items())).encode()).hexdigest()[:16]
+        job["filepath"] = os.path.join(payloaddir, f"cells_{khash}.usdc")
+        return job
+
+    def AttachPayloadCells(self, job: dict):
+        # the cell roots in the stage: the payload, the extentsHint, the material the spheres inherit and the bounds
+        sdfa = SdfAuthor(self.GetTargetLayer())
+        mtlpath = Sdf.Path(job["cellmtlpath"]) if job["cellmtlpath"] else None
+        bbmtlpath = Sdf.Path(job["bbmtlpath"]) if job["bbmtlpath"] else None
+        extent = job["extent"]
+        # the cells are component models, extentsHint only counts under an unbroken model hierarchy
+        stage = omni.usd.get_context().get_stage()
+        world = stage.GetPrimAtPath("/World")
+        setkind = world.IsValid() and Usd.ModelAPI(world).GetKind() == ""
+        with self.PhaseTimer("bounds"), Sdf.ChangeBlock():
+            if setkind:
+                sdfa.EnsureDefined("/World").kind = "group"
+            for (primpath, cpt) in job["cells"]:
+                sdfa.RemovePrim(primpath)
+                self._flakes.pop(primpath, None)
+                cell = sdfa.DefinePayloadCell(primpath, job["filepath"], cpt, extent)
+                sdfa.BindMaterial(cell, mtlpath)
+                sdfa.DefineBoundsCube(primpath+"/bounds", cpt, extent, bbmtlpath, job["visible"])
+                self._createlist.append(primpath)
+                self._bbcubelist.append(primpath+"/bounds")
+            self.CollectBindStats(sdfa)
+
+    def IterGenerateManyPayloads(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int):
+        # payload cells, a content layer per p_export_chunk cells and one payload per cell root
+        self.PrepareMaterials()
+        self._ncells_planned = nx*ny*nz
+        boxes = list(self.IterExportBoxes(sx, sy, sz, nx, ny, nz, self.p_export_chunk))
+        count = self._count
+        yield 0
+        for (ibatch, box) in enumerate(boxes):
+            job = self.MakePayloadJob(ibatch, *box)
+            if not os.path.isfile(job["filepath"]):
+                with self.PhaseTimer("author"):
+                    GenerateChunk(job)
+            self.AttachPayloadCells(job)
+            for _ in job["cells"]:
+                count += 1
+                yield 1
+        return count
+
+    def GetCellPath(self, ix: int, iy: int, iz: int) -> str:
+        # named by the full grid size, so the serial, worker and payload paths all author the same cell roots
+        return f"/World/SphereFlake_{ix}_{iy}_{iz}__{self.p_nsfx}_{self.p_nsfy}_{self.p_nsfz}"
+
+    def GetCellPaths(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int) -> list:
+        return [Sdf.Path(self.GetCellPath(ix, iy, iz))
+                for ix in range(sx, sx+nx) for iy in range(sy, sy+ny) for iz in range(sz, sz+nz)]
+
+    def LoadCells(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int, unloadrest: bool = False) -> int:
+        # loads the payload cells of the box, and unloads all the others with unloadrest - the cell roots with
+        # their bounds and extentsHint stay either way
+        stage = omni.usd.get_context().get_stage()
+        paths = [path for path in self.GetCellPaths(sx, sy, sz, nx, ny, nz)
+                 if stage.GetPrimAtPath(path).IsValid() and stage.GetPrimAtPath(path).HasAuthoredPayloads()]
+        unload = [Sdf.Path("/World")] if unloadrest else []
+        stage.LoadAndUnload(paths, unload)
+        return len(paths)
+
+    def UnloadCells(self):
+        stage = omni.usd.get_context().get_stage()
+        stage.Unload(Sdf.Path("/World"))
+
+    def DetachParallelLayers(self):
+        if len(self._parallel_layers) > 0:
+            stage = omni.usd.get_context().get_stage()
+            if stage is not None:
+                root = stage.GetRootLayer()
+                with Sdf.ChangeBlock():
+                    for filepath in self._parallel_layers:
+                        if filepath in root.subLayerPaths:
+                            root.subLayerPaths.remove(filepath)
+            self._parallel_layers = []
+        if self._parallel_dir is not None:
+            shutil.rmtree(self._parallel_dir, ignore_errors=True)
+            self._parallel_dir = None
+
+    def CanExport(self) -> bool:
+        # the chunks are authored by GenerateChunk, so the same modes as the parallel workers
+        return self.CanGenerateInWorkers()
+
+    def IterExportBoxes(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int, chunkcells: int):
+        # (sx, sy, sz, nx, ny, nz) boxes of about chunkcells cells - slabs along x, split along y when one x slab
+        # alone is bigger than that
+        chunkcells = max(1, chunkcells)
+        stepx = max(1, chunkcells // (ny*nz))
+        stepy = ny if ny*nz <= chunkcells else max(1, chunkcells // nz)
+        for ix in range(sx, sx+nx, stepx):
+            for iy in range(sy, sy+ny, stepy):
+                yield (ix, iy, sz, min(stepx, sx+nx-ix), min(stepy, sy+ny-iy), nz)
+
+    def GetExportChunkDir(self, filepath: str) -> str:
+        return os.path.splitext(filepath)[0] + "_chunks"
+
+    async def ExportMany(self, filepath: str, progressfn=None) -> dict:
+        # Streams the grid into a .usdc without authoring it in the live stage: every chunk of p_export_chunk cells
+        # is written to its own layer by GenerateChunk and released, filepath is a root layer with the materials
+        # and the chunks as sublayers. Memory stays at a few chunks, whatever the grid size.
+        if not self.CanExport():
+            print(f"ExportMany - {self.p_genmode}/{self.p_bind_mode}/instanceable:{self.p_instanceable} "
+                  "cannot be exported, only UsdSphere and SdfSphere without PerLevel binding")
+            return None
+        start = time.time()
+        filepath = os.path.abspath(filepath)
+        chunkdir = self.GetExportChunkDir(filepath)
+        os.makedirs(chunkdir, exist_ok=True)
+        # chunks of an earlier export to the same file would otherwise be left lying around
+        for fname in os.listdir(chunkdir):
+            if fname.startswith("chunk_") and fname.endswith(".usdc"):
+                os.remove(os.path.join(chunkdir, fname))
+        (sx, sy, sz, nx, ny, nz) = self.GetGenerateRange()
+        nchunks = len(list(self.IterExportBoxes(sx, sy, sz, nx, ny, nz, self.p_export_chunk)))
+        nworkers = min(self.GetParallelWorkers(), nchunks) if self.p_parallelRender else 1
+        loop = asyncio.get_event_loop()
+        pool = None
+        if nworkers > 1:
+            pool = concurrent.futures.ProcessPoolExecutor(max_workers=nworkers, mp_context=GetSpawnContext())
+        results = []
+        pending = []
+        try:
+            # jobs are made as the chunks go out, only a few are ever in flight
+            boxes = self.IterExportBoxes(sx, sy, sz, nx, ny, nz, self.p_export_chunk)
+            for (ichunk, box) in enumerate(boxes):
+                chunkpath = os.path.join(chunkdir, f"chunk_{ichunk:05d}.usdc")
+                job = self.MakeWorkerJob(ichunk, *box, filepath=chunkpath)
+                pending.append(loop.run_in_executor(pool, GenerateChunk, job))
+                if len(pending) >= 2*nworkers:
+                    results.append(await pending.pop(0))
+                    if progressfn is not None:
+                        progressfn(len(results), nchunks, time.time() - start)
+            for fut in pending:
+                results.append(await fut)
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        self.WriteExportRoot(filepath, [res[0] for res in results])
+        ncells = sum(res[1] for res in results)
+        nprims = sum(res[2] for res in results)
+        nbytes = os.path.getsize(filepath) + sum(os.path.getsize(res[0]) for res in results)
+        elap = time.time() - start
+        if progressfn is not None:
+            progressfn(nchunks, nchunks, elap)
+        print(f"ExportMany: {ncells} cells {nprims} prims in {len(results)} chunks, {nbytes/1e6:.1f} MB "
+              f"to {filepath} in {elap:.2f} s")
+        return {"filepath": filepath, "cells": ncells, "prims": nprims, "chunks": len(results), "bytes": nbytes,
+                "elapsed": elap}
+
+    def WriteExportRoot(self, filepath: str, chunkpaths: list):
+        # the materials are copied from the live stage, the chunks bind to them by path
+        stage = omni.usd.get_context().get_stage()
+        layer = CreateLayer(filepath)
+        layer.defaultPrim = "World"
+        layer.pseudoRoot.SetInfo(UsdGeom.Tokens.upAxis, UsdGeom.GetStageUpAxis(stage))
+        layer.pseudoRoot.SetInfo(UsdGeom.Tokens.metersPerUnit, UsdGeom.GetStageMetersPerUnit(stage))
+        world = Sdf.CreatePrimInLayer(layer, "/World")
+        world.specifier = Sdf.SpecifierDef
+        world.typeName = "Xform"
+        for matname in [self.p_sf_matname, self.p_bb_matname]:
+            mtlpath = self.GetMaterialPath(matname)
+            if mtlpath is None:
+                continue
+            prim = stage.GetPrimAtPath(mtlpath)
+            # the parents (/World/Looks) are defined too, a material under an over is not part of the scene
+            for path in mtlpath.GetPrefixes()[1:-1]:
+                spec = Sdf.CreatePrimInLayer(layer, path)
+                spec.specifier = Sdf.SpecifierDef
+                if stage.GetPrimAtPath(path).GetTypeName() != "":
+                    spec.typeName = stage.GetPrimAtPath(path).GetTypeName()
+            # the strongest spec at that path, with its arcs if the material is referenced in (content modes)
+            srcspecs = [spec for spec in prim.GetPrimStack() if spec.path == mtlpath]
+            if len(srcspecs) > 0:
+                Sdf.CopySpec(srcspecs[0].layer, mtlpath, layer, mtlpath)
+        chunkdir = os.path.dirname(filepath)
+        layer.subLayerPaths = ["./" + os.path.relpath(path, chunkdir).replace(os.sep, "/") for path in chunkpaths]
+        layer.Save()
+
+    def GetGenerateRange(self) -> tuple:
         if self.p_partialRender:
             sx = self.p_partial_ssfx
             sy = self.p_partial_ssfy
@@ -291,45 +860,362 @@ class SphereFlakeFactory():
             nx = self.p_nsfx
             ny = self.p_nsfy
             nz = self.p_nsfz
+        return (sx, sy, sz, nx, ny, nz)
+
+    def IterGenerateMany(self):
+        (sx, sy, sz, nx, ny, nz) = self.GetGenerateRange()
+        if self.p_incremental and self.GetMergeChunk() == 1 and not self.CanPayloadCells():
+            return self.IterGenerateManyIncremental(sx, sy, sz, nx, ny, nz)
         self._createlist = []
         self._bbcubelist = []
-        sfcount = self.GenerateManySubcube(sx, sy, sz, nx, ny, nz)
-        return sfcount
+        self._mergechunk = []
+        self._nmergechunks = 0
+        self._protos = {}
+        self._teardown_time = 0.0
+        self.DropGridCells()
+        self.DropMergeChunks()
+        self.DetachParallelLayers()
+        if self.CanPayloadCells():
+            return self.IterGenerateManyPayloads(sx, sy, sz, nx, ny, nz)
+        return self.IterGenerateManySubcube(sx, sy, sz, nx, ny, nz)
+
+    def GenerateMany(self):
+        return self.RunCells(self.IterGenerateMany())
+
+    async def GenerateManyBudgeted(self, progressfn=None):
+        return await self.RunCellsBudgeted(self.IterGenerateMany(), progressfn)
+
+    def GetCellBlock(self):
+        # SdfSphere cells are pure Sdf authoring and get batched into change blocks, the other modes go through Usd
+        return Sdf.ChangeBlock() if self.p_genmode == "SdfSphere" else contextlib.nullcontext()
+
+    def RunCells(self, cells) -> int:
+        # The IterGenerateMany* generators do their setup, yield 0, and then yield 1 per generated cell.
+        # Their return value is the new flake count.
+        self._yield_time = 0.0
+        self._nslices = 1
+        self._cancelled = False
+        try:
+            next(cells)
+            # the change block close is where Usd processes the batched changes, that is authoring time too
+            with self.PhaseTimer("author"), self.GetCellBlock():
+                while True:
+                    next(cells)
+        except StopIteration as e:
+            return e.value
+
+    def CancelGenerate(self):
+        self._cancel_requested = True
+
+    async def RunCellsBudgeted(self, cells, progressfn=None) -> int:
+        # Same as RunCells, but cells are generated in slices of about p_frame_budget_ms and the Kit update loop
+        # gets a frame between slices. Cancelling stops at a cell boundary and closes the generator, which still
+        # flushes pending merge chunks and updates the created lists, so the stage stays consistent.
+        budget = self.p_frame_budget_ms / 1000.0
+        self._cancel_requested = False
+        self._cancelled = False
+        self._yield_time = 0.0
+        self._nslices = 0
+        ndone = 0
+        start = time.time()
+        try:
+            next(cells)
+            ncells = self._ncells_planned
+            while True:
+                slicestart = time.time()
+                with self.PhaseTimer("author"), self.GetCellBlock():
+                    # at least one cell per slice, a cell that takes longer than the budget still has to progress
+                    ndone += next(cells)
+                    while time.time() - slicestart < budget:
+                        ndone += next(cells)
+                self._nslices += 1
+                if progressfn is not None:
+                    progressfn(ndone, ncells, time.time() - start - self._yield_time)
+                if self._cancel_requested:
+                    self._cancelled = True
+                    cells.close()
+                    print(f"RunCellsBudgeted: cancelled after {ndone} of {ncells} cells")
+                    return self._count + ndone
+                ystart = time.time()
+                await omni.kit.app.get_app().next_update_async()
+                self._yield_time += time.time() - ystart
+        except StopIteration as e:
+            self._nslices += 1
+            if progressfn is not None:
+                progressfn(ncells, ncells, time.time() - start - self._yield_time)
+            return e.value
+
+    def IterGenerateManyIncremental(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int):
+        # Diffs the new grid against what _gridcells says is authored: new cells are generated, dropped ones
+        # removed, and survivors only get their root translate set to wherever GetCenterPosition puts them now.
+        # Cell paths leave out the grid size so a cell keeps its name when the grid grows or shrinks.
+        self.GenPrep()
+        self.DetachParallelLayers()
+        self._teardown_time = 0.0
+        self.DropMergeChunks()
+        extentvec = self.GetSphereFlakeBoundingBox()
+        varkey = self.GetVariantKey(self.p_sf_matname)
+        layer = self.GetTargetLayer()
+        sdfa = SdfAuthor(layer)
+        wanted = {}
+        for ix in range(sx, sx+nx):
+            for iy in range(sy, sy+ny):
+                for iz in range(sz, sz+nz):
+                    wanted[(ix, iy, iz)] = self.GetCenterPosition(ix, iy, iz, extentvec)
+
+        ndrop = 0
+        nmove = 0
+        start = time.time()
+        with Sdf.ChangeBlock():
+            for (key, (primpath, basecpt, cellkey)) in list(self._gridcells.items()):
+                if key in wanted and cellkey == varkey and layer.GetPrimAtPath(primpath) is not None:
+                    continue
+                # dropped, or built with other parameters - the latter gets rebuilt below
+                sdfa.RemovePrim(primpath)
+                del self._gridcells[key]
+                ndrop += 1 if key not in wanted else 0
+            for (key, (primpath, basecpt, _)) in self._gridcells.items():
+                delta = wanted[key] - basecpt
+                if delta.GetLength() > 0:
+                    nmove += 1
+                sdfa.SetTranslate(layer.GetPrimAtPath(primpath), delta)
+                bounds = layer.GetPrimAtPath(primpath+"/bounds")
+                if bounds is not None:
+                    sdfa.SetVisibility(bounds, self.p_make_bounds_visible)
+        self._teardown_time += time.time() - start
+
+        newcells = [key for key in wanted if key not in self._gridcells]
+        self._ncells_planned = len(newcells)
+        if self.p_genmode == "SdfSphere":
+            self.PrepareMaterials()
+        yield 0
+        try:
+            for key in newcells:
+                (ix, iy, iz) = key
+                primpath = f"/World/SphereFlake_{ix}_{iy}_{iz}"
+                cpt = wanted[key]
+                self.GenerateCell(primpath, cpt, extentvec)
+                self._gridcells[key] = (primpath, cpt, varkey)
+                yield 1
+        finally:
+            self._createlist = [primpath for (primpath, _, _) in self._gridcells.values()]
+            self._bbcubelist = [primpath+"/bounds" for primpath in self._createlist]
+        nkeep = len(wanted) - len(newcells)
+        print(f"GenerateManyIncremental: added:{len(newcells)} moved:{nmove} kept:{nkeep} dropped:{ndrop}")
+        return self._count + len(wanted)
+
+    def DropGridCells(self):
+        # the cells of an earlier incremental run are named without the grid size, nothing else would replace them
+        self.RemoveRoots([primpath for (primpath, _, _) in self._gridcells.values()], deferred=False)
+        self._gridcells = {}
+
+    def DropMergeChunks(self):
+        # merged meshes and instancers are numbered per run, a smaller grid or another genmode would leave them behind
+        self.RemoveRoots(self._mergeroots, deferred=False)
+        self._mergeroots = []
+
+    def GenerateManyIncremental(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int) -> int:
+        return self.RunCells(self.IterGenerateManyIncremental(sx, sy, sz, nx, ny, nz))
 
-    def GenerateManySubcube(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int) -> int:
+    def GenerateManySubcube(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int, flush: bool = True) -> int:
+        return self.RunCells(self.IterGenerateManySubcube(sx, sy, sz, nx, ny, nz, flush))
+
+    def IterGenerateManySubcube(self, sx: int, sy: int, sz: int, nx: int, ny: int, nz: int, flush: bool = True):
         self.GenPrep()
         cpt = Gf.Vec3f(0, self.p_rad, 0)
         # extentvec = self.GetFlakeExtent(depth, self._rad, self._radratio)
         extentvec = self.GetSphereFlakeBoundingBox()
         count = self._count
 
-        for iix in range(nx):
-            for iiy in range(ny):
-                for iiz in range(nz):
-                    ix = iix+sx
-                    iy = iiy+sy
-                    iz = iiz+sz
-                    count += 1
-                    # primpath = f"/World/SphereFlake_{count}"
-                    primpath = f"/World/SphereFlake_{ix}_{iy}_{iz}__{nx}_{ny}_{nz}"
+        # the old cells go in one batch up front, except the ones that can be updated in place
+        cellpaths = [self.GetCellPath(ix, iy, iz)
+                     for ix in range(sx, sx+nx) for iy in range(sy, sy+ny) for iz in range(sz, sz+nz)]
+        if not self.p_instanceable:
+            cellpaths = [p for p in cellpaths if not self.CanUpdateInPlace(p, self.p_sf_matname)]
+        self.RemoveRoots(cellpaths, deferred=False)
 
-                    cpt = self.GetCenterPosition(ix, iy, iz, extentvec)
+        self._ncells_planned = nx*ny*nz
+        if self.p_genmode == "SdfSphere":
+            self.PrepareMaterials()
+        yield 0
+        try:
+            for iix in range(nx):
+                for iiy in range(ny):
+                    for iiz in range(nz):
+                        ix = iix+sx
+                        iy = iiy+sy
+                        iz = iiz+sz
+                        count += 1
+                        # primpath = f"/World/SphereFlake_{count}"
+                        primpath = self.GetCellPath(ix, iy, iz)
 
-                    self.Generate(primpath, cpt)
-                    self._createlist.append(primpath)
-                    bnd_cubepath = primpath+"/bounds"
-                    bnd_cube = self.SpawnBBcube(bnd_cubepath, cpt, extentvec, self.p_bb_matname)
-                    self._bbcubelist.append(bnd_cubepath)
-                    if self.p_make_bounds_visible:
-                        UsdGeom.Imageable(bnd_cube).MakeVisible()
-                    else:
-                        UsdGeom.Imageable(bnd_cube).MakeInvisible()
+                        cpt = self.GetCenterPosition(ix, iy, iz, extentvec)
+
+                        self.GenerateCell(primpath, cpt, extentvec)
+                        self._createlist.append(primpath)
+                        self._bbcubelist.append(primpath+"/bounds")
+                        yield 1
+        finally:
+            if flush:
+                with self.PhaseTimer("author"):
+                    self.FlushMergeChunk()
         return count
 
+    def RemoveRoots(self, primpaths: list, deferred: bool = None) -> int:
+        # Bulk teardown of generated roots in one change block, the stage only recomposes once.
+        # Deferred just deactivates the roots, which takes them off the stage right away,
+        # and leaves deleting their specs to FinishDeferredRemoval a few roots per frame.
+        if deferred is None:
+            deferred = self.p_deferred_removal
+        start = time.time()
+        layer = self.GetTargetLayer()
+        sdfa = SdfAuthor(layer)
+        nroots = 0
+        with Sdf.ChangeBlock():
+            for primpath in primpaths:
+                spec = layer.GetPrimAtPath(primpath)
+                if spec is None:
+                    continue
+                if deferred:
+                    spec.active = False
+                    self._deferred.append(str(primpath))
+                else:
+                    sdfa.RemovePrim(primpath)
+                nroots += 1
+        self._teardown_time += time.time() - start
+        if len(self._deferred) > 0 and not self._deferred_running:
+            asyncio.ensure_future(self.FinishDeferredRemoval())
+        return nroots
+
+    async def FinishDeferredRemoval(self, batch: int = 8):
+        self._deferred_running = True
+        try:
+            while len(self._deferred) > 0:
+                await omni.kit.app.get_app().next_update_async()
+                primpaths = self._deferred[:batch]
+                del self._deferred[:batch]
+                layer = self.GetTargetLayer()
+                sdfa = SdfAuthor(layer)
+                with Sdf.ChangeBlock():
+                    for primpath in primpaths:
+                        spec = layer.GetPrimAtPath(primpath)
+                        # anything regenerated at the same path in the meantime is active again and stays
+                        if spec is not None and not spec.active:
+                            sdfa.RemovePrim(primpath)
+        finally:
+            self._deferred_running = False
+
+    @traced()
+    def GenerateCell(self, primpath: str, cpt: Gf.Vec3f, extentvec: Gf.Vec3f):
+        # one grid cell, the flake with its bounds cube as a child of the cell root
+        with self.PhaseTimer("author"):
+            if self.p_genmode in ["MergedMesh", "PointInstancer"] and self.GetMergeChunk() > 1:
+                self.AddToMergeChunk(primpath, cpt)
+            elif self.p_instanceable:
+                self.GenerateInstance(primpath, cpt)
+            else:
+                self.Generate(primpath, cpt)
+        with self.PhaseTimer("bounds"):
+            bnd_cubepath = primpath+"/bounds"
+            if self.p_genmode == "SdfSphere":
+                self.SpawnBBcubeSdf(bnd_cubepath, cpt, extentvec, self.p_bb_matname, self.p_make_bounds_visible)
+            else:
+                bnd_cube = self.SpawnBBcube(bnd_cubepath, cpt, extentvec, self.p_bb_matname)
+                if self.p_make_bounds_visible:
+                    UsdGeom.Imageable(bnd_cube).MakeVisible()
+                else:
+                    UsdGeom.Imageable(bnd_cube).MakeInvisible()
+
+    def GetVariantKey(self, matname: str) -> tuple:
+        # everything that changes the content of a flake, but not where it is
+        return (self.p_genmode, self.p_genform, self.p_depth, self.p_rad, self.p_radratio,
+                self._smf.p_nlat, self._smf.p_nlng, self._smf.p_tess_mode, self._smf.p_tess_levels,
+                self._smf.p_tess_edge, self._smf.p_precision, self.p_instancer_proto, self.p_instanceable,
+                self.p_bind_mode, self.p_sf_alt_matname, self.p_bb_matname, matname)
+
+    def GetPrototypePath(self, matname: str) -> str:
+        # one prototype per distinct flake variant, the name hashes everything that changes its content
+        key = self.GetVariantKey(matname)
+        khash = hashlib.md5(repr(key).encode()).hexdigest()[:12]
+        return f"/World/SphereFlake_prototypes/Proto_{matname}_{khash}"
+
+    def EnsurePrototype(self, matname: str) -> str:
+        protopath = self.GetPrototypePath(matname)
+        if protopath in self._protos:
+            return protopath
+        layer = self.GetTargetLayer()
+        if layer.GetPrimAtPath(protopath) is None:
+            # authored at the origin, the instances carry the translation
+            self.Generate(protopath, Gf.Vec3f(0, 0, 0))
+            # a class is never rendered itself, only through the instances that reference it
+            layer.GetPrimAtPath(protopath).specifier = Sdf.SpecifierClass
+        self._protos[protopath] = matname
+        return protopath
+
+    def GenerateInstance(self, sphflkname: str, cenpt: Gf.Vec3f):
+        # the cell root stays a normal prim so the bounds cube can live next to the instance
+        protopath = self.EnsurePrototype(self.p_sf_matname)
+        sdfa = SdfAuthor(self.GetTargetLayer())
+        # the root no longer holds a flake that could be updated in place
+        self._flakes.pop(sphflkname, None)
+        with Sdf.ChangeBlock():
+            sdfa.RemovePrim(sphflkname)
+            root = sdfa.EnsureDefined(sphflkname)
+            root.typeName = "Xform"
+            sdfa.SetXformOps(root, (0, 0, 0))
+            sdfa.DefineInstance(sphflkname + "/Flake", cenpt, protopath)
+
+    def AddToMergeChunk(self, sphflkname: str, cenpt: Gf.Vec3f):
+        # the cell keeps its own root (for the bounds cube), its spheres go into the shared chunk mesh
+        self._flakes.pop(sphflkname, None)
+        ovut.delete_if_exists(sphflkname)
+        stage = omni.usd.get_context().get_stage()
+        UsdGeom.Xform.Define(stage, sphflkname)
+        layout = GetLayout(self.p_genform, self.p_depth, self.p_rad, self.p_radratio)
+        # the materials of this flake and a per sphere index into them, PerLevel alternates them by depth
+        if self.p_bind_mode == "PerLevel":
+            levelmats = [self.GetLevelMatName(0), self.GetLevelMatName(1)]
+            levelidx = (layout.depths % 2).astype(np.int32)
+        else:
+            levelmats = [self.p_sf_matname]
+            levelidx = np.zeros(layout.nnodes, dtype=np.int32)
+        self._mergechunk.append((layout.GetCenters(cenpt, np.float32), layout.radii, levelmats, levelidx))
+        if len(self._mergechunk) >= self.GetMergeChunk():
+            self.FlushMergeChunk()
+
+    def FlushMergeChunk(self):
+        if len(self._mergechunk) == 0:
+            return
+        matnames = []
+        matidx = []
+        for (_, _, levelmats, levelidx) in self._mergechunk:
+            for matname in levelmats:
+                if matname not in matnames:
+                    matnames.append(matname)
+            chunkidx = np.array([matnames.index(matname) for matname in levelmats], dtype=np.int32)
+            matidx.append(chunkidx[levelidx])
+        centers = np.concatenate([c for (c, _, _, _) in self._mergechunk])
+        radii = np.concatenate([r for (_, r, _, _) in self._mergechunk])
+        matidx = np.concatenate(matidx)
+        chunktype = "instancer" if self.p_genmode == "PointInstancer" else "merged"
+        chunkname = f"/World/SphereFlake_{chunktype}_{self._nmergechunks}"
+        ovut.delete_if_exists(chunkname)
+        stage = omni.usd.get_context().get_stage()
+        UsdGeom.Xform.Define(stage, chunkname)
+        if self.p_genmode == "PointInstancer":
+            self.CreatePointInstancer(chunkname + "/PointInstancer", matnames, centers, radii, matidx)
+        else:
+            self._smf.CreateMergedMesh(chunkname + "/MergedMesh", matnames, centers, radii, matidx)
+        self._createlist.append(chunkname)
+        self._mergeroots.append(chunkname)
+        self._nmergechunks += 1
+        self._mergechunk = []
+
     def ToggleBoundsVisiblity(self):
         # print(f"ToggleBoundsVisiblity: {self._bbcubelist}")
         okc.execute('ToggleVisibilitySelectedPrims', selected_paths=self._bbcubelist)
 
+    @traced()
     def Generate(self, sphflkname: str, cenpt: Gf.Vec3f):
 
         global latest_sf_gen_time
@@ -338,23 +1224,212 @@ class SphereFlakeFactory():
         self._total_quads = 0
 
         self._nring = 8
-        ovut.delete_if_exists(sphflkname)
-
-        stage = omni.usd.get_context().get_stage()
-        xformPrim = UsdGeom.Xform.Define(stage, sphflkname)
-        UsdGeom.XformCommonAPI(xformPrim).SetTranslate((0, 0, 0))
-        UsdGeom.XformCommonAPI(xformPrim).SetRotate((0, 0, 0))
-
-        mxdepth = self.p_depth
-        basept = cenpt
         matname = self.p_sf_matname
-        self.GenRecursively(sphflkname, matname, mxdepth, self.p_depth, basept, cenpt, self.p_rad)
+        with self.PhaseTimer("layout"):
+            layout = GetLayout(self.p_genform, self.p_depth, self.p_rad, self.p_radratio)
+
+        with self.PhaseTimer("author"):
+            if self.CanUseFlakeCache():
+                self.GenerateCached(sphflkname, matname, layout, cenpt)
+            else:
+                self.AuthorFlake(sphflkname, matname, layout, cenpt)
 
         elap = time.time() - self._start_time
         # print(f"GenerateSF {sphflkname} {matname} {depth} {cenpt} totquads:{self._total_quads} in {elap:.3f} secs")
 
         latest_sf_gen_time = elap
 
+    def AuthorFlake(self, sphflkname: str, matname: str, layout, cenpt: Gf.Vec3f):
+        # the flake itself, every sphere authored with the current genmode
+        if self.CanUpdateInPlace(sphflkname, matname):
+            self.UpdateInPlace(sphflkname, layout, cenpt)
+        elif self.p_genmode == "SdfSphere":
+            self.GenerateSdf(sphflkname, matname, layout, cenpt)
+        else:
+            ovut.delete_if_exists(sphflkname)
+
+            stage = omni.usd.get_context().get_stage()
+            xformPrim = UsdGeom.Xform.Define(stage, sphflkname)
+            UsdGeom.XformCommonAPI(xformPrim).SetTranslate((0, 0, 0))
+            UsdGeom.XformCommonAPI(xformPrim).SetRotate((0, 0, 0))
+
+            # PerLevel alternates the material by depth, as subsets of the merged mesh or instancer prototypes
+            if self.p_bind_mode == "PerLevel":
+                levelmats = [self.GetLevelMatName(0), self.GetLevelMatName(1)]
+                levelidx = (layout.depths % 2).astype(np.int32)
+            else:
+                levelmats = [matname]
+                levelidx = None
+            if self.p_genmode == "MergedMesh":
+                centers = layout.GetCenters(cenpt, np.float32)
+                meshmats = [None] if self.p_bind_mode == "FlakeRoot" else levelmats
+                self._smf.CreateMergedMesh(sphflkname + "/MergedMesh", meshmats, centers, layout.radii, levelidx)
+                if self.p_bind_mode == "FlakeRoot":
+                    self.BindFlakeRoot(sphflkname, layout, matname)
+            elif self.p_genmode == "PointInstancer":
+                centers = layout.GetCenters(cenpt, np.float32)
+                self.CreatePointInstancer(sphflkname + "/PointInstancer", levelmats, centers, layout.radii,
+                                          levelidx)
+            else:
+                centers = layout.GetCenters(cenpt)
+                radii = layout.radii
+                depths = layout.depths
+                paths = layout.GetNodePaths(sphflkname)
+                spheremat = matname if self.p_bind_mode == "PerSphere" else None
+                for i in range(layout.nnodes):
+                    (x, y, z) = centers[i]
+                    self.GenSphere(paths[i], spheremat, Gf.Vec3f(x, y, z), float(radii[i]), int(depths[i]))
+                self.BindFlakeRoot(sphflkname, layout, matname)
+        self._flakes[sphflkname] = self.GetTopologyKey(matname)
+
+    def GetFlakeCache(self) -> FlakeCache:
+        if self._flakecache is None:
+            cachedir = self.p_flake_cache_dir if self.p_flake_cache_dir != "" else GetDefaultFlakeCacheDir()
+            self._flakecache = FlakeCache(cachedir, int(self.p_flake_cache_mb*1024*1024))
+        return self._flakecache
+
+    def CanUseFlakeCache(self) -> bool:
+        # AsyncMesh builds its meshes after Generate returns, OmniSphere goes through Kit commands
+        return self.p_flake_cache and self.p_genmode in ["UsdSphere", "SdfSphere", "DirectMesh", "MergedMesh",
+                                                         "PointInstancer"]
+
+    def GetFlakeCacheStats(self) -> tuple:
+        if self._flakecache is None:
+            return (0, 0)
+        return (self._flakecache.hitCount, self._flakecache.missCount)
+
+    def GenerateCached(self, sphflkname: str, matname: str, layout, cenpt: Gf.Vec3f):
+        # The flake comes from its .usdc in the flake cache, authored there at the origin the first time it is asked
+        # for. The cell root stays a normal prim at the origin (for the bounds cube), the reference is its Flake child.
+        cache = self.GetFlakeCache()
+        key = cache.GetKey(self.GetVariantKey(matname))
+        path = cache.Lookup(key)
+        layer = self.GetTargetLayer()
+        sdfa = SdfAuthor(layer)
+        if path is None:
+            buildpath = f"/World/SphereFlake_cachebuild/Flake_{key}"
+            # the bindings of the build do not count, the ones authored on the reference below do
+            bindstats = (self._nbindrels, self._bindtime, self._smf.nbindrels, self._smf.bindtime)
+            self.AuthorFlake(buildpath, matname, layout, Gf.Vec3f(0, 0, 0))
+            path = cache.Store(key, layer, buildpath)
+            (self._nbindrels, self._bindtime, self._smf.nbindrels, self._smf.bindtime) = bindstats
+            self._flakes.pop(buildpath, None)
+            sdfa.RemovePrim("/World/SphereFlake_cachebuild")
+            if path is None:
+                self.AuthorFlake(sphflkname, matname, layout, cenpt)
+                return
+        self.PrepareMaterials()
+        self._flakes.pop(sphflkname, None)
+        with Sdf.ChangeBlock():
+            sdfa.RemovePrim(sphflkname)
+            root = sdfa.EnsureDefined(sphflkname)
+            root.typeName = "Xform"
+            sdfa.SetXformOps(root, (0, 0, 0))
+            sdfa.DefineReference(sphflkname + "/Flake", cenpt, path)
+            sdfa.OverrideRelationships(sphflkname + "/Flake", FLAKE_ROOT, cache.GetBindings(key))
+            self.CollectBindStats(sdfa)
+
+    @traced()
+    def CreatePointInstancer(self, name: str, matnames: list, centers: np.ndarray, radii: np.ndarray,
+                             protoidx: np.ndarray = None):
+        # one unit sphere prototype per material, every sphere is just a position and a uniform scale
+        stage = omni.usd.get_context().get_stage()
+        instancer = UsdGeom.PointInstancer.Define(stage, name)
+        protopaths = []
+        for imat, matname in enumerate(matnames):
+            protopath = f"{name}/Prototypes/Proto_{imat}"
+            if self.p_instancer_proto == "Mesh":
+                self._smf.CreateMesh(protopath, matname, Gf.Vec3f(0, 0, 0), 1.0)
+            else:
+                proto = UsdGeom.Sphere.Define(stage, protopath)
+                proto.CreateRadiusAttr(1.0)
+                self.BindMaterial(proto.GetPrim(), matname)
+            protopaths.append(protopath)
+        instancer.CreatePrototypesRel().SetTargets(protopaths)
+
+        nsph = len(radii)
+        radii = np.asarray(radii, dtype=np.float32)
+        centers = np.ascontiguousarray(centers, dtype=np.float32)
+        scales = np.repeat(radii[:, None], 3, axis=1)
+        if protoidx is None:
+            protoidx = np.zeros(nsph, dtype=np.int32)
+        instancer.CreatePositionsAttr(Vt.Vec3fArray.FromNumpy(centers))
+        instancer.CreateScalesAttr(Vt.Vec3fArray.FromNumpy(scales))
+        instancer.CreateProtoIndicesAttr(Vt.IntArray.FromNumpy(np.asarray(protoidx, dtype=np.int32)))
+        instancer.CreateExtentAttr(CalcSphereExtent(centers, radii))
+        return instancer
+
+    def GetTopologyKey(self, matname: str) -> tuple:
+        # everything that changes which prims a flake has, rad/radratio/cenpt only change their values
+        return (self.p_genmode, self.p_genform, self.p_depth, self._smf.p_nlat, self._smf.p_nlng,
+                self._smf.p_tess_mode, self._smf.p_tess_levels, self._smf.p_precision, self.p_instancer_proto,
+                self.p_bind_mode, self.p_sf_alt_matname, matname)
+
+    def CanUpdateInPlace(self, sphflkname: str, matname: str) -> bool:
+        # OmniSphere goes through Kit commands, EdgeLength tessellation changes with the radius
+        if self.p_genmode not in ["UsdSphere", "SdfSphere", "DirectMesh", "AsyncMesh", "MergedMesh", "PointInstancer"]:
+            return False
+        if self.p_genmode in ["DirectMesh", "AsyncMesh"] and self._smf.p_tess_mode == "EdgeLength":
+            return False
+        if self._flakes.get(sphflkname) != self.GetTopologyKey(matname) or self._smf.HasQueuedMeshes():
+            return False
+        # a root deactivated by a deferred removal is on its way out
+        spec = self.GetTargetLayer().GetPrimAtPath(sphflkname)
+        return spec is not None and spec.active
+
+    def UpdateInPlace(self, sphflkname: str, layout, cenpt: Gf.Vec3f):
+        # same prims as the last Generate of this flake, only the values that depend on the geometry are rewritten
+        layer = self.GetTargetLayer()
+        sdfa = SdfAuthor(layer)
+        radii = layout.radii
+        with Sdf.ChangeBlock():
+            # an incremental grid may have moved the root, the new values are absolute again
+            sdfa.SetTranslate(layer.GetPrimAtPath(sphflkname), (0, 0, 0))
+            if self.p_genmode == "MergedMesh":
+                centers = layout.GetCenters(cenpt, np.float32)
+                self._smf.UpdateMergedMesh(layer, sphflkname + "/MergedMesh", centers, radii)
+            elif self.p_genmode == "PointInstancer":
+                centers = layout.GetCenters(cenpt, np.float32)
+                name = sphflkname + "/PointInstancer"
+                scales = np.ascontiguousarray(np.repeat(radii[:, None], 3, axis=1), dtype=np.float32)
+                layer.GetAttributeAtPath(name + ".positions").default = Vt.Vec3fArray.FromNumpy(centers)
+                layer.GetAttributeAtPath(name + ".scales").default = Vt.Vec3fArray.FromNumpy(scales)
+                layer.GetAttributeAtPath(name + ".extent").default = CalcSphereExtent(centers, radii)
+            else:
+                # GenSphere gets its centers as Gf.Vec3f, only the Sdf path authors them at full precision
+                centers = layout.GetCenters(cenpt, np.float64 if self.p_genmode == "SdfSphere" else np.float32)
+                depths = layout.depths
+                paths = layout.GetNodePaths(sphflkname)
+                if self.p_genmode in ["DirectMesh", "AsyncMesh"]:
+                    meshname = "/SphereMeshAsync" if self.p_genmode == "AsyncMesh" else "/SphereMesh"
+                    for i in range(layout.nnodes):
+                        self._smf.UpdateMeshPoints(layer, paths[i] + meshname, centers[i], float(radii[i]),
+                                                   int(depths[i]))
+                else:
+                    spherename = "/SdfSphere" if self.p_genmode == "SdfSphere" else "/UsdSphere"
+                    centers = centers.tolist()
+                    radii = radii.tolist()
+                    for i in range(layout.nnodes):
+                        spec = layer.GetPrimAtPath(paths[i] + spherename)
+                        rad = radii[i]
+                        sdfa.SetTranslate(spec, centers[i])
+                        sdfa.SetScale(spec, (rad, rad, rad))
+
+    @traced()
+    def GenerateSdf(self, sphflkname: str, matname: str, layout, cenpt: Gf.Vec3f):
+        # writes the whole flake into the edit target layer, the stage only sees one change notice
+        mtlpath = self.GetMaterialPath(matname)
+        if self.p_bind_mode == "PerLevel":
+            self.GetMaterialPath(self.p_sf_alt_matname)
+        spheremtl = mtlpath if self.p_bind_mode == "PerSphere" else None
+        sdfa = SdfAuthor(self.GetTargetLayer())
+        with Sdf.ChangeBlock():
+            sdfa.RemovePrim(sphflkname)
+            sdfa.DefineSphereFlake(sphflkname, layout, cenpt, spheremtl)
+            self.CollectBindStats(sdfa)
+            self.BindFlakeRoot(sphflkname, layout, matname)
+
+    @traced()
     def GenRecursively(self, sphflkname: str, matname: str, mxdepth: int, depth: int, basept: Gf.Vec3f,
                        cenpt: Gf.Vec3f, rad: float):
 
@@ -362,16 +1437,40 @@ class SphereFlakeFactory():
         # UsdGeom.XformCommonAPI(xformPrim).SetTranslate((0, 0, 0))
         # UsdGeom.XformCommonAPI(xformPrim).SetRotate((0, 0, 0))
 
+        self.GenSphere(sphflkname, matname, cenpt, rad, mxdepth-depth)
+
+        if depth > 0:
+            form = self.p_genform
+            if form == "Classic":
+                thoff = 0
+                phioff = -20*math.pi/180
+                self._nring = 6
+                self.GenRing(sphflkname, "r1", matname, mxdepth, depth, basept, cenpt, 6, rad, thoff, phioff)
+
+                thoff = 30*math.pi/180
+                phioff = 55*math.pi/180
+                self._nring = 3
+                self.GenRing(sphflkname, "r2", matname, mxdepth, depth, basept, cenpt, 3, rad, thoff, phioff)
+            else:
+                thoff = 0
+                phioff = 0
+                self._nring = 8
+                self.GenRing(sphflkname, "r1", matname, mxdepth, depth, basept, cenpt, self._nring, rad, thoff, phioff)
+
+    @traced()
+    def GenSphere(self, sphflkname: str, matname: str, cenpt: Gf.Vec3f, rad: float, level: int = 0):
+        # authors the single sphere of one tree node with the current genmode, level is its depth in the flake
+
         meshname = sphflkname + "/SphereMesh"
 
         # spheremesh = UsdGeom.Mesh.Define(self._stage, meshname)
 
         if self.p_genmode == "AsyncMesh":
             meshname = sphflkname + "/SphereMeshAsync"
-            asyncio.ensure_future(self._smf.CreateMeshAsync(meshname, matname, cenpt,  rad))
+            self._smf.QueueMesh(meshname, matname, cenpt,  rad, level)
         elif self.p_genmode == "DirectMesh":
             meshname = sphflkname + "/SphereMesh"
-            self._smf.CreateMesh(meshname, matname, cenpt,  rad)
+            self._smf.CreateMesh(meshname, matname, cenpt,  rad, level)
         elif self.p_genmode == "OmniSphere":
             meshname = sphflkname + "/OmniSphere"
             okc.execute('CreateMeshPrimWithDefaultXform',	prim_type="Sphere", prim_path=meshname)
@@ -381,10 +1480,10 @@ class SphereFlakeFactory():
                         paths=[meshname],
                         new_scales=[sz, sz, sz],
                         new_translations=[cenpt[0], cenpt[1], cenpt[2]])
-            mtl = self._matman.GetMaterial(matname)
-            stage = omni.usd.get_context().get_stage()
-            prim: Usd.Prim = stage.GetPrimAtPath(meshname)
-            UsdShade.MaterialBindingAPI(prim).Bind(mtl)
+            if matname is not None:
+                stage = omni.usd.get_context().get_stage()
+                prim: Usd.Prim = stage.GetPrimAtPath(meshname)
+                self.BindMaterial(prim, matname)
         elif self.p_genmode == "UsdSphere":
             meshname = sphflkname + "/UsdSphere"
             stage = omni.usd.get_context().get_stage()
@@ -393,27 +1492,10 @@ class SphereFlakeFactory():
             UsdGeom.XformCommonAPI(xformPrim).SetTranslate((cenpt[0], cenpt[1], cenpt[2]))
             UsdGeom.XformCommonAPI(xformPrim).SetScale((sz, sz, sz))
             spheremesh = UsdGeom.Sphere.Define(stage, meshname)
-            mtl = self._matman.GetMaterial(matname)
-            UsdShade.MaterialBindingAPI(spheremesh).Bind(mtl)
-
-        if depth > 0:
-            form = self.p_genform
-            if form == "Classic":
-                thoff = 0
-                phioff = -20*math.pi/180
-                self._nring = 6
-                self.GenRing(sphflkname, "r1", matname, mxdepth, depth, basept, cenpt, 6, rad, thoff, phioff)
-
-                thoff = 30*math.pi/180
-                phioff = 55*math.pi/180
-                self._nring = 3
-                self.GenRing(sphflkname, "r2", matname, mxdepth, depth, basept, cenpt, 3, rad, thoff, phioff)
-            else:
-                thoff = 0
-                phioff = 0
-                self._nring = 8
-                self.GenRing(sphflkname, "r1", matname, mxdepth, depth, basept, cenpt, self._nring, rad, thoff, phioff)
+            if matname is not None:
+                self.BindMaterial(spheremesh.GetPrim(), matname)
 
+    @traced()
     def GenRing(self, sphflkname: str, ringname: str, matname: str, mxdepth: int, depth: int,
                 basept: Gf.Vec3f, cenpt: Gf.Vec3f,
                 nring: int, rad: float,
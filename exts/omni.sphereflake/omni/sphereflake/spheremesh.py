@@ -1,9 +1,14 @@
 import omni.kit.commands as okc
 import omni.usd
 import math
+import functools
+import time
+import asyncio
+import concurrent.futures
 import numpy as np
 from pxr import Gf, Sdf, Usd, UsdGeom, UsdShade, Vt
-from .ovut import MatMan, delete_if_exists
+from .ovut import MatMan, delete_if_exists, get_setting, save_setting
+from .tracing import traced
 
 
 class SphereMeshFactoryV1():
@@ -118,6 +123,58 @@ class SphereMeshFactoryV1():
         return spheremesh
 
 
+class SphereTemplate():
+    # The unit sphere for one (nlat, nlng, polegap) - normals double as unit positions.
+    # Built once with broadcasting and shared read only by every mesh, including the
+    # topology already converted to Vt arrays so authoring does not convert it again.
+
+    def __init__(self, nlat: int, nlng: int, polegap: float) -> None:
+        self.nlat = nlat
+        self.nlng = nlng
+        self.polegap = polegap
+        self.nquads = nlat*nlng
+        self.nverts = (nlat+1)*nlng
+
+        i = np.arange(nlat, dtype=np.int32)[:, None]
+        j = np.arange(nlng, dtype=np.int32)[None, :]
+        jn = (j+1) % nlng
+        offset = i*nlng
+        vidxbuf = np.stack(np.broadcast_arrays(offset+j, offset+jn, offset+jn+nlng, offset+j+nlng), axis=-1)
+        self.vidxbuf = np.ascontiguousarray(vidxbuf.reshape(self.nquads, 4), dtype=np.int32)
+        self.facebuf = np.full((self.nquads, 1), 4, dtype=np.int32)
+
+        theta = polegap + np.arange(nlat+1)*(math.pi-2*polegap)/float(nlat)
+        phi = np.arange(nlng)*2*math.pi/float(nlng)
+        st = np.sin(theta)[:, None]
+        ct = np.cos(theta)[:, None]
+        normbuf = np.stack(np.broadcast_arrays(st*np.cos(phi)[None, :], ct, st*np.sin(phi)[None, :]), axis=-1)
+        self.normbuf = np.ascontiguousarray(normbuf.reshape(self.nverts, 3), dtype=np.float32)
+        self.txtrbuf = np.ascontiguousarray(self.normbuf[:, 0:2])
+
+        for arr in (self.vidxbuf, self.facebuf, self.normbuf, self.txtrbuf):
+            arr.flags.writeable = False
+
+        self.vt_facecounts = Vt.IntArray.FromNumpy(self.facebuf.reshape(-1))
+        self.vt_vidx = Vt.IntArray.FromNumpy(self.vidxbuf.reshape(-1))
+        self.vt_txtr = Vt.Vec2fArray.FromNumpy(self.txtrbuf)
+        self.vt_normals = Vt.Vec3dArray.FromNumpy(self.normbuf)
+        self.vt_normals_f = Vt.Vec3fArray.FromNumpy(self.normbuf)
+        self.vt_normals_h = Vt.Vec3hArray.FromNumpy(self.normbuf.astype(np.float16))
+
+
+def CalcSphereExtent(centers: np.ndarray, radii: np.ndarray) -> Vt.Vec3fArray:
+    radii = np.asarray(radii, dtype=np.float32)
+    centers = np.asarray(centers, dtype=np.float32)
+    lo = (centers - radii[:, None]).min(axis=0)
+    hi = (centers + radii[:, None]).max(axis=0)
+    return Vt.Vec3fArray([Gf.Vec3f(*lo.tolist()), Gf.Vec3f(*hi.tolist())])
+
+
+@functools.lru_cache(maxsize=16)
+def GetSphereTemplate(nlat: int, nlng: int, polegap: float = 0.01) -> SphereTemplate:
+    return SphereTemplate(int(nlat), int(nlng), float(polegap))
+
+
 class SphereMeshFactory():
 
     _show_normals = False
@@ -126,22 +183,115 @@ class SphereMeshFactory():
     p_nlng = 8
     _total_quads = 0
     _dotexcoords = True
+    _polegap = 0.01  # prevents the vertices from being exactly on the poles
+    _template: SphereTemplate = None
+    p_precision = "Double"
+    p_tess_mode = "Uniform"
+    p_tess_levels = "16,12,8,6,4"
+    p_tess_edge = 5.0
+    p_tess_max = 256
+    p_async_workers = 4
+    p_async_queue = 64
+    _asyncjobs: list = []
+    nbindrels = 0
+    bindtime = 0.0
 
     def __init__(self, matman: MatMan) -> None:
         self._matman = matman
+        self._asyncjobs = []
         # self._stage = omni.usd.get_context().get_stage()
 
+    def LoadSettings(self):
+        print("SphereMeshFactory.LoadSettings (trc)")
+        self.p_nlat = get_setting("p_nlat", self.p_nlat)
+        self.p_nlng = get_setting("p_nlng", self.p_nlng)
+        self.p_precision = get_setting("p_precision", self.p_precision)
+        self.p_tess_mode = get_setting("p_tess_mode", self.p_tess_mode)
+        self.p_tess_levels = get_setting("p_tess_levels", self.p_tess_levels)
+        self.p_tess_edge = get_setting("p_tess_edge", self.p_tess_edge)
+        self.p_async_workers = get_setting("p_async_workers", self.p_async_workers)
+        self.p_async_queue = get_setting("p_async_queue", self.p_async_queue)
+
+    def SaveSettings(self):
+        print("SphereMeshFactory.SaveSettings (trc)")
+        save_setting("p_nlat", self.p_nlat)
+        save_setting("p_nlng", self.p_nlng)
+        save_setting("p_precision", self.p_precision)
+        save_setting("p_tess_mode", self.p_tess_mode)
+        save_setting("p_tess_levels", self.p_tess_levels)
+        save_setting("p_tess_edge", self.p_tess_edge)
+        save_setting("p_async_workers", self.p_async_workers)
+        save_setting("p_async_queue", self.p_async_queue)
+
+    @staticmethod
+    def GetPrecisions():
+        # Double - legacy path, points and normals go through a double copy that Usd casts back to float
+        # Float  - float32 point3f[]/normal3f[] straight from the float32 buffers
+        # Half   - like Float but the normals are authored as a normal3h[] primvar
+        return ["Double", "Float", "Half"]
+
+    @staticmethod
+    def GetTessModes():
+        # Uniform    - every sphere uses p_nlat x p_nlng
+        # PerLevel   - p_tess_levels lists the (square) tessellation per depth level, the last entry repeats
+        # EdgeLength - pick nlat/nlng so the quad edges are about p_tess_edge long on every sphere
+        return ["Uniform", "PerLevel", "EdgeLength"]
+
+    def GetLevelTess(self, level: int, radius: float):
+        if self.p_tess_mode == "PerLevel":
+            levels = [int(v) for v in str(self.p_tess_levels).replace(" ", "").split(",") if v != ""]
+            if len(levels) > 0:
+                n = max(3, min(levels[min(level, len(levels)-1)], self.p_tess_max))
+                return n, n
+        elif self.p_tess_mode == "EdgeLength" and self.p_tess_edge > 0:
+            nlat = max(3, min(math.ceil(math.pi*radius/self.p_tess_edge), self.p_tess_max))
+            nlng = max(3, min(math.ceil(2*math.pi*radius/self.p_tess_edge), self.p_tess_max))
+            return nlat, nlng
+        return self.p_nlat, self.p_nlng
+
+    def GetLevelTemplate(self, level: int, radius: float) -> SphereTemplate:
+        # levels share the template cache, so a schedule costs one template per distinct level
+        (nlat, nlng) = self.GetLevelTess(level, radius)
+        return GetSphereTemplate(nlat, nlng, self._polegap)
+
     def GenPrep(self):
-        self._nquads = self.p_nlat*self.p_nlng
-        self._nverts = (self.p_nlat+1)*(self.p_nlng)
-        self._normbuf = np.zeros((self._nverts, 3), dtype=np.float32)
-        self._txtrbuf = np.zeros((self._nverts, 2), dtype=np.float32)
-        self._facebuf = np.zeros((self._nquads, 1), dtype=np.int32)
-        self._vidxbuf = np.zeros((self._nquads, 4), dtype=np.int32)
         self.MakeArrays()
 
+    def MakeVertBuf(self, cenpt: Gf.Vec3f, radius: float, tmpl: SphereTemplate = None) -> np.ndarray:
+        normbuf = self._normbuf if tmpl is None else tmpl.normbuf
+        if self.p_precision == "Double":
+            return normbuf*radius + cenpt
+        # float32 throughout, one allocation and the center added in place
+        vertbuf = np.multiply(normbuf, np.float32(radius))
+        vertbuf += np.asarray(cenpt, dtype=np.float32)
+        return vertbuf
+
+    def SetPointsAndNormals(self, spheremesh: UsdGeom.Mesh, vertbuf: np.ndarray, normbuf: np.ndarray = None,
+                            tmpl: SphereTemplate = None):
+        # normbuf None means the single sphere normals of the template, which are shared and never copied
+        if tmpl is None:
+            tmpl = self._template
+        if self.p_precision == "Double":
+            spheremesh.CreatePointsAttr(Vt.Vec3dArray.FromNumpy(vertbuf))
+            vtnorm = tmpl.vt_normals if normbuf is None else Vt.Vec3dArray.FromNumpy(normbuf)
+            spheremesh.CreateNormalsAttr(vtnorm)
+            return
+        spheremesh.CreatePointsAttr(Vt.Vec3fArray.FromNumpy(np.ascontiguousarray(vertbuf, dtype=np.float32)))
+        if self.p_precision == "Half":
+            if normbuf is None:
+                vtnorm = tmpl.vt_normals_h
+            else:
+                vtnorm = Vt.Vec3hArray.FromNumpy(normbuf.astype(np.float16, copy=False))
+            normals = UsdGeom.PrimvarsAPI(spheremesh).CreatePrimvar("normals",
+                                                                    Sdf.ValueTypeNames.Normal3hArray,
+                                                                    UsdGeom.Tokens.vertex)
+            normals.Set(vtnorm)
+        else:
+            vtnorm = tmpl.vt_normals_f if normbuf is None else Vt.Vec3fArray.FromNumpy(normbuf)
+            spheremesh.CreateNormalsAttr(vtnorm)
+
     def Clear(self):
-        pass
+        self._asyncjobs = []
 
     def MakeMarker(self, name: str, matname: str, cenpt: Gf.Vec3f, rad: float):
         # print(f"MakeMarker {name}  {cenpt} {rad}")
@@ -160,42 +310,15 @@ class SphereMeshFactory():
         UsdShade.MaterialBindingAPI(prim).Bind(mtl)
 
     def MakeArrays(self):
-        nlat = self.p_nlat
-        nlong = self.p_nlng
-        for i in range(nlat):
-            offset = i * nlong
-            for j in range(nlong):
-                if j < nlong - 1:
-                    i1 = offset+j
-                    i2 = offset+j+1
-                    i3 = offset+j+nlong+1
-                    i4 = offset+j+nlong
-                else:
-                    i1 = offset+j
-                    i2 = offset
-                    i3 = offset+nlong
-                    i4 = offset+j+nlong
-                vidx = i*nlong+j
-                self._facebuf[vidx] = 4
-                self._vidxbuf[vidx] = [i1, i2, i3, i4]
-
-        polegap = 0.01  # prevents the vertices from being exactly on the poles
-        for i in range(nlat+1):
-            theta = polegap + (i * (math.pi-2*polegap) / float(nlat))
-            st = math.sin(theta)
-            ct = math.cos(theta)
-            for j in range(nlong):
-                phi = j * 2 * math.pi / float(nlong)
-                sp = math.sin(phi)
-                cp = math.cos(phi)
-                nx = st*cp
-                ny = ct
-                nz = st*sp
-                nrmvek = Gf.Vec3f(nx, ny, nz)
-                vidx = i*nlong+j
-                self._normbuf[vidx] = nrmvek
-                self._txtrbuf[vidx] = (nx, ny)
-        #  print("MakeArrays done")
+        # the buffers are views of the cached template, only the first use of a tessellation builds them
+        tmpl = GetSphereTemplate(self.p_nlat, self.p_nlng, self._polegap)
+        self._template = tmpl
+        self._nquads = tmpl.nquads
+        self._nverts = tmpl.nverts
+        self._normbuf = tmpl.normbuf
+        self._txtrbuf = tmpl.txtrbuf
+        self._facebuf = tmpl.facebuf
+        self._vidxbuf = tmpl.vidxbuf
 
     def ShowNormals(self, vertbuf):
         nlat = self.p_nlat
@@ -212,16 +335,23 @@ class SphereMeshFactory():
                 self.MakeMarker(ptname, "red", pt, 1)
                 self.MakeMarker(nmname, "blue", npt, 1)
 
-    def CreateMesh(self, name: str, matname: str, cenpt: Gf.Vec3f, radius: float):
+    @traced()
+    def CreateMesh(self, name: str, matname: str, cenpt: Gf.Vec3f, radius: float, level: int = 0):
         # This will create nlat*nlog quads or twice that many triangles
         # it will need nlat+1 vertices in the latitude direction and nlong vertices in the longitude direction
         # so a total of (nlat+1)*(nlong) vertices
+        # level is the depth of the sphere in its flake, it only matters for the adaptive tessellation modes
 
-        stage = omni.usd.get_context().get_stage()
-        spheremesh = UsdGeom.Mesh.Define(stage, name)
+        tmpl = self.GetLevelTemplate(level, radius)
 
         # note that vertbuf is local to this function allowing it to be changed in a multithreaded environment
-        vertbuf = self._normbuf*radius + cenpt
+        vertbuf = self.MakeVertBuf(cenpt, radius, tmpl)
+        self.AuthorMesh(name, matname, vertbuf, tmpl)
+
+    def AuthorMesh(self, name: str, matname: str, vertbuf: np.ndarray, tmpl: SphereTemplate):
+        # the Usd side of CreateMesh, it has to run on the main thread
+        stage = omni.usd.get_context().get_stage()
+        spheremesh = UsdGeom.Mesh.Define(stage, name)
 
         if self._show_normals:
             self.ShowNormals(vertbuf)
@@ -230,56 +360,125 @@ class SphereMeshFactory():
             texCoords = UsdGeom.PrimvarsAPI(spheremesh).CreatePrimvar("st",
                                                                       Sdf.ValueTypeNames.TexCoord2fArray,
                                                                       UsdGeom.Tokens.varying)
-            texCoords.Set(Vt.Vec2fArray.FromNumpy(self._txtrbuf))
+            texCoords.Set(tmpl.vt_txtr)
 
-        spheremesh.CreatePointsAttr(Vt.Vec3dArray.FromNumpy(vertbuf))
-        spheremesh.CreateNormalsAttr(Vt.Vec3dArray.FromNumpy(self._normbuf))
-        spheremesh.CreateFaceVertexCountsAttr(Vt.IntArrayFromBuffer(self._facebuf))
-        spheremesh.CreateFaceVertexIndicesAttr(Vt.IntArrayFromBuffer(self._vidxbuf))
+        self.SetPointsAndNormals(spheremesh, vertbuf, tmpl=tmpl)
+        spheremesh.CreateFaceVertexCountsAttr(tmpl.vt_facecounts)
+        spheremesh.CreateFaceVertexIndicesAttr(tmpl.vt_vidx)
 
-        mtl = self._matman.GetMaterial(matname)
-        UsdShade.MaterialBindingAPI(spheremesh).Bind(mtl)
+        if matname is not None:
+            self.BindMaterial(spheremesh.GetPrim(), matname)
 
-        self._total_quads += self._nquads  # face vertex counts
-
-        return None
-
-    async def CreateVertBuf(self, radius, cenpt):
-        vertbuf = self._normbuf*radius + cenpt
-        return vertbuf
+        self._total_quads += tmpl.nquads  # face vertex counts
 
-    async def CreateStuff(self, spheremesh, vertbuf, normbuf, facebuf, vidxbuf):
-        spheremesh.CreatePointsAttr(Vt.Vec3dArray.FromNumpy(vertbuf))
-        spheremesh.CreateNormalsAttr(Vt.Vec3dArray.FromNumpy(normbuf))
-        spheremesh.CreateFaceVertexCountsAttr(Vt.IntArrayFromBuffer(facebuf))
-        spheremesh.CreateFaceVertexIndicesAttr(Vt.IntArrayFromBuffer(vidxbuf))
-        return
+    def BindMaterial(self, prim: Usd.Prim, matname: str):
+        # counts the binding relationships and the time they take for the run log
+        start = time.time()
+        mtl = self._matman.GetMaterial(matname)
+        UsdShade.MaterialBindingAPI(prim).Bind(mtl)
+        self.nbindrels += 1
+        self.bindtime += time.time() - start
 
-    async def CreateMeshAsync(self, name: str, matname: str, cenpt: Gf.Vec3f, radius: float):
-        # This will create nlat*nlog quads or twice that many triangles
-        # it will need nlat+1 vertices in the latitude direction and nlong vertices in the longitude direction
-        # so a total of (nlat+1)*(nlong) vertices
+    @traced()
+    def CreateMergedMesh(self, name: str, matnames: list, centers: np.ndarray, radii: np.ndarray,
+                         matidx: np.ndarray = None):
+        # Puts the transformed unit sphere of every (center, radius) into one mesh prim.
+        # matidx gives the index into matnames for each sphere, with more than one material
+        # the faces are split into GeomSubsets that each carry their own binding
 
         stage = omni.usd.get_context().get_stage()
         spheremesh = UsdGeom.Mesh.Define(stage, name)
 
-        # note that vertbuf is local to this function allowing it to be changed in a multithreaded environment
-        vertbuf = await self.CreateVertBuf(radius, cenpt)
-
-        if self._show_normals:
-            self.ShowNormals(vertbuf)
+        nsph = len(radii)
+        nverts = self._nverts
+        nquads = self._nquads
+        vertbuf = self.MakeMergedVertBuf(centers, radii)
+        unitnorm = self._normbuf.astype(np.float16) if self.p_precision == "Half" else self._normbuf
+        normbuf = np.tile(unitnorm, (nsph, 1))
+        facebuf = np.full(nsph*nquads, 4, dtype=np.int32)
+        # each sphere's indices are offset by the vertices of the spheres in front of it
+        vidxbuf = (self._vidxbuf[None, :, :] + (np.arange(nsph, dtype=np.int32)*nverts)[:, None, None]).reshape(-1)
 
         if self._dotexcoords:
             texCoords = UsdGeom.PrimvarsAPI(spheremesh).CreatePrimvar("st",
                                                                       Sdf.ValueTypeNames.TexCoord2fArray,
                                                                       UsdGeom.Tokens.varying)
-            texCoords.Set(Vt.Vec2fArray.FromNumpy(self._txtrbuf))
+            texCoords.Set(Vt.Vec2fArray.FromNumpy(np.tile(self._txtrbuf, (nsph, 1))))
+
+        self.SetPointsAndNormals(spheremesh, vertbuf, normbuf)
+        spheremesh.CreateFaceVertexCountsAttr(Vt.IntArray.FromNumpy(facebuf))
+        spheremesh.CreateFaceVertexIndicesAttr(Vt.IntArray.FromNumpy(vidxbuf))
+        spheremesh.CreateExtentAttr(CalcSphereExtent(centers, radii))
+
+        if matidx is None or len(matnames) == 1:
+            if matnames[0] is not None:
+                self.BindMaterial(spheremesh.GetPrim(), matnames[0])
+        else:
+            facemat = np.repeat(np.asarray(matidx), nquads)
+            for imat, matname in enumerate(matnames):
+                faces = np.nonzero(facemat == imat)[0].astype(np.int32)
+                if len(faces) == 0:
+                    continue
+                subset = UsdGeom.Subset.CreateGeomSubset(spheremesh, f"mat_{imat}", UsdGeom.Tokens.face,
+                                                         Vt.IntArray.FromNumpy(faces),
+                                                         UsdShade.Tokens.materialBind,
+                                                         UsdGeom.Tokens.nonOverlapping)
+                self.BindMaterial(subset.GetPrim(), matname)
+
+        self._total_quads += nsph*nquads
 
-        await self.CreateStuff(spheremesh, vertbuf, self._normbuf, self._facebuf, self._vidxbuf)
-
-        mtl = self._matman.GetMaterial(matname)
-        UsdShade.MaterialBindingAPI(spheremesh).Bind(mtl)
-
-        self._total_quads += self._nquads  # face vertex counts
+        return spheremesh
 
-        return None
+    def MakeMergedVertBuf(self, centers: np.ndarray, radii: np.ndarray) -> np.ndarray:
+        radii = np.asarray(radii, dtype=np.float32)
+        centers = np.asarray(centers, dtype=np.float32)
+        return (self._normbuf[None, :, :]*radii[:, None, None] + centers[:, None, :]).reshape(-1, 3)
+
+    def UpdateMeshPoints(self, layer: Sdf.Layer, name: str, cenpt: Gf.Vec3f, radius: float, level: int = 0):
+        # in-place update of a CreateMesh mesh, the topology and the (unit) normals stay as they are
+        vertbuf = self.MakeVertBuf(cenpt, radius, self.GetLevelTemplate(level, radius))
+        attr = layer.GetAttributeAtPath(name + ".points")
+        attr.default = Vt.Vec3fArray.FromNumpy(np.ascontiguousarray(vertbuf, dtype=np.float32))
+
+    def UpdateMergedMesh(self, layer: Sdf.Layer, name: str, centers: np.ndarray, radii: np.ndarray):
+        vertbuf = self.MakeMergedVertBuf(centers, radii)
+        layer.GetAttributeAtPath(name + ".points").default = Vt.Vec3fArray.FromNumpy(vertbuf)
+        layer.GetAttributeAtPath(name + ".extent").default = CalcSphereExtent(centers, radii)
+
+    def HasQueuedMeshes(self) -> bool:
+        return len(self._asyncjobs) > 0
+
+    def QueueMesh(self, name: str, matname: str, cenpt: Gf.Vec3f, radius: float, level: int = 0):
+        # AsyncMesh - nothing is authored yet, BuildQueuedMeshes has to be awaited to get the meshes
+        self._asyncjobs.append((name, matname, (cenpt[0], cenpt[1], cenpt[2]), radius, level))
+
+    async def BuildQueuedMeshes(self) -> int:
+        # Vertex buffers are computed on a thread pool (numpy releases the GIL for the heavy parts),
+        # the main thread authors them in order as they come out of a bounded queue.
+        # The queue bound keeps the producer from running far ahead and holding every buffer at once.
+        jobs = self._asyncjobs
+        self._asyncjobs = []
+        if len(jobs) == 0:
+            return 0
+        loop = asyncio.get_event_loop()
+        queue = asyncio.Queue(maxsize=max(1, self.p_async_queue))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, self.p_async_workers)) as pool:
+
+            async def produce():
+                for (name, matname, cenpt, radius, level) in jobs:
+                    tmpl = self.GetLevelTemplate(level, radius)
+                    fut = loop.run_in_executor(pool, self.MakeVertBuf, cenpt, radius, tmpl)
+                    await queue.put((name, matname, tmpl, fut))
+                await queue.put(None)
+
+            async def consume():
+                while True:
+                    item = await queue.get()
+                    if item is None:
+                        break
+                    (name, matname, tmpl, fut) = item
+                    vertbuf = await fut
+                    self.AuthorMesh(name, matname, vertbuf, tmpl)
+
+            await asyncio.gather(produce(), consume())
+        return len(jobs)
@@ -0,0 +1,87 @@
+import os
+import json
+import queue
+import threading
+
+# JSONL sink for the run records. Write() only queues the record, a writer thread batches the queued lines into the
+# file and rotates it (runs.jsonl -> runs.jsonl.1 -> ...) once it grows past maxbytes. Stdlib only, the UI, the
+# headless runner and the stage benchmarks all write through it.
+
+
+def GetDefaultLogPath() -> str:
+    return os.path.join(os.path.expanduser("~"), ".omni.sphereflake", "logs", "runs.jsonl")
+
+
+class TelemetrySink():
+    path: str = None
+    maxbytes: int = 0
+    backups: int = 0
+    nwritten: int = 0
+    ndropped: int = 0
+
+    def __init__(self, path: str, maxbytes: int = 16*1024*1024, backups: int = 5, flushsecs: float = 0.5):
+        # maxbytes 0 never rotates
+        self.path = path
+        self.maxbytes = maxbytes
+        self.backups = backups
+        self.flushsecs = flushsecs
+        self._queue = queue.SimpleQueue()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._error = None
+
+    def Write(self, record: dict):
+        # never blocks on the file, whatever thread calls it
+        self._queue.put(json.dumps(record, sort_keys=True))
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._Run, name="sf-telemetry", daemon=True)
+                self._thread.start()
+
+    def _Run(self):
+        while True:
+            lines = [self._queue.get()]
+            # gather what arrives within flushsecs into one write
+            try:
+                while len(lines) < 1024 and lines[-1] is not None:
+                    lines.append(self._queue.get(timeout=self.flushsecs))
+            except queue.Empty:
+                pass
+            done = lines[-1] is None
+            lines = [ln for ln in lines if ln is not None]
+            if len(lines) > 0:
+                self._WriteLines(lines)
+            if done:
+                return
+
+    def _WriteLines(self, lines: list):
+        try:
+            os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+            if self.maxbytes > 0 and os.path.isfile(self.path) and os.path.getsize(self.path) >= self.maxbytes:
+                self.Rotate()
+            with open(self.path, "a") as f:
+                f.write("".join(f"{ln}\n" for ln in lines))
+            self.nwritten += len(lines)
+        except OSError as e:
+            # a broken log path must not take the benchmark down, report it once and count what was lost
+            if self._error is None:
+                print(f"TelemetrySink - cannot write {self.path}: {e}")
+            self._error = e
+            self.ndropped += len(lines)
+
+    def Rotate(self):
+        for i in range(self.backups, 0, -1):
+            src = self.path if i == 1 else f"{self.path}.{i-1}"
+            if os.path.isfile(src):
+                os.replace(src, f"{self.path}.{i}")
+        if self.backups == 0:
+            os.remove(self.path)
+
+    def Close(self, timeout: float = 5.0):
+        # flushes everything queued so far and stops the writer, a later Write starts a new one
+        with self._lock:
+            thread = self._thread
+            self._thread = None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join(timeout)
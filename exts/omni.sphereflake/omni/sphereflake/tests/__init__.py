@@ -1 +1,7 @@
-from .test_hello_world import *
\ No newline at end of file
+from .test_hello_world import *
+from .test_sflayout import *
+from .test_generate import *
+from .test_runlog import *
+from .test_incremental import *
+from .test_flakecache import *
+from .test_export import *
@@ -0,0 +1,93 @@
+import omni.kit.test
+import os
+import tempfile
+from pxr import Usd, UsdGeom
+
+from .test_generate import NewFactories, DumpWorld, AssertSameWorld
+
+
+class TestExport(omni.kit.test.AsyncTestCase):
+
+    async def GenerateLive(self, genmode: str, grid: list, params: dict = {}) -> dict:
+        (stage, matman, smf, sff) = await NewFactories(genmode, grid=grid, params=params)
+        sff.GenerateMany()
+        return DumpWorld(stage)
+
+    async def test_export_matches_live(self):
+        # 3 chunks of 2 cells, written in this process and then again by worker processes while the first export
+        # is still open
+        with tempfile.TemporaryDirectory() as tmpdir:
+            filepath = os.path.join(tmpdir, "grid.usdc")
+            for (parallel, radratio) in [(False, 0.3), (True, 0.4)]:
+                params = {"p_export_chunk": 2, "p_parallelRender": parallel, "p_parallel_workers": 2,
+                          "p_radratio": radratio}
+                (stage, matman, smf, sff) = await NewFactories("SdfSphere", grid=[3, 1, 2], params=params)
+                res = await sff.ExportMany(filepath)
+                self.assertEqual((res["cells"], res["chunks"]), (6, 3))
+                # nothing but the materials goes into the live stage
+                self.assertEqual(len(DumpWorld(stage)), 0)
+                exported = Usd.Stage.Open(filepath)
+                live = await self.GenerateLive("SdfSphere", [3, 1, 2], {"p_radratio": radratio})
+                AssertSameWorld(self, DumpWorld(exported), live)
+
+            # a smaller export to the same file leaves none of the old chunks behind
+            (stage, matman, smf, sff) = await NewFactories("SdfSphere", grid=[1, 1, 2], params={"p_export_chunk": 2})
+            res = await sff.ExportMany(filepath)
+            self.assertEqual(os.listdir(sff.GetExportChunkDir(filepath)), ["chunk_00000.usdc"])
+            exported = Usd.Stage.Open(filepath)
+            AssertSameWorld(self, DumpWorld(exported), await self.GenerateLive("SdfSphere", [1, 1, 2]))
+
+    async def test_export_rejects_kit_modes(self):
+        (stage, matman, smf, sff) = await NewFactories("DirectMesh")
+        with tempfile.TemporaryDirectory() as tmpdir:
+            self.assertIsNone(await sff.ExportMany(os.path.join(tmpdir, "grid.usdc")))
+
+
+class TestPayloadCells(omni.kit.test.AsyncTestCase):
+
+    async def GeneratePayloads(self, payloaddir: str, grid: list, bindmode: str) -> tuple:
+        params = {"p_payload_cells": True, "p_payload_dir": payloaddir, "p_export_chunk": 2, "p_bind_mode": bindmode}
+        (stage, matman, smf, sff) = await NewFactories("SdfSphere", grid=grid, params=params)
+        sff.GenerateMany()
+        return (stage, sff)
+
+    def CountSpheres(self, stage) -> int:
+        return sum(1 for prim in stage.Traverse() if prim.IsA(UsdGeom.Sphere))
+
+    async def test_payload_cells_match_inline(self):
+        with tempfile.TemporaryDirectory() as payloaddir:
+            for bindmode in ["PerSphere", "FlakeRoot"]:
+                (stage, sff) = await self.GeneratePayloads(payloaddir, [3, 1, 2], bindmode)
+                (inline, matman, smf, sff) = await NewFactories("SdfSphere", grid=[3, 1, 2],
+                                                                params={"p_bind_mode": bindmode})
+                sff.GenerateMany()
+                AssertSameWorld(self, DumpWorld(stage), DumpWorld(inline))
+            # the content does not depend on the binding, the second run found its files already there
+            self.assertEqual(len(os.listdir(payloaddir)), 3)
+
+    async def test_load_unload(self):
+        with tempfile.TemporaryDirectory() as payloaddir:
+            (stage, sff) = await self.GeneratePayloads(payloaddir, [3, 1, 2], "PerSphere")
+            nspheres = sff.CalcSpheres()
+            self.assertEqual(self.CountSpheres(stage), 6*nspheres)
+            cellpath = sff.GetCellPaths(2, 0, 1, 1, 1, 1)[0]
+            bboxcache = UsdGeom.BBoxCache(Usd.TimeCode.Default(), ["default"], useExtentsHint=True)
+            loadedbox = bboxcache.ComputeWorldBound(stage.GetPrimAtPath(cellpath)).ComputeAlignedRange()
+
+            # unloaded, the cell roots and their bounds stay and the extentsHint still gives the cell's bounds
+            sff.UnloadCells()
+            self.assertEqual(self.CountSpheres(stage), 0)
+            self.assertTrue(all(stage.GetPrimAtPath(path).IsValid() for path in sff.GetCellPaths(0, 0, 0, 3, 1, 2)))
+            self.assertTrue(stage.GetPrimAtPath(cellpath.AppendChild("bounds")).IsValid())
+            bboxcache.Clear()
+            unloadedbox = bboxcache.ComputeWorldBound(stage.GetPrimAtPath(cellpath)).ComputeAlignedRange()
+            for i in range(3):
+                self.assertAlmostEqual(unloadedbox.GetMin()[i], loadedbox.GetMin()[i], places=2)
+                self.assertAlmostEqual(unloadedbox.GetMax()[i], loadedbox.GetMax()[i], places=2)
+
+            # a box of two cells, then just one of them with the rest unloaded
+            self.assertEqual(sff.LoadCells(1, 0, 0, 2, 1, 1), 2)
+            self.assertEqual(self.CountSpheres(stage), 2*nspheres)
+            self.assertEqual(sff.LoadCells(2, 0, 1, 1, 1, 1, unloadrest=True), 1)
+            self.assertEqual(self.CountSpheres(stage), nspheres)
+            self.assertTrue(stage.GetPrimAtPath(cellpath).IsLoaded())
@@ -0,0 +1,72 @@
+import omni.kit.test
+import os
+import time
+import tempfile
+from pxr import Gf, Sdf, Usd, UsdGeom, UsdShade
+
+from omni.sphereflake.flakecache import FlakeCache
+from .test_generate import NewFactories, DumpWorld, AssertSameWorld
+
+
+def MakeFlakeLayer(nspheres: int) -> Sdf.Layer:
+    # a stand-in flake at /World/F, its spheres bound to a material outside it
+    layer = Sdf.Layer.CreateAnonymous()
+    stage = Usd.Stage.Open(layer)
+    mtl = UsdShade.Material.Define(stage, "/World/Looks/Mirror")
+    UsdGeom.Xform.Define(stage, "/World/F")
+    for i in range(nspheres):
+        sphere = UsdGeom.Sphere.Define(stage, f"/World/F/S_{i}")
+        UsdShade.MaterialBindingAPI.Apply(sphere.GetPrim()).Bind(mtl)
+    return layer
+
+
+class TestFlakeCache(omni.kit.test.AsyncTestCase):
+
+    async def GenerateFlake(self, genmode: str, cachedir: str, sphflkname: str) -> tuple:
+        # cachedir None generates without the cache
+        params = {"p_flake_cache": cachedir is not None, "p_flake_cache_dir": cachedir or ""}
+        (stage, matman, smf, sff) = await NewFactories(genmode, params=params)
+        sff.GenPrep()
+        sff.Generate(sphflkname, Gf.Vec3f(100, 50, -20))
+        return (stage, sff)
+
+    async def test_hit_matches_plain(self):
+        for genmode in ["UsdSphere", "SdfSphere", "DirectMesh", "MergedMesh", "PointInstancer"]:
+            with tempfile.TemporaryDirectory() as cachedir:
+                (stage, sff) = await self.GenerateFlake(genmode, cachedir, "/World/SF")
+                self.assertEqual(sff.GetFlakeCacheStats(), (0, 1))
+                # a new session on the same directory, the flake comes from disk this time
+                (stage, sff) = await self.GenerateFlake(genmode, cachedir, "/World/SF")
+                self.assertEqual(sff.GetFlakeCacheStats(), (1, 0))
+                # the cached flake sits one level down, under the Flake reference
+                cached = {path.replace("/World/SF/Flake", "/World/SF"): val
+                          for (path, val) in DumpWorld(stage, "/World/SF").items()}
+                (stage, sff) = await self.GenerateFlake(genmode, None, "/World/SF")
+                AssertSameWorld(self, cached, DumpWorld(stage, "/World/SF"))
+
+    async def test_lru_eviction(self):
+        with tempfile.TemporaryDirectory() as cachedir:
+            layer = MakeFlakeLayer(20)
+            cache = FlakeCache(cachedir)
+            for key in ["a", "b", "c"]:
+                self.assertIsNotNone(cache.Store(key, layer, "/World/F"))
+                time.sleep(0.02)
+            size = cache.manifest["entries"]["a"]["size"]
+            self.assertEqual(cache.GetBindings("a")[0]["targets"], ["/World/Looks/Mirror"])
+
+            # a new session uses "a", which makes "b" the least recently used
+            cache = FlakeCache(cachedir)
+            self.assertIsNotNone(cache.Lookup("a"))
+            time.sleep(0.02)
+            # a lowered limit evicts right away
+            cache = FlakeCache(cachedir, maxbytes=2*size)
+            self.assertEqual(cache.evictCount, 1)
+            self.assertIsNone(cache.Lookup("b"))
+            self.assertFalse(os.path.exists(cache.GetLayerPath("b")))
+            self.assertIsNotNone(cache.Lookup("a"))
+            self.assertIsNotNone(cache.Lookup("c"))
+
+            # storing past the limit evicts the oldest entry but never the one just stored
+            cache.Store("d", layer, "/World/F")
+            self.assertEqual(sorted(cache.manifest["entries"].keys()), ["c", "d"])
+            self.assertLessEqual(cache.GetTotalBytes(), cache.maxbytes)
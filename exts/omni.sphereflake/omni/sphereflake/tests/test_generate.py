@@ -0,0 +1,237 @@
+import omni.kit.test
+import omni.usd
+import numpy as np
+from pxr import Gf, Usd, UsdGeom, UsdShade
+
+from omni.sphereflake.headless import MakeFactories
+
+
+async def NewFactories(genmode: str, depth: int = 2, grid: list = [1, 1, 1], params: dict = {}) -> tuple:
+    # the factories on a new stage of the current context, kitless or not - (stage, matman, smf, sff)
+    ctx = omni.usd.get_context()
+    await ctx.new_stage_async()
+    return MakeFactories(genmode, "Classic", depth, grid, [8, 8], params, ctx.get_stage())
+
+
+def DumpStage(stage, root: str = "/World") -> dict:
+    # every authored attribute value and relationship target under root, keyed by (primpath, propname)
+    rv = {}
+    for prim in stage.Traverse():
+        primpath = str(prim.GetPath())
+        if not primpath.startswith(root):
+            continue
+        rv[(primpath, "typeName")] = prim.GetTypeName()
+        for attr in prim.GetAttributes():
+            if attr.HasAuthoredValue():
+                val = attr.Get()
+                try:
+                    rv[(primpath, attr.GetName())] = np.asarray(val, dtype=np.float64)
+                except (TypeError, ValueError):
+                    rv[(primpath, attr.GetName())] = val
+        for rel in prim.GetRelationships():
+            rv[(primpath, rel.GetName())] = [str(t) for t in rel.GetTargets()]
+    return rv
+
+
+def AssertSameStage(test, dump1: dict, dump2: dict):
+    # the UsdGeom path rounds some values to float, the Sdf and numpy paths keep double
+    test.assertGreater(len(dump1), 0)
+    test.assertEqual(sorted(dump1.keys()), sorted(dump2.keys()))
+    for (key, val) in dump1.items():
+        if isinstance(val, np.ndarray):
+            np.testing.assert_allclose(val, dump2[key], rtol=1e-5, atol=1e-4, err_msg=str(key))
+        else:
+            test.assertEqual(val, dump2[key], str(key))
+
+
+def GetBoundMaterial(prim) -> str:
+    (mtl, _) = UsdShade.MaterialBindingAPI(prim).ComputeBoundMaterial()
+    return str(mtl.GetPath()) if mtl else ""
+
+
+def DumpWorld(stage, root: str = "/World") -> dict:
+    # world transform and material of every gprim, a moved root and a fresh one look the same - a mesh gives its
+    # points in world space, an instancer the world transforms of its instances instead of its prototypes
+    rv = {}
+    xfcache = UsdGeom.XformCache(Usd.TimeCode.Default())
+    prims = iter(Usd.PrimRange(stage.GetPrimAtPath(root)))
+    for prim in prims:
+        xform = np.array(xfcache.GetLocalToWorldTransform(prim), dtype=np.float64)
+        if prim.IsA(UsdGeom.PointInstancer):
+            prims.PruneChildren()
+            instancer = UsdGeom.PointInstancer(prim)
+            mats = instancer.ComputeInstanceTransformsAtTime(Usd.TimeCode.Default(), Usd.TimeCode.Default())
+            xform = np.array([np.array(mat) for mat in mats]) @ xform
+            mtl = ",".join(GetBoundMaterial(stage.GetPrimAtPath(path))
+                           for path in instancer.GetPrototypesRel().GetTargets())
+        elif prim.IsA(UsdGeom.Gprim):
+            if prim.IsA(UsdGeom.Mesh):
+                points = np.array(UsdGeom.Mesh(prim).GetPointsAttr().Get(), dtype=np.float64)
+                xform = points @ xform[:3, :3] + xform[3, :3]
+            mtl = GetBoundMaterial(prim)
+        else:
+            continue
+        rv[str(prim.GetPath())] = (xform, mtl, UsdGeom.Imageable(prim).ComputeVisibility())
+    return rv
+
+
+def AssertSameWorld(test, dump1: dict, dump2: dict):
+    test.assertGreater(len(dump1), 0)
+    test.assertEqual(sorted(dump1.keys()), sorted(dump2.keys()))
+    for (path, (xform, mtl, vis)) in dump1.items():
+        np.testing.assert_allclose(xform, dump2[path][0], rtol=1e-5, atol=1e-3, err_msg=path)
+        test.assertEqual((mtl, vis), dump2[path][1:], path)
+
+
+def CountMaterials(stage) -> dict:
+    # faces of every mesh and instances of every instancer, keyed by the material they end up bound to
+    rv = {}
+    for prim in stage.Traverse():
+        if prim.IsA(UsdGeom.PointInstancer):
+            instancer = UsdGeom.PointInstancer(prim)
+            mtls = [GetBoundMaterial(stage.GetPrimAtPath(path)) for path in instancer.GetPrototypesRel().GetTargets()]
+            counts = [(mtls[idx], 1) for idx in instancer.GetProtoIndicesAttr().Get()]
+        elif prim.IsA(UsdGeom.Mesh):
+            mesh = UsdGeom.Mesh(prim)
+            subsets = UsdGeom.Subset.GetAllGeomSubsets(mesh)
+            counts = [(GetBoundMaterial(subset.GetPrim()), len(subset.GetIndicesAttr().Get())) for subset in subsets]
+            if len(subsets) == 0:
+                counts = [(GetBoundMaterial(prim), len(mesh.GetFaceVertexCountsAttr().Get()))]
+        else:
+            continue
+        for (mtl, n) in counts:
+            rv[mtl] = rv.get(mtl, 0) + n
+    return rv
+
+
+class TestGenerate(omni.kit.test.AsyncTestCase):
+
+    async def GenerateOne(self, genmode: str, matname: str = "Mirror") -> dict:
+        (stage, matman, smf, sff) = await NewFactories(genmode)
+        sff.p_sf_matname = matname
+        sff.GenPrep()
+        sff.Generate("/World/SF", Gf.Vec3f(0, 50, 0))
+        return DumpStage(stage, "/World/SF")
+
+    def GetCellRoots(self, stage) -> list:
+        return [str(prim.GetPath()) for prim in stage.GetPrimAtPath("/World").GetChildren()
+                if prim.GetName().startswith("SphereFlake_")]
+
+    def DumpGrid(self, stage, sff) -> dict:
+        # the cells of the current grid and every merged or instancer chunk root
+        rv = {}
+        paths = [str(path) for path in sff.GetCellPaths(0, 0, 0, sff.p_nsfx, sff.p_nsfy, sff.p_nsfz)]
+        paths += [path for path in self.GetCellRoots(stage) if "_merged_" in path or "_instancer_" in path]
+        for path in paths:
+            rv.update(DumpWorld(stage, path))
+        return rv
+
+    async def test_sdfsphere_matches_usdsphere(self):
+        usddump = await self.GenerateOne("UsdSphere")
+        sdfdump = await self.GenerateOne("SdfSphere")
+        # the sphere prims are named after the genmode, everything else has to be the same
+        sdfdump = {(path.replace("SdfSphere", "UsdSphere"), name): val for ((path, name), val) in sdfdump.items()}
+        AssertSameStage(self, usddump, sdfdump)
+
+    async def test_sdfsphere_regenerate(self):
+        # a new material changes the topology key, so the flake is removed and authored again
+        (stage, matman, smf, sff) = await NewFactories("SdfSphere")
+        sff.GenPrep()
+        sff.Generate("/World/SF", Gf.Vec3f(0, 50, 0))
+        sff.p_sf_matname = "Red_Glass"
+        sff.Generate("/World/SF", Gf.Vec3f(0, 50, 0))
+        AssertSameStage(self, DumpStage(stage, "/World/SF"), await self.GenerateOne("SdfSphere", "Red_Glass"))
+
+    async def test_quads_match_authored(self):
+        # a per-level schedule only changes DirectMesh, MergedMesh authors the uniform nlat x nlng template
+        params = {"p_tess_mode": "PerLevel", "p_tess_levels": "16,8,4"}
+        for genmode in ["DirectMesh", "MergedMesh", "UsdSphere", "SdfSphere", "PointInstancer"]:
+            (stage, matman, smf, sff) = await NewFactories(genmode, params=params)
+            sff.GenPrep()
+            sff.Generate("/World/SF", Gf.Vec3f(0, 50, 0))
+            nfaces = sum(len(UsdGeom.Mesh(prim).GetFaceVertexCountsAttr().Get())
+                         for prim in stage.Traverse() if prim.IsA(UsdGeom.Mesh))
+            self.assertEqual(sff.CalcQuadsAndPrims()[0], nfaces, genmode)
+
+    async def test_workers_replace_serial_cells(self):
+        # a partial serial run names its cells like the workers do, so they replace them instead of doubling up
+        params = {"p_parallel_nxbatch": 2, "p_parallel_nybatch": 1, "p_parallel_nzbatch": 1, "p_parallel_workers": 2,
+                  "p_partial_ssfx": 1, "p_partial_ssfy": 0, "p_partial_ssfz": 0,
+                  "p_partial_nsfx": 1, "p_partial_nsfy": 1, "p_partial_nsfz": 2}
+        (stage, matman, smf, sff) = await NewFactories("SdfSphere", grid=[2, 1, 2], params=params)
+        sff.p_partialRender = True
+        sff.GenerateMany()
+        serialpaths = self.GetCellRoots(stage)
+        sff.p_partialRender = False
+        await sff.GenerateManyParallel()
+        self.assertEqual(len(serialpaths), 2)
+        self.assertEqual(len(self.GetCellRoots(stage)), 4)
+        self.assertTrue(set(serialpaths) <= set(self.GetCellRoots(stage)))
+        nspheres = sum(1 for prim in stage.Traverse() if prim.IsA(UsdGeom.Sphere))
+        self.assertEqual(nspheres, 4*sff.CalcSpheres())
+
+    async def test_sdfsphere_generate_many_twice(self):
+        # the second run updates the cells in place, bounds cubes included
+        (stage, matman, smf, sff) = await NewFactories("SdfSphere", grid=[2, 1, 2])
+        sff.GenerateMany()
+        sff.p_radratio = 0.4
+        sff.p_make_bounds_visible = not sff.p_make_bounds_visible
+        sff.GenerateMany()
+        params = {"p_radratio": 0.4, "p_make_bounds_visible": sff.p_make_bounds_visible}
+        (freshstage, matman, smf, sff) = await NewFactories("SdfSphere", grid=[2, 1, 2], params=params)
+        sff.GenerateMany()
+        AssertSameStage(self, DumpStage(stage), DumpStage(freshstage))
+
+    async def test_switch_mode_and_back(self):
+        # instances and merge chunks replace the cell roots, the next UsdSphere run must author them again and
+        # remove the chunks
+        switches = [("UsdSphere", {"p_instanceable": True}), ("MergedMesh", {"p_merge_chunk": 2}),
+                    ("PointInstancer", {"p_instancer_grid": True})]
+        (freshstage, matman, smf, sff) = await NewFactories("UsdSphere", grid=[2, 1, 1])
+        sff.GenerateMany()
+        for (genmode, params) in switches:
+            (stage, matman, smf, sff) = await NewFactories("UsdSphere", grid=[2, 1, 1])
+            sff.GenerateMany()
+            sff.p_genmode = genmode
+            for (name, val) in params.items():
+                setattr(sff, name, val)
+            sff.GenerateMany()
+            sff.p_genmode = "UsdSphere"
+            (sff.p_instanceable, sff.p_merge_chunk, sff.p_instancer_grid) = (False, 1, False)
+            sff.GenerateMany()
+            # the whole world, a merged or instancer chunk root left over from the switch shows up as extra gprims
+            AssertSameWorld(self, DumpWorld(stage), DumpWorld(freshstage))
+
+    async def test_merge_chunks_shrink_and_switch(self):
+        # the merged chunks of the bigger grid, or of MergedMesh at all, must not outlive the run that made them
+        params = {"p_merge_chunk": 2}
+        (stage, matman, smf, sff) = await NewFactories("MergedMesh", grid=[4, 1, 4], params=params)
+        sff.GenerateMany()
+        (sff.p_nsfx, sff.p_nsfz) = (2, 2)
+        sff.GenerateMany()
+        (freshstage, matman, smf, freshsff) = await NewFactories("MergedMesh", grid=[2, 1, 2], params=params)
+        freshsff.GenerateMany()
+        # the cells of the 4x1x4 grid have other names and stay, as they always did without p_incremental
+        AssertSameWorld(self, self.DumpGrid(stage, sff), self.DumpGrid(freshstage, freshsff))
+        for genmode in ["DirectMesh", "UsdSphere"]:
+            # from merged chunks to one flake per cell of the same grid
+            (stage, matman, smf, sff) = await NewFactories("MergedMesh", grid=[2, 1, 2], params=params)
+            sff.GenerateMany()
+            sff.p_genmode = genmode
+            sff.GenerateMany()
+            (freshstage, matman, smf, freshsff) = await NewFactories(genmode, grid=[2, 1, 2], params=params)
+            freshsff.GenerateMany()
+            AssertSameWorld(self, DumpWorld(stage), DumpWorld(freshstage))
+
+    async def test_merge_chunks_per_level(self):
+        # chunked flakes alternate the materials by depth like the ones authored one root each
+        for (genmode, params) in [("MergedMesh", {"p_merge_chunk": 3}), ("PointInstancer", {"p_instancer_grid": True})]:
+            params = dict(params, p_bind_mode="PerLevel")
+            (stage, matman, smf, sff) = await NewFactories(genmode, grid=[2, 1, 2], params=params)
+            sff.GenerateMany()
+            params = dict(params, p_merge_chunk=1, p_instancer_grid=False)
+            (freshstage, matman, smf, sff) = await NewFactories(genmode, grid=[2, 1, 2], params=params)
+            sff.GenerateMany()
+            counts = CountMaterials(stage)
+            self.assertEqual(len(counts), 2, genmode)
+            self.assertEqual(counts, CountMaterials(freshstage), genmode)
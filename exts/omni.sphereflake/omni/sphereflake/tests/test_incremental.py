@@ -0,0 +1,33 @@
+import omni.kit.test
+
+from .test_generate import NewFactories, DumpWorld, AssertSameWorld
+
+
+class TestIncremental(omni.kit.test.AsyncTestCase):
+
+    async def GenerateGrids(self, genmode: str, grids: list, incremental: bool = True) -> dict:
+        (stage, matman, smf, sff) = await NewFactories(genmode, grid=grids[0], params={"p_incremental": incremental})
+        for grid in grids:
+            (sff.p_nsfx, sff.p_nsfy, sff.p_nsfz) = grid
+            sff.GenerateMany()
+        return DumpWorld(stage)
+
+    async def test_grow_matches_fresh(self):
+        for genmode in ["UsdSphere", "SdfSphere"]:
+            grown = await self.GenerateGrids(genmode, [[2, 1, 2], [3, 1, 3]])
+            fresh = await self.GenerateGrids(genmode, [[3, 1, 3]])
+            AssertSameWorld(self, grown, fresh)
+
+    async def test_shrink_matches_fresh(self):
+        for genmode in ["UsdSphere", "SdfSphere"]:
+            shrunk = await self.GenerateGrids(genmode, [[3, 1, 3], [2, 1, 1]])
+            fresh = await self.GenerateGrids(genmode, [[2, 1, 1]])
+            AssertSameWorld(self, shrunk, fresh)
+
+    async def test_incremental_off_matches_fresh(self):
+        # leaving incremental mode takes the incremental cells with it
+        (stage, matman, smf, sff) = await NewFactories("SdfSphere", grid=[2, 1, 2], params={"p_incremental": True})
+        sff.GenerateMany()
+        sff.p_incremental = False
+        sff.GenerateMany()
+        AssertSameWorld(self, DumpWorld(stage), await self.GenerateGrids("SdfSphere", [[2, 1, 2]], False))
@@ -0,0 +1,57 @@
+import omni.kit.test
+import os
+import json
+import tempfile
+
+from omni.sphereflake.runlog import MakeRunRecord
+from omni.sphereflake.telemetry import TelemetrySink
+from .test_generate import NewFactories
+
+
+class TestRunLog(omni.kit.test.AsyncTestCase):
+
+    async def test_merged_mesh_counts_spheres(self):
+        # one merged mesh per flake, but the rate is spheres, all 91 of them at depth 2
+        (stage, matman, smf, sff) = await NewFactories("MergedMesh", grid=[2, 1, 1])
+        sff.GenerateMany()
+        rundict = MakeRunRecord(sff, smf, matman, 2.0, "test")
+        self.assertEqual(rundict["2-prims"], 1)
+        self.assertEqual(rundict["2-spheres"], 2*91)
+        self.assertEqual(rundict["2-spheres_per_sec"], 91)
+
+    async def test_point_instancer_counts_spheres(self):
+        # one instancer per flake, or one for the whole grid, the rate is still spheres
+        for instgrid in [False, True]:
+            (stage, matman, smf, sff) = await NewFactories("PointInstancer", grid=[2, 1, 1],
+                                                           params={"p_instancer_grid": instgrid})
+            sff.GenerateMany()
+            rundict = MakeRunRecord(sff, smf, matman, 2.0, "test")
+            self.assertEqual(rundict["2-grid_prims"], 1 if instgrid else 2)
+            self.assertEqual(rundict["2-spheres"], 2*91)
+            self.assertEqual(rundict["2-spheres_per_sec"], 91)
+
+    async def test_sink_rotates(self):
+        # every record is flushed on its own, and each one is past maxbytes, so each write rotates the file
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "logs", "runs.jsonl")
+            sink = TelemetrySink(path, maxbytes=10, backups=2)
+            for irun in range(5):
+                sink.Write({"0-run": irun})
+                sink.Close()
+            self.assertEqual(sink.nwritten, 5)
+            self.assertEqual(sink.ndropped, 0)
+            self.assertEqual(sorted(os.listdir(os.path.dirname(path))), ["runs.jsonl", "runs.jsonl.1", "runs.jsonl.2"])
+            for (suffix, irun) in [("", 4), (".1", 3), (".2", 2)]:
+                with open(path + suffix, "r") as f:
+                    self.assertEqual([json.loads(ln) for ln in f], [{"0-run": irun}])
+
+    async def test_sink_batches_without_rotating(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, "runs.jsonl")
+            sink = TelemetrySink(path, maxbytes=0)
+            for irun in range(100):
+                sink.Write({"0-run": irun})
+            sink.Close()
+            with open(path, "r") as f:
+                self.assertEqual([json.loads(ln)["0-run"] for ln in f], list(range(100)))
+            self.assertEqual(os.listdir(tmpdir), ["runs.jsonl"])
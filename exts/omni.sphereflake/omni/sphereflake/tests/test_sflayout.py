@@ -0,0 +1,46 @@
+import omni.kit.test
+import numpy as np
+from pxr import Gf
+
+from omni.sphereflake.sphereflake import SphereFlakeFactory
+from omni.sphereflake.sflayout import GetLayout, SphereFlakeLayout
+
+
+class _RecordingFactory(SphereFlakeFactory):
+    # records what GenRecursively would author instead of touching the stage
+    def __init__(self):
+        super().__init__(None, None)
+        self.recorded = {}
+
+    def GenSphere(self, sphflkname: str, matname: str, cenpt: Gf.Vec3f, rad: float, level: int = 0):
+        self.recorded[sphflkname] = (np.array(cenpt, dtype=np.float64), rad, level)
+
+
+class TestSphereFlakeLayout(omni.kit.test.AsyncTestCase):
+
+    async def test_layout_matches_genring(self):
+        cenpt = Gf.Vec3f(10, 50, -3)
+        for genform in SphereFlakeFactory.GetGenForms():
+            for depth in range(4):
+                sff = _RecordingFactory()
+                sff.p_genform = genform
+                sff.p_depth = depth
+                sff.p_radratio = 0.3
+                sff.GenRecursively("/World/SF", "Mirror", depth, depth, cenpt, cenpt, 50)
+
+                layout = GetLayout(genform, depth, 50, 0.3)
+                centers = layout.GetCenters(cenpt)
+                paths = layout.GetNodePaths("/World/SF")
+                self.assertEqual(len(paths), len(sff.recorded))
+                for i, path in enumerate(paths):
+                    (rcen, rrad, rlevel) = sff.recorded[path]
+                    np.testing.assert_allclose(centers[i], rcen, atol=1e-3)
+                    self.assertAlmostEqual(layout.radii[i], rrad, places=4)
+                    self.assertEqual(layout.depths[i], rlevel)
+
+    async def test_layout_structure(self):
+        layout = SphereFlakeLayout("Classic", 3, 50, 0.3)
+        self.assertEqual(layout.nnodes, 1 + 9 + 81 + 729)
+        self.assertEqual(layout.levelstart, [0, 1, 10, 91, 820])
+        self.assertTrue(np.all(layout.parents[1:] < np.arange(1, layout.nnodes)))
+        self.assertTrue(np.all(layout.depths[layout.parents[1:]] == layout.depths[1:] - 1))
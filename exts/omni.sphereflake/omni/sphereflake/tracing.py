@@ -0,0 +1,126 @@
+import os
+import json
+import time
+import datetime
+import functools
+import threading
+
+# Tracing spans for the generation hot path. Functions decorated with @traced cost one attribute check while tracing
+# is off. While it is on every call is aggregated per name (calls, inclusive, self and max time), and every
+# sample_every-th call of a name is kept as a Chrome trace event, up to maxevents, so long runs stay cheap.
+# WriteChromeTrace output opens in Perfetto (ui.perfetto.dev) or chrome://tracing.
+
+
+def GetDefaultTraceDir() -> str:
+    return os.path.join(os.path.expanduser("~"), ".omni.sphereflake", "traces")
+
+
+class Tracer():
+    enabled: bool = False
+    sample_every: int = 1
+    maxevents: int = 200000
+
+    def __init__(self, sample_every: int = 1, maxevents: int = 200000):
+        self.sample_every = sample_every
+        self.maxevents = maxevents
+        self._local = threading.local()
+        self.Reset()
+
+    def Reset(self):
+        # name -> [calls, inclusive ns, self ns, max ns, active calls, name], inclusive only counts the outermost of
+        # recursive calls
+        self._stats = {}
+        self._events = []
+        self._ndropped = 0
+        self._t0 = time.perf_counter_ns()
+
+    def Enable(self, enabled: bool = True, sample_every: int = None):
+        if sample_every is not None:
+            self.sample_every = max(1, sample_every)
+        self.enabled = enabled
+
+    def _GetStack(self) -> list:
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+            self._local.tid = threading.get_ident()
+        return stack
+
+    def Enter(self, name: str):
+        # stack entries are [stat, start ns, child ns], kept lean - this runs for every sphere of a flake
+        stat = self._stats.get(name)
+        if stat is None:
+            stat = self._stats[name] = [0, 0, 0, 0, 0, name]
+        stat[4] += 1
+        self._GetStack().append([stat, time.perf_counter_ns(), 0])
+
+    def Exit(self):
+        end = time.perf_counter_ns()
+        stack = self._local.stack
+        (stat, start, childns) = stack.pop()
+        elap = end - start
+        stat[0] += 1
+        stat[2] += elap - childns
+        stat[4] -= 1
+        if stat[4] == 0:
+            stat[1] += elap
+        if elap > stat[3]:
+            stat[3] = elap
+        if stack:
+            stack[-1][2] += elap
+        if stat[0] % self.sample_every == 0:
+            if len(self._events) < self.maxevents:
+                self._events.append((stat[5], start, elap, self._local.tid))
+            else:
+                self._ndropped += 1
+
+    def GetTable(self) -> list:
+        # (name, calls, inclusive s, self s, max ms), the most expensive self time first
+        rows = [(name, st[0], st[1]/1e9, st[2]/1e9, st[3]/1e6) for (name, st) in self._stats.items() if st[0] > 0]
+        return sorted(rows, key=lambda row: row[3], reverse=True)
+
+    def FormatTable(self) -> str:
+        lines = [f"{'span':<40}{'calls':>9}{'total s':>10}{'self s':>10}{'max ms':>10}"]
+        for (name, calls, incl, slf, mx) in self.GetTable():
+            lines.append(f"{name:<40}{calls:>9}{incl:>10.4f}{slf:>10.4f}{mx:>10.3f}")
+        if self._ndropped > 0:
+            lines.append(f"({self._ndropped} events past maxevents:{self.maxevents} only in the totals)")
+        return "\n".join(lines)
+
+    def WriteChromeTrace(self, path: str) -> int:
+        # complete ("X") events, timestamps in microseconds since Reset
+        pid = os.getpid()
+        events = [{"name": name, "cat": "sphereflake", "ph": "X", "pid": pid, "tid": tid,
+                   "ts": (start - self._t0) / 1000.0, "dur": elap / 1000.0}
+                  for (name, start, elap, tid) in self._events]
+        meta = {"sample_every": self.sample_every, "dropped": self._ndropped,
+                "date": datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump({"traceEvents": events, "displayTimeUnit": "ms", "otherData": meta}, f)
+        return len(events)
+
+
+_tracer = Tracer()
+
+
+def GetTracer() -> Tracer:
+    return _tracer
+
+
+def traced(name: str = None):
+    # @traced() names the span after the function (its __qualname__), @traced("name") for something else
+    def decorator(fn):
+        spanname = name if name is not None else fn.__qualname__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if not _tracer.enabled:
+                return fn(*args, **kwargs)
+            _tracer.Enter(spanname)
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                _tracer.Exit()
+        return wrapper
+    return decorator